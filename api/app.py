@@ -5,23 +5,27 @@ Flights application.
 
 import logging
 
-from flask import Flask, request, jsonify
-from flask_apispec import FlaskApiSpec
+from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_migrate import Migrate
 
 import api.settings
 from api.endpoints.healthz import healthz
+from api.endpoints.metrics import metrics
 from api.endpoints.users import users
 from api.endpoints.flights import flights
 from api.endpoints.routes import routes
 from api.endpoints.tickets import tickets
 from api.models.db import db
+from api.util import instrumentation, profiling, querylog, request_log, tracing
+from api.util.docs import CachedApiSpec
+from api.util.passwords import HashingBusy
+from api.util.uploads import SpoolingRequest
 from notifier.settings import mail_settings
 
 NAME = 'flights'
 
-docs = FlaskApiSpec()
+docs = CachedApiSpec()
 
 
 def create_app(config_obj=api.settings, **config_overrides):
@@ -34,6 +38,7 @@ def create_app(config_obj=api.settings, **config_overrides):
     root_logger.setLevel(level=logging.INFO)
 
     app = Flask(NAME)
+    app.request_class = SpoolingRequest
     app.config.from_object(config_obj)  # defaults
     app.config.update(config_overrides)
     app.config.update(mail_settings)
@@ -46,6 +51,7 @@ def create_app(config_obj=api.settings, **config_overrides):
     Migrate(app, db)
 
     app.register_blueprint(healthz)
+    app.register_blueprint(metrics)
     app.register_blueprint(users)
     app.register_blueprint(flights)
     app.register_blueprint(routes)
@@ -53,10 +59,11 @@ def create_app(config_obj=api.settings, **config_overrides):
 
     CORS(app, resources={r"/api/*": {'origins': '*'}})
 
-    @app.before_request
-    def log_request_body():
-        if request.get_data():
-            root_logger.info('Request Data: %s', request.json)
+    tracing.init_app(app)
+    profiling.init_app(app)
+    instrumentation.init_app(app)
+    querylog.init_app(app)
+    request_log.init_app(app)
 
     # error handling & reporting
     @app.errorhandler(422)
@@ -76,6 +83,17 @@ def create_app(config_obj=api.settings, **config_overrides):
             messages = ["Invalid request"]
         return jsonify({"messages": messages}), 422
 
+    @app.errorhandler(413)
+    def handle_request_entity_too_large(err):
+        """Refuse bodies over MAX_CONTENT_LENGTH before they are read."""
+        limit = app.config.get('MAX_CONTENT_LENGTH')
+        return jsonify({"message": f"Request body exceeds the {limit} byte limit."}), 413
+
+    @app.errorhandler(HashingBusy)
+    def handle_hashing_busy(err):
+        """Shed logins while the password hashing pool is saturated."""
+        return jsonify({"message": str(err)}), 503, {'Retry-After': '1'}
+
     @app.errorhandler(500)
     def handle_internal_error(err):
         """Handle 500 erros."""
@@ -87,7 +105,8 @@ def create_app(config_obj=api.settings, **config_overrides):
         root_logger.error('Application Exception: {}'.format(err))
 
     if not app.testing:  # workaround https://github.com/jmcarp/flask-apispec/issues/56 during testing
-        # generate Swagger 2.0 documentation for view functions and classes
+        # generate Swagger 2.0 documentation for view functions and classes,
+        # on first request when APISPEC_LAZY is set (see `api.util.docs`)
         docs.init_app(app)
         docs.register_existing_resources()
 
@@ -1,34 +1,77 @@
 """
 /flights endpoint.
 """
+import base64
+import json
+from collections import defaultdict
+from itertools import islice
+
 import marshmallow as mm
-from flask import Blueprint, request, abort
+from flask import Blueprint, Response, request, abort, stream_with_context
 from flask_apispec import doc, marshal_with, use_kwargs
-from sqlalchemy import and_
-from datetime import datetime, timedelta
+from sqlalchemy import and_, tuple_
+from datetime import datetime, timedelta, timezone
 
 from api.endpoints.tickets import TicketSchema
 from api.endpoints.util.auth import common_params, login_required, admin_required
-from api.models.db import Flight
+from api.models.db import Flight, Ticket
+from api.util import cache, itineraries
+from api.util.querylog import query_budget
 
 flights = Blueprint('flights', __name__)
 
+MAX_PAGE_SIZE = 1000
+ROUTE_SEARCH_DAYS = 30
+MAX_FLEX_DAYS = 7
+STREAM_BATCH_SIZE = 500
+
 
 class FlightSchema(mm.Schema):
+    """A flight with seat counts, which is all most clients need."""
+
     class Meta:
         strict = True
 
+    id = mm.fields.Integer(dump_only=True)
     origin_id = mm.fields.Integer(required=True)
     destination_id = mm.fields.Integer(required=True)
     departure = mm.fields.DateTime(required=True)
     arrival = mm.fields.DateTime(required=True)
     price = mm.fields.Number(required=True)
     capacity = mm.fields.Integer(required=True)
+    seats_sold = mm.fields.Integer(dump_only=True)
+    seats_available = mm.fields.Function(
+        lambda flight: max(0, int(flight.capacity) - flight.seats_sold), dump_only=True)
+
+
+class FlightDetailSchema(FlightSchema):
+    """A flight with its tickets, returned for `include=tickets`."""
+
     tickets = mm.fields.Nested(TicketSchema, many=True)
 
 
 class FlightsSchema(mm.Schema):
-    flights = mm.fields.Nested(FlightSchema, many=True)
+    flights = mm.fields.Nested(FlightDetailSchema, many=True)
+
+
+class LegSchema(mm.Schema):
+    id = mm.fields.Integer()
+    origin_id = mm.fields.Integer()
+    destination_id = mm.fields.Integer()
+    departure = mm.fields.DateTime()
+    arrival = mm.fields.DateTime()
+    price = mm.fields.Number()
+
+
+class ItinerarySchema(mm.Schema):
+    legs = mm.fields.Nested(LegSchema, many=True)
+    departure = mm.fields.DateTime()
+    arrival = mm.fields.DateTime()
+    price = mm.fields.Number()
+
+
+class ItinerariesSchema(mm.Schema):
+    itineraries = mm.fields.Nested(ItinerarySchema, many=True)
 
 
 flight_request_params = {
@@ -45,9 +88,73 @@ flight_request_params = {
         'required': False
     },
     'departure': {
-        'description': 'Departure Day',
+        'description': f'Departure day (UTC) e.g. 2019-07-19. Defaults to the next '
+                       f'{ROUTE_SEARCH_DAYS} days',
         'in': 'query',
-        'type': 'int',
+        'type': 'string',
+        'format': 'date',
+        'required': False
+    },
+    'flex': {
+        'description': f'Also search this many days either side of departure, up to '
+                       f'{MAX_FLEX_DAYS}',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    }
+}
+
+include_params = {
+    'include': {
+        'description': 'Pass "tickets" to list each flight\'s tickets',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    }
+}
+
+itinerary_params = {
+    'origin': {
+        'description': 'Origin',
+        'in': 'query',
+        'type': 'integer',
+        'required': True
+    },
+    'destination': {
+        'description': 'Destination',
+        'in': 'query',
+        'type': 'integer',
+        'required': True
+    },
+    'departure': {
+        'description': 'Day of the first departure (UTC) e.g. 2019-07-19. Defaults to now',
+        'in': 'query',
+        'type': 'string',
+        'format': 'date',
+        'required': False
+    },
+    'max_legs': {
+        'description': f'Most flights per itinerary, 1 to {itineraries.MAX_LEGS}. Defaults to 2',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    },
+    'min_connection': {
+        'description': 'Minutes to allow between flights. Defaults to 60',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    },
+    'sort': {
+        'description': 'arrival (earliest first, the default) or price (cheapest first)',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    },
+    'limit': {
+        'description': 'Itineraries to return, at most 20. Defaults to 5',
+        'in': 'query',
+        'type': 'integer',
         'required': False
     }
 }
@@ -69,8 +176,30 @@ date_range_params = {
     }
 }
 
+pagination_params = {
+    'limit': {
+        'description': f'Page size, at most {MAX_PAGE_SIZE}. Pages are ordered by departure.',
+        'in': 'query',
+        'type': 'integer',
+        'required': False
+    },
+    'cursor': {
+        'description': 'The next_cursor of the previous page',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    },
+    'stream': {
+        'description': 'Stream the response instead of building it in memory (true|false)',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    }
+}
+
 
 @flights.route('/api/flights', methods=('POST', ))
+@query_budget(3)
 @doc(params=common_params)
 @use_kwargs(FlightSchema().fields, locations=('json', ))
 @admin_required
@@ -83,15 +212,23 @@ def create(**kwargs):
 
 
 @flights.route('/api/flights', methods=('GET', ))
-@doc(params={**common_params, **date_range_params})
+@query_budget(3)
+@doc(params={**common_params, **date_range_params, **pagination_params,
+             **include_params, **cache.read_through_cache_params})
 @login_required
 def get_all():
-    """Get all flights."""
+    """Get all flights.
+
+    Passing `limit` or `cursor` returns one page ordered by departure along
+    with the `next_cursor` to fetch the next one. `stream=true` writes the
+    flights out as they are read from the database.
+    """
     from_str = request.args.get('from')
     to_str = request.args.get('to')
     try:
         if not from_str:
-            from_date = datetime.today()
+            # Whole minutes, so that default searches share a cache entry.
+            from_date = datetime.today().replace(second=0, microsecond=0)
         else:
             from_date = datetime.strptime(from_str, '%Y-%m-%dT%H:%M:%S')
 
@@ -102,45 +239,235 @@ def get_all():
     except Exception as exc:
         abort(422, str(exc))
 
-    flights = Flight.query.filter(
-        and_(Flight.departure >= from_date, Flight.arrival <= to_date)).all()
-    # FIXME: return {'flights': flights}, 200
-    # For some reason that doesn't work, even though
-    # it works in every other endpoint. E.g. L126
-    # ¯\_(ツ)_/¯
-    return {
-        'flights': [FlightSchema().dump(flight).data for flight in flights]
-    }, 200
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    stream = request.args.get('stream') == 'true'
+    include_tickets = _include_tickets()
+    if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+        abort(422, f'limit must be between 1 and {MAX_PAGE_SIZE}.')
+
+    if not (stream or limit or cursor):
+        return {'flights': _flights_in_window(from_date, to_date, include_tickets)}, 200
+
+    after = _decode_cursor(cursor) if cursor else None
+    query = _flights_in_window_query(from_date, to_date, after, limit)
+    if stream:
+        return Response(stream_with_context(_stream_flights(query, limit, include_tickets)),
+                        mimetype='application/json')
+
+    page = query.all()
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = _encode_cursor(page[-1])
+    return {'flights': _dump_flights(page, include_tickets),
+            'next_cursor': next_cursor}, 200
 
 
 @flights.route('/api/flights/route', methods=('GET', ))
-@doc(params={**common_params, **flight_request_params})
-@marshal_with(FlightsSchema())
+@query_budget(3)
+@doc(params={**common_params, **flight_request_params, **include_params,
+             **cache.read_through_cache_params})
+@marshal_with(FlightsSchema(), apply=False)
 @login_required
 def get_by_route():
-    """Get flights by route."""
-    origin = request.args.get('origin')
-    destination = request.args.get('destination')
-    flights = Flight.query.filter_by(origin_id=origin,
-                                     destination_id=destination).all()
+    """Get flights by route, in departure order.
+
+    Searches whole UTC days: the `departure` day give or take `flex` days, or
+    the coming `ROUTE_SEARCH_DAYS` days.
+    """
+    origin = request.args.get('origin', type=int)
+    destination = request.args.get('destination', type=int)
+    departure = request.args.get('departure')
+    flex = request.args.get('flex', 0, type=int)
+    if not 0 <= flex <= MAX_FLEX_DAYS:
+        abort(422, f'flex must be between 0 and {MAX_FLEX_DAYS}.')
+    try:
+        if departure:
+            first_day = datetime.strptime(departure, '%Y-%m-%d').date() - timedelta(days=flex)
+            days = 2 * flex + 1
+        else:
+            first_day = datetime.now(timezone.utc).date()
+            days = ROUTE_SEARCH_DAYS
+    except ValueError as exc:
+        abort(422, str(exc))
+
+    flights = _flights_by_route(origin, destination, first_day, days, _include_tickets())
     return {'flights': flights}, 200
 
 
 @flights.route('/api/flights/origin/<int:origin>', methods=('GET', ))
-@doc(params=common_params)
-@marshal_with(FlightsSchema())
+@query_budget(3)
+@doc(params={**common_params, **include_params, **cache.read_through_cache_params})
+@marshal_with(FlightsSchema(), apply=False)
 @login_required
 def get_by_origin(origin):
     """Get flights by origin."""
-    flights = Flight.query.filter_by(origin_id=origin).all()
-    return {'flights': flights}, 200
+    return {'flights': _flights_by_origin(origin, _include_tickets())}, 200
 
 
 @flights.route('/api/flights/destination/<int:destination>', methods=('GET', ))
-@doc(params=common_params)
-@marshal_with(FlightsSchema())
+@query_budget(3)
+@doc(params={**common_params, **include_params, **cache.read_through_cache_params})
+@marshal_with(FlightsSchema(), apply=False)
 @login_required
 def get_by_destination(destination):
     """Get flights by destination."""
-    flights = Flight.query.filter_by(destination_id=destination).all()
-    return {'flights': flights}, 200
+    return {'flights': _flights_by_destination(destination, _include_tickets())}, 200
+
+
+@flights.route('/api/flights/itineraries', methods=('GET', ))
+@query_budget(2)
+@doc(params={**common_params, **itinerary_params})
+@marshal_with(ItinerariesSchema())
+@login_required
+def get_itineraries():
+    """Search direct and connecting flights between two routes."""
+    origin = request.args.get('origin', type=int)
+    destination = request.args.get('destination', type=int)
+    max_legs = request.args.get('max_legs', 2, type=int)
+    min_connection = request.args.get('min_connection', 60, type=int)
+    sort = request.args.get('sort', 'arrival')
+    limit = request.args.get('limit', 5, type=int)
+    if origin is None or destination is None:
+        abort(422, 'origin and destination are required.')
+    if not 0 < max_legs <= itineraries.MAX_LEGS:
+        abort(422, f'max_legs must be between 1 and {itineraries.MAX_LEGS}.')
+    if min_connection < 0:
+        abort(422, 'min_connection cannot be negative.')
+    if sort not in itineraries.SORT_ORDERS:
+        abort(422, f'sort must be one of {", ".join(itineraries.SORT_ORDERS)}.')
+    if not 0 < limit <= 20:
+        abort(422, 'limit must be between 1 and 20.')
+
+    departure = request.args.get('departure')
+    try:
+        if departure:
+            earliest = datetime.strptime(departure, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+        else:
+            earliest = datetime.now(timezone.utc)
+    except ValueError as exc:
+        abort(422, str(exc))
+
+    found = itineraries.search(origin, destination, earliest, earliest + timedelta(days=1),
+                               max_legs=max_legs,
+                               min_connection=timedelta(minutes=min_connection),
+                               sort=sort, limit=limit)
+    return {'itineraries': found}, 200
+
+
+def _flights_in_window_query(from_date, to_date, after=None, limit=None):
+    """Flights in a window in keyset order, i.e. by `(departure, id)`.
+
+    Fetches one flight beyond `limit` to tell whether there is a next page.
+    """
+    query = Flight.query.filter_by(is_deleted=False).filter(
+        and_(Flight.departure >= from_date, Flight.arrival <= to_date))
+    if after is not None:
+        query = query.filter(tuple_(Flight.departure, Flight.id) > after)
+    query = query.order_by(Flight.departure, Flight.id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+    return query
+
+
+def _stream_flights(query, limit=None, include_tickets=False):
+    """Write out `{"flights": [...], "next_cursor": ...}` a batch at a time."""
+    yield '{"flights": ['
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+    if limit is not None:
+        rows = islice(rows, limit + 1)
+    next_cursor = None
+    count = 0
+    last = None
+    while True:
+        batch = list(islice(rows, STREAM_BATCH_SIZE))
+        if limit is not None and count + len(batch) > limit:
+            batch = batch[:limit - count]
+            next_cursor = _encode_cursor(batch[-1] if batch else last)
+        for flight in _dump_flights(batch, include_tickets):
+            yield (',' if count else '') + json.dumps(flight)
+            count += 1
+        if next_cursor or len(batch) < STREAM_BATCH_SIZE:
+            break
+        last = batch[-1]
+    yield '], "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+
+def _include_tickets():
+    return request.args.get('include') == 'tickets'
+
+
+def _dump_flights(flights, include_tickets=False):
+    """Serialize flights in a constant number of queries.
+
+    Tickets, when asked for, are loaded for all flights with a single `IN`
+    query rather than one query per flight.
+    """
+    flights = list(flights)
+    data = FlightSchema(many=True).dump(flights).data
+    if not include_tickets or not flights:
+        return data
+
+    tickets = defaultdict(list)
+    booked = Ticket.query.filter(Ticket.flight_id.in_([flight.id for flight in flights]))
+    for ticket in booked.order_by(Ticket.id):
+        tickets[ticket.flight_id].append(ticket)
+    for flight, flight_data in zip(flights, data):
+        flight_data['tickets'] = TicketSchema(many=True).dump(tickets[flight.id]).data
+    return data
+
+
+def _encode_cursor(flight):
+    position = [flight.departure.isoformat(), flight.id]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        departure, flight_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(departure), int(flight_id)
+    except (TypeError, ValueError):
+        abort(422, 'Invalid cursor.')
+
+
+# Flight searches are served from the cache by default and return serialized
+# flights, hence `apply=False` above: the schema is only used for the docs.
+# Entries are dropped whenever a flight is added on a route they cover, or a
+# ticket is booked or cancelled on a flight they list.
+
+@cache.cached(cache.FLIGHT_SEARCH, tags=lambda *args: ['flights_window'],
+              value_tags=cache.flight_tags)
+def _flights_in_window(from_date, to_date, include_tickets=False):
+    flights = Flight.query.filter_by(is_deleted=False).filter(
+        and_(Flight.departure >= from_date, Flight.arrival <= to_date))
+    return _dump_flights(flights, include_tickets)
+
+
+@cache.cached(cache.FLIGHT_SEARCH,
+              tags=lambda origin, destination, *args: [f'flights_route_{origin}_{destination}'],
+              value_tags=cache.flight_tags)
+def _flights_by_route(origin, destination, first_day, days, include_tickets=False):
+    # A half-open range on departure rather than date(departure), so that the
+    # (origin_id, destination_id, departure) index serves it directly.
+    start = datetime.combine(first_day, datetime.min.time(), tzinfo=timezone.utc)
+    flights = Flight.query.filter_by(is_deleted=False, origin_id=origin,
+                                     destination_id=destination).filter(
+        Flight.departure >= start,
+        Flight.departure < start + timedelta(days=days)).order_by(Flight.departure, Flight.id)
+    return _dump_flights(flights, include_tickets)
+
+
+@cache.cached(cache.FLIGHT_SEARCH, tags=lambda origin, *args: [f'flights_origin_{origin}'],
+              value_tags=cache.flight_tags)
+def _flights_by_origin(origin, include_tickets=False):
+    flights = Flight.query.filter_by(is_deleted=False, origin_id=origin)
+    return _dump_flights(flights, include_tickets)
+
+
+@cache.cached(cache.FLIGHT_SEARCH,
+              tags=lambda destination, *args: [f'flights_destination_{destination}'],
+              value_tags=cache.flight_tags)
+def _flights_by_destination(destination, include_tickets=False):
+    flights = Flight.query.filter_by(is_deleted=False, destination_id=destination)
+    return _dump_flights(flights, include_tickets)
@@ -0,0 +1,17 @@
+"""
+/metrics endpoint.
+
+"""
+
+from flask import Blueprint
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from api.util import instrumentation
+
+metrics = Blueprint('metrics', __name__)
+
+
+@metrics.route('/api/metrics')
+def get():
+    """Return request, SQL, Redis and cache metrics in Prometheus text format."""
+    return instrumentation.exposition(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
@@ -7,6 +7,8 @@ from flask_apispec import doc, marshal_with, use_kwargs
 
 from api.models.db import Route
 from api.endpoints.util.auth import common_params, login_required, admin_required
+from api.util import cache
+from api.util.querylog import query_budget
 
 routes = Blueprint('routes', __name__)
 
@@ -24,6 +26,7 @@ class RoutesSchema(mm.Schema):
 
 
 @routes.route('/api/routes', methods=('POST', ))
+@query_budget(4)
 @doc(params=common_params)
 @use_kwargs(RouteSchema(), locations=('json', ))
 @admin_required
@@ -36,10 +39,17 @@ def create(**kwargs):
 
 
 @routes.route('/api/routes', methods=('GET', ))
-@doc(params=common_params)
-@marshal_with(RoutesSchema())
+@query_budget(2)
+@doc(params={**common_params, **cache.read_through_cache_params})
+@marshal_with(RoutesSchema(), apply=False)
 @login_required
 def get_all():
     """Get all routes."""
-    routes = Route.query.all()
-    return {'routes': routes}, 200
+    return {'routes': _all_routes()}, 200
+
+
+# Served from process memory most of the time; dropped whenever a route is
+# added or removed.
+@cache.cached(cache.ROUTES, tags=lambda: ['routes'])
+def _all_routes():
+    return RouteSchema(many=True).dump(Route.query.order_by(Route.id)).data
@@ -2,12 +2,13 @@
 /tickets endpoint.
 """
 import marshmallow as mm
-from flask import Blueprint, request
+from flask import Blueprint, current_app, request
 from flask_apispec import doc, marshal_with, use_kwargs
 
 from api.models.db import Ticket, User
 from api.endpoints.util.auth import common_params, login_required, admin_required
-from api.util import cache
+from api.util import booking, cache, holds
+from api.util.querylog import query_budget
 
 tickets = Blueprint('tickets', __name__)
 
@@ -23,7 +24,13 @@ class TicketsSchema(mm.Schema):
     tickets = mm.fields.Nested(TicketSchema, many=True)
 
 
+def _tickets_booked_by(user_id):
+    tickets = Ticket.query.filter_by(is_deleted=False, booked_by_id=user_id).order_by(Ticket.id)
+    return TicketSchema(many=True).dump(tickets).data
+
+
 @tickets.route('/api/tickets/book', methods=('POST', ))
+@query_budget(4)
 @doc(params=common_params)
 @use_kwargs(TicketSchema(), locations=('json', ))
 @login_required
@@ -36,10 +43,12 @@ def create(**kwargs):
     #                      amount=flight.price,
     #                      currency='usd',
     #                      description='Ticket booking')
-    ticket = Ticket(**kwargs)
-    ticket.paid = True
-    ticket.booked_by_id = request.user_id
-    ticket.save()
+    try:
+        holds.book_directly(kwargs['flight_id'], request.user_id)
+    except booking.FlightNotFound:
+        return {'message': 'Flight not found.'}, 404
+    except booking.SoldOut:
+        return {'message': 'Flight is sold out.'}, 409
     response = {'message': 'Ticket successfully booked.'}
     # except stripe.CardError as e:
     #     return {'message': str(e)}, 400
@@ -47,45 +56,88 @@ def create(**kwargs):
     return response, 201
 
 
+@tickets.route('/api/tickets/hold', methods=('POST', ))
+@query_budget(2)
+@doc(params=common_params)
+@use_kwargs(TicketSchema(), locations=('json', ))
+@login_required
+def hold(flight_id):
+    """Hold a seat while the user checks out."""
+    ttl = current_app.config.get('SEAT_HOLD_TTL', holds.DEFAULT_TTL)
+    try:
+        hold_id = holds.hold_seat(flight_id, request.user_id, ttl)
+    except booking.FlightNotFound:
+        return {'message': 'Flight not found.'}, 404
+    except booking.SoldOut:
+        return {'message': 'Flight is sold out.'}, 409
+    response = {'message': 'Seat successfully held.', 'hold_id': hold_id, 'expires_in': ttl}
+    return response, 201
+
+
+@tickets.route('/api/tickets/hold/<hold_id>/confirm', methods=('POST', ))
+@query_budget(3)
+@doc(params=common_params)
+@login_required
+def confirm_hold(hold_id):
+    """Book a held seat."""
+    try:
+        holds.confirm_hold(hold_id, request.user_id)
+    except holds.HoldNotFound:
+        return {'message': 'Seat hold not found.'}, 404
+    except holds.HoldExpired:
+        return {'message': 'Seat hold has expired.'}, 410
+    except booking.FlightNotFound:
+        return {'message': 'Flight not found.'}, 404
+    except booking.SoldOut:
+        return {'message': 'Flight is sold out.'}, 409
+    return {'message': 'Ticket successfully booked.'}, 201
+
+
+@tickets.route('/api/tickets/hold/<hold_id>', methods=('DELETE', ))
+@query_budget(1)
+@doc(params=common_params)
+@login_required
+def release_hold(hold_id):
+    """Give a held seat back."""
+    try:
+        holds.release_hold(hold_id, request.user_id)
+    except holds.HoldNotFound:
+        return {'message': 'Seat hold not found.'}, 404
+    except holds.HoldExpired:
+        return {'message': 'Seat hold has expired.'}, 410
+    return {'message': 'Seat hold released.'}, 200
+
+
 @tickets.route('/api/tickets/<int:user_id>', methods=('GET', ))
+@query_budget(3)
 @doc(params={**common_params, **cache.cache_params})
 @marshal_with(TicketsSchema())
 @admin_required
 def get_by_user(user_id):
     """Get all tickets booked by user."""
-    use_cache = cache.parse_use_cache(request.headers)
-    cached_tickets = cache.get_data_from_redis([f'user_{user_id}'])
-    if cached_tickets and use_cache:
-        tickets = cached_tickets.get(f'user_{user_id}')
-        return {'tickets': tickets}, 200
-
-    tickets = Ticket.query.filter_by(booked_by_id=user_id).all()
-    if tickets:
-        cache.cache_data_in_redis({f'user_{user_id}': [TicketSchema().dump(ticket).data
-                                                       for ticket in tickets]})
+    policy = cache.CachePolicy.from_headers(request.headers)
+    tickets = policy.fetch(cache.USER_TICKETS.key(user_id),
+                           lambda: _tickets_booked_by(user_id),
+                           ttl=cache.USER_TICKETS.ttl)
     return {'tickets': tickets}, 200
 
 
 @tickets.route('/api/tickets/mine', methods=('GET', ))
+@query_budget(2)
 @doc(params={**common_params, **cache.cache_params})
 @marshal_with(TicketsSchema())
 @login_required
 def get_mine():
     """Get all tickets booked by user."""
-    use_cache = cache.parse_use_cache(request.headers)
-    cached_tickets = cache.get_data_from_redis([f'user_{request.user_id}'])
-    if cached_tickets and use_cache:
-        tickets = cached_tickets.get(f'user_{request.user_id}')
-        return {'tickets': tickets}, 200
-
-    tickets = Ticket.query.filter_by(booked_by_id=request.user_id)
-    if tickets:
-        cache.cache_data_in_redis({f'user_{request.user_id}': [TicketSchema().dump(ticket).data
-                                                               for ticket in tickets]})
+    policy = cache.CachePolicy.from_headers(request.headers)
+    tickets = policy.fetch(cache.USER_TICKETS.key(request.user_id),
+                           lambda: _tickets_booked_by(request.user_id),
+                           ttl=cache.USER_TICKETS.ttl)
     return {'tickets': tickets}, 200
 
 
 @tickets.route('/api/tickets/cancel/<int:ticket_id>', methods=('DELETE', ))
+@query_budget(5)
 @doc(params=common_params)
 @login_required
 def cancel(ticket_id):
@@ -93,5 +145,8 @@ def cancel(ticket_id):
     current_user = User.query.filter_by(id=request.user_id).first()
     ticket = Ticket.query.filter_by(id=ticket_id).first()
     if ticket.booked_by_id == (request.user_id or current_user.is_admin):
-        ticket.delete()
+        flight_id = ticket.flight_id
+        booking.cancel_ticket(ticket)
+        # The ticket is gone already; a Redis failure only costs the seat's hold.
+        cache.BREAKER.call(holds.seat_returned, flight_id)
     return {'message': 'Ticket successfully cancelled.'}, 200
@@ -2,16 +2,21 @@
 /users endpoint.
 
 """
+import mimetypes
 from io import BytesIO
 
 import marshmallow as mm
 import sqlalchemy
-from flask import Blueprint, request, send_file
+from flask import Blueprint, Response, abort, request, send_file
 from flask_apispec import doc, use_kwargs
 
 from api.models.db import User, Photo
 from api.endpoints.util.auth import common_params, login_required
 from api.settings import file_plugin
+from api.util import tasks
+from api.util.querylog import query_budget
+from api.util.storage import get_storage
+from api.util.thumbnails import VARIANTS
 
 users = Blueprint('users', __name__)
 
@@ -40,6 +45,7 @@ class UserPhotoSchema(mm.Schema):
 
 
 @users.route('/api/users/register', methods=('POST', ))
+@query_budget(2)
 @use_kwargs(UserRegistrationSchema(), locations=('json', ))
 def register(email, password):
     """Handle POST request at /users/register."""
@@ -60,6 +66,7 @@ def register(email, password):
 
 
 @users.route('/api/users/login', methods=('POST', ))
+@query_budget(4)
 @use_kwargs(UserRegistrationSchema(), locations=('json', ))
 def login(email, password):
     """Handle POST request at /users/login."""
@@ -68,6 +75,7 @@ def login(email, password):
 
     # Try to authenticate the found user using their password
     if user and user.is_registered_password(password):
+        user.rehash_password(password)
         # Generate the access token.
         access_token = user.generate_token(user.id)
         if access_token:
@@ -83,6 +91,7 @@ def login(email, password):
 
 
 @users.route('/api/users/stripe_id', methods=('POST', ))
+@query_budget(3)
 @doc(params=common_params)
 @use_kwargs({'stripe_id': mm.fields.Integer()}, locations=('json', ))
 @login_required
@@ -95,24 +104,73 @@ def add_stripe(stripe_id):
 
 
 @users.route('/api/users/photo/upload', methods=('POST', ))
+@query_budget(3)
 @doc(params=common_params)
 @use_kwargs(UserPhotoSchema(), locations=('files', ))
 @login_required
 def upload(data):
+    sha256, size = get_storage().save(data.stream)
     photo = Photo(name=data.filename,
-                  data=data.read(),
+                  sha256=sha256,
+                  size=size,
                   uploaded_by_id=request.user_id)
     photo.save()
+    tasks.generate_photo_variants(photo.id)
     response = {'message': f'Photo {photo.name} successfully uploaded.'}
     return response, 201
 
 
+photo_size_params = {
+    'size': {
+        'description': f'original (the default) or a resized variant: {", ".join(VARIANTS)}',
+        'in': 'query',
+        'type': 'string',
+        'required': False
+    }
+}
+
+
 @users.route('/api/users/photo/download', methods=('GET', ))
-@doc(params=common_params)
+@query_budget(3)
+@doc(params={**common_params, **photo_size_params})
 @login_required
 def download():
-    photo = Photo.query.filter_by(uploaded_by_id=request.user_id).order_by(
+    """Download your most recent photo.
+
+    Supports Range requests. The file is sent with `sendfile`, or by the
+    reverse proxy when `PHOTO_ACCEL_REDIRECT_PREFIX` is set. Resized variants
+    are rendered in the background after upload; until they are ready the
+    original is sent instead.
+    """
+    size = request.args.get('size', 'original')
+    if size != 'original' and size not in VARIANTS:
+        abort(422, f'size must be original or one of {", ".join(VARIANTS)}.')
+
+    photo = Photo.query.filter_by(is_deleted=False, uploaded_by_id=request.user_id).order_by(
         Photo.created_at.desc()).first()
-    return send_file(BytesIO(photo.data),
-                     attachment_filename=photo.name,
-                     as_attachment=True)
+    if photo is None:
+        abort(404, 'No photo uploaded yet.')
+    if size != 'original':
+        variant = photo.variants.filter_by(name=size).first()
+        if variant is not None:
+            return _send_stored(variant.sha256, photo.name)
+    if photo.sha256 is None:
+        # Uploaded before photos moved to storage and not migrated yet.
+        return send_file(BytesIO(photo.data),
+                         attachment_filename=photo.name,
+                         as_attachment=True)
+    return _send_stored(photo.sha256, photo.name)
+
+
+def _send_stored(sha256, name):
+    storage = get_storage()
+    accel_redirect = storage.accel_redirect(sha256)
+    if accel_redirect:
+        response = Response(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = accel_redirect
+        response.headers.set('Content-Disposition', 'attachment', filename=name)
+        return response
+    return send_file(storage.path(sha256) or storage.open(sha256),
+                     attachment_filename=name,
+                     as_attachment=True,
+                     conditional=True)
@@ -2,7 +2,8 @@ from functools import wraps
 
 from flask import abort, request
 
-from api.models.db import User
+from api.models.db import db, User
+from api.util import cache
 
 common_params = {
     'Authorization': {
@@ -30,6 +31,24 @@ def login_required(func):
     return wrapper
 
 
+def is_admin(user_id):
+    """Whether a user is an admin.
+
+    Roles are read through the cache, including this process' memory, so the
+    steady state costs no database query. Changing `User.is_admin` drops the
+    cached role everywhere once the change is committed.
+    """
+    policy = cache.CachePolicy(cache.CachePolicy.READ_THROUGH)
+    return policy.fetch(cache.USER_ROLES.key(user_id),
+                        lambda: _load_is_admin(user_id),
+                        ttl=cache.USER_ROLES.ttl,
+                        local_ttl=cache.USER_ROLES.local_ttl)
+
+
+def _load_is_admin(user_id):
+    return db.session.query(User.is_admin).filter_by(id=user_id).scalar()
+
+
 def admin_required(func):
     """With great power comes great responsibility."""
 
@@ -38,8 +57,9 @@ def admin_required(func):
         access_token = request.headers.get('Authorization')
         if access_token:
             user_id = User.decode_token(access_token)
-            user = User.query.get(user_id)
-            if not user.is_admin:
+            if isinstance(user_id, str):
+                abort(404, user_id)
+            if not is_admin(user_id):
                 abort(401, 'You\'re not authorized to perform this action.')
             request.user_id = user_id
         return func(*args, **kwargs)
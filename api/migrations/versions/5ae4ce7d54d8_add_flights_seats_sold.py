@@ -0,0 +1,31 @@
+"""Add flights.seats_sold counter
+
+Revision ID: 5ae4ce7d54d8
+Revises:
+Create Date: 2026-10-18 09:12:44.301552
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5ae4ce7d54d8'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # `create_app` runs `db.create_all()` before migrations are applied, so on
+    # a fresh database the column may already exist.
+    op.execute('ALTER TABLE flights '
+               'ADD COLUMN IF NOT EXISTS seats_sold INTEGER NOT NULL DEFAULT 0')
+    # Backfill from the live tickets booked before capacity was enforced.
+    op.execute('UPDATE flights SET seats_sold = counts.sold '
+               'FROM (SELECT flight_id, count(*) AS sold FROM tickets '
+               '      WHERE NOT is_deleted GROUP BY flight_id) AS counts '
+               'WHERE flights.id = counts.flight_id')
+
+
+def downgrade():
+    op.drop_column('flights', 'seats_sold')
@@ -0,0 +1,70 @@
+"""Move photo blobs out of Postgres into content-addressed storage
+
+Revision ID: 9a8501d66d07
+Revises: fe330ce95e66
+Create Date: 2026-10-18 16:41:05.193822
+
+"""
+from io import BytesIO
+
+from alembic import op
+import sqlalchemy as sa
+
+from api.util.storage import get_storage
+
+
+# revision identifiers, used by Alembic.
+revision = '9a8501d66d07'
+down_revision = 'fe330ce95e66'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 100
+
+
+def upgrade():
+    # `create_app` runs `db.create_all()` first, so the columns may exist.
+    op.execute('ALTER TABLE photos ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)')
+    op.execute('ALTER TABLE photos ADD COLUMN IF NOT EXISTS size INTEGER')
+    op.execute('CREATE INDEX IF NOT EXISTS ix_photos_sha256 ON photos (sha256)')
+    op.alter_column('photos', 'data', nullable=True)
+
+    # Commit every batch, so that only one batch of blobs is in memory and an
+    # interrupted run picks up where it stopped.
+    storage = get_storage()
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        while True:
+            batch = conn.execute(sa.text(
+                'SELECT id, data FROM photos '
+                'WHERE sha256 IS NULL AND data IS NOT NULL '
+                'ORDER BY id LIMIT :limit'), limit=BATCH_SIZE).fetchall()
+            if not batch:
+                break
+            for photo_id, data in batch:
+                sha256, size = storage.save(BytesIO(data))
+                conn.execute(sa.text(
+                    'UPDATE photos SET sha256 = :sha256, size = :size, data = NULL '
+                    'WHERE id = :id'), sha256=sha256, size=size, id=photo_id)
+
+
+def downgrade():
+    storage = get_storage()
+    with op.get_context().autocommit_block():
+        conn = op.get_bind()
+        while True:
+            batch = conn.execute(sa.text(
+                'SELECT id, sha256 FROM photos '
+                'WHERE data IS NULL AND sha256 IS NOT NULL '
+                'ORDER BY id LIMIT :limit'), limit=BATCH_SIZE).fetchall()
+            if not batch:
+                break
+            for photo_id, sha256 in batch:
+                with storage.open(sha256) as stored:
+                    conn.execute(sa.text('UPDATE photos SET data = :data WHERE id = :id'),
+                                 data=stored.read(), id=photo_id)
+
+    op.alter_column('photos', 'data', nullable=False)
+    op.drop_index('ix_photos_sha256', table_name='photos')
+    op.drop_column('photos', 'size')
+    op.drop_column('photos', 'sha256')
@@ -0,0 +1,44 @@
+"""Add photo_variants for resized copies of photos
+
+Revision ID: d2b8c66e5775
+Revises: 9a8501d66d07
+Create Date: 2026-10-18 18:22:51.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2b8c66e5775'
+down_revision = '9a8501d66d07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # `create_app` runs `db.create_all()` first, so the table may exist.
+    if 'photo_variants' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'photo_variants',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('is_deleted', sa.Boolean(), nullable=False),
+        sa.Column('photo_id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=16), nullable=False),
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.Integer(), nullable=False),
+        sa.Column('width', sa.Integer(), nullable=False),
+        sa.Column('height', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['photo_id'], ['photos.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('photo_id', 'name')
+    )
+    op.create_index(op.f('ix_photo_variants_id'), 'photo_variants', ['id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_photo_variants_id'), table_name='photo_variants')
+    op.drop_table('photo_variants')
@@ -0,0 +1,46 @@
+"""Add composite and partial indexes for hot queries
+
+Revision ID: fe330ce95e66
+Revises: 5ae4ce7d54d8
+Create Date: 2026-10-18 14:03:17.528190
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'fe330ce95e66'
+down_revision = '5ae4ce7d54d8'
+branch_labels = None
+depends_on = None
+
+# Partial indexes skip soft-deleted rows; see `api.models.db.NOT_DELETED`.
+INDEXES = {
+    'ix_flights_route_departure':
+        'flights (origin_id, destination_id, departure) WHERE NOT is_deleted',
+    'ix_flights_destination_id_departure':
+        'flights (destination_id, departure) WHERE NOT is_deleted',
+    'ix_flights_departure_id':
+        'flights (departure, id) WHERE NOT is_deleted',
+    'ix_tickets_booked_by_id_id':
+        'tickets (booked_by_id, id) WHERE NOT is_deleted',
+    'ix_tickets_flight_id':
+        'tickets (flight_id)',
+    'ix_photos_uploaded_by_id_created_at':
+        'photos (uploaded_by_id, created_at DESC) WHERE NOT is_deleted',
+}
+
+
+def upgrade():
+    # Built concurrently so that bookings keep flowing on large tables, which
+    # cannot happen inside a transaction. `db.create_all()` may already have
+    # created them on a fresh database.
+    with op.get_context().autocommit_block():
+        for name, definition in INDEXES.items():
+            op.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
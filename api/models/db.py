@@ -4,12 +4,17 @@ from datetime import datetime, timedelta
 
 import jwt
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+
+from api.util import passwords
 
 db = SQLAlchemy()
 
 SECRET = os.getenv('SECRET', 'secret')
 
+# Partial indexes skip soft-deleted rows. Queries only use them when they
+# filter on `is_deleted=False` too.
+NOT_DELETED = db.text('NOT is_deleted')
+
 
 class Base(object):
     id = db.Column(db.Integer, primary_key=True, index=True)
@@ -73,11 +78,20 @@ class User(db.Model, Base):
                                   number, one lowercase, one uppercase letter \
                                   and at least six characters')
 
-        return Bcrypt().generate_password_hash(password).decode()
+        return passwords.hash_password(password)
 
     def is_registered_password(self, password):
         """Check the password against its hash."""
-        return Bcrypt().check_password_hash(self.password, password)
+        return passwords.check_password(self.password, password)
+
+    def rehash_password(self, password):
+        """Re-hash a verified password if the work factor has changed.
+
+        Skips the strength rules, which the password may predate.
+        """
+        if passwords.needs_rehash(self.password):
+            self.password = passwords.hash_password(password)
+            self.save()
 
     @staticmethod
     def generate_token(user_id):
@@ -116,11 +130,39 @@ class Photo(db.Model, Base):
     """Define the photos table."""
 
     __tablename__ = 'photos'
+    __table_args__ = (
+        db.Index('ix_photos_uploaded_by_id_created_at', 'uploaded_by_id',
+                 db.text('created_at DESC'), postgresql_where=NOT_DELETED),
+    )
 
     name = db.Column(db.String(255), nullable=False)
-    data = db.Column(db.LargeBinary, nullable=False)
+    # Content lives in `api.util.storage` under its SHA-256. `data` only
+    # holds photos uploaded before that, until they are migrated.
+    data = db.Column(db.LargeBinary)
+    sha256 = db.Column(db.String(64), index=True)
+    size = db.Column(db.Integer)
     uploaded_by = db.relationship('User')
     uploaded_by_id = db.Column(db.Integer, db.ForeignKey(User.id))
+    variants = db.relationship('PhotoVariant',
+                               backref='photo',
+                               cascade='all, delete-orphan',
+                               lazy='dynamic')
+
+
+class PhotoVariant(db.Model, Base):
+    """Define the photo_variants table: resized copies of a photo."""
+
+    __tablename__ = 'photo_variants'
+    __table_args__ = (
+        db.UniqueConstraint('photo_id', 'name'),
+    )
+
+    photo_id = db.Column(db.Integer, db.ForeignKey('photos.id'), nullable=False)
+    name = db.Column(db.String(16), nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
 
 
 class Route(db.Model, Base):
@@ -139,9 +181,23 @@ class Flight(db.Model, Base):
     """Define the flights table."""
 
     __tablename__ = 'flights'
+    __table_args__ = (
+        # Searches by route and by origin, in departure order.
+        db.Index('ix_flights_route_departure', 'origin_id', 'destination_id',
+                 'departure', postgresql_where=NOT_DELETED),
+        db.Index('ix_flights_destination_id_departure', 'destination_id',
+                 'departure', postgresql_where=NOT_DELETED),
+        # Date windows and keyset pagination on (departure, id).
+        db.Index('ix_flights_departure_id', 'departure', 'id',
+                 postgresql_where=NOT_DELETED),
+    )
 
     capacity = db.Column(db.Numeric(precision=3, asdecimal=False),
                          nullable=False)
+    # Seats taken on this flight; bumped atomically by `api.util.booking`
+    # so capacity checks never have to count tickets.
+    seats_sold = db.Column(db.Integer, default=0, server_default='0',
+                           nullable=False)
     origin_id = db.Column(db.Integer, db.ForeignKey('routes.id'), nullable=False)
     origin = db.relationship('Route', foreign_keys=[origin_id])
 
@@ -171,8 +227,13 @@ class Ticket(db.Model, Base):
     """Define the tickets table."""
 
     __tablename__ = 'tickets'
+    __table_args__ = (
+        db.Index('ix_tickets_booked_by_id_id', 'booked_by_id', 'id',
+                 postgresql_where=NOT_DELETED),
+    )
 
-    flight_id = db.Column(db.Integer, db.ForeignKey('flights.id'))
+    # Not partial: foreign key checks when deleting flights need every row.
+    flight_id = db.Column(db.Integer, db.ForeignKey('flights.id'), index=True)
     flight = db.relationship('Flight')
     paid = db.Column(db.Boolean, default=False)
     booked_by_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -9,6 +9,7 @@ import argparse
 import factory
 
 from api import app
+from api.models.db import Route
 from tests.util.factories import FlightFactory, RouteFactory, UserFactory, TicketFactory
 
 
@@ -60,9 +61,15 @@ def main():
                                               chance_of_getting_true=0),
                         help='Create user as admin')
 
+    parser.add_argument('--if-empty',
+                        action='store_true',
+                        help='Only seed a database that has no routes yet')
+
     args = parser.parse_args()
     flights_app = app.create_app()
     with flights_app.app_context():
+        if args.if_empty and Route.query.first() is not None:
+            return
         seed_routes()
         seed_flights()
         seed_user(args)
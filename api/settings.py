@@ -20,9 +20,56 @@ APISPEC_SPEC = APISpec(
 APISPEC_SWAGGER_URL = '/api/swagger.json'
 APISPEC_SWAGGER_UI_URL = '/api/'
 APISPEC_TITLE = 'flights'
+# Build the spec on first request for the docs instead of at boot, or serve
+# the file written by `flask build-docs` and never build it at all.
+APISPEC_LAZY = os.getenv('APISPEC_LAZY', 'true').lower() == 'true'
+APISPEC_PREBUILT = os.getenv('APISPEC_PREBUILT')
 
 user = os.getenv('DB_USER', 'postgres')
 password = os.getenv('DB_PASSWORD', 'password')
 host = os.getenv('DB_HOST', 'postgres')
 SQLALCHEMY_DATABASE_URI = f'postgresql+psycopg2://{user}:{password}@{host}:5432/flights'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+PHOTO_STORAGE_BACKEND = os.getenv('PHOTO_STORAGE_BACKEND', 'api.util.storage.LocalStorage')
+PHOTO_STORAGE_DIR = os.getenv('PHOTO_STORAGE_DIR', 'media')
+# e.g. /protected-media, an nginx `internal` location aliased to PHOTO_STORAGE_DIR
+PHOTO_ACCEL_REDIRECT_PREFIX = os.getenv('PHOTO_ACCEL_REDIRECT_PREFIX')
+
+# Uploads over MAX_CONTENT_LENGTH are refused; smaller ones spill from memory
+# to UPLOAD_SPOOL_DIR (the system temp dir by default) past UPLOAD_SPOOL_MAX_MEMORY.
+MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', 10 * 1024 * 1024))  # bytes
+UPLOAD_SPOOL_MAX_MEMORY = int(os.getenv('UPLOAD_SPOOL_MAX_MEMORY', 512 * 1024))  # bytes
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR')
+
+# Request logs are sampled, capped and redacted; see `api.util.request_log`.
+REQUEST_LOG_SAMPLE_RATE = float(os.getenv('REQUEST_LOG_SAMPLE_RATE', 0.1))
+REQUEST_LOG_MAX_BODY = int(os.getenv('REQUEST_LOG_MAX_BODY', 2048))  # bytes
+REQUEST_LOG_ENDPOINTS = {
+    'healthz.get': {'sample_rate': 0},
+    'metrics.get': {'sample_rate': 0},
+}
+REQUEST_LOG_REDACT = ('password', 'token', 'access_token', 'authorization')
+REQUEST_LOG_FILE = os.getenv('REQUEST_LOG_FILE')  # stderr by default
+REQUEST_LOG_QUEUE_SIZE = int(os.getenv('REQUEST_LOG_QUEUE_SIZE', 10000))
+
+# Slow queries, N+1 patterns and views over their `@query_budget` are logged;
+# see `api.util.querylog`. Strict mode raises instead, as in the tests.
+SLOW_QUERY_MS = int(os.getenv('SLOW_QUERY_MS', 200))
+N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 5))
+QUERY_BUDGET_STRICT = os.getenv('QUERY_BUDGET_STRICT', 'false').lower() == 'true'
+
+# Admins profile a request by sending PROFILE_HEADER; see `api.util.profiling`.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', 1))
+PROFILE_DIR = os.getenv('PROFILE_DIR')  # flights-profiles in the system temp dir by default
+
+# Spans of sampled traces are exported as JSON lines or OTLP; see `api.util.tracing`.
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'jsonl')  # 'jsonl', 'otlp' or '' for off
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 0.1))
+TRACING_FILE = os.getenv('TRACING_FILE')  # flights-traces.jsonl in the system temp dir by default
+TRACING_OTLP_ENDPOINT = os.getenv('TRACING_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+
+SEAT_HOLD_TTL = int(os.getenv('SEAT_HOLD_TTL', 600))  # seconds
+BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
@@ -0,0 +1,75 @@
+"""
+Seat booking engine.
+
+Capacity is enforced with the per-flight `Flight.seats_sold` counter, which is
+bumped by a single conditional UPDATE:
+
+    UPDATE flights SET seats_sold = seats_sold + 1
+    WHERE id = :flight_id AND seats_sold < capacity
+
+Postgres serializes concurrent UPDATEs on the same row, and re-evaluates the
+WHERE clause once the competing transaction commits, so two bookings can never
+both take the last seat. The row lock is held only until the ticket INSERT in
+the same transaction commits; nothing ever counts tickets.
+"""
+from api.models.db import db, Flight, Ticket
+
+
+class BookingError(Exception):
+    """Base class for booking failures."""
+
+
+class FlightNotFound(BookingError):
+    """The requested flight does not exist."""
+
+
+class SoldOut(BookingError):
+    """The requested flight has no seats left."""
+
+
+def book_seat(flight_id, user_id, paid=True):
+    """Take a seat on a flight and issue the ticket in one transaction.
+
+    Parameters
+    ----------
+    flight_id : int
+    user_id : int
+    paid : bool
+
+    Returns
+    -------
+    ticket : Ticket
+
+    Raises
+    ------
+    FlightNotFound, SoldOut
+    """
+    taken = Flight.query.filter(Flight.id == flight_id,
+                                Flight.seats_sold < Flight.capacity).update(
+                                    {Flight.seats_sold: Flight.seats_sold + 1},
+                                    synchronize_session=False)
+    if not taken:
+        db.session.rollback()
+        if db.session.query(Flight.id).filter_by(id=flight_id).scalar() is None:
+            raise FlightNotFound(f'Flight {flight_id} does not exist.')
+        raise SoldOut(f'Flight {flight_id} is sold out.')
+
+    ticket = Ticket(flight_id=flight_id, paid=paid, booked_by_id=user_id)
+    db.session.add(ticket)
+    db.session.commit()
+    return ticket
+
+
+def cancel_ticket(ticket):
+    """Delete a ticket and hand its seat back in one transaction.
+
+    Parameters
+    ----------
+    ticket : Ticket
+    """
+    Flight.query.filter(Flight.id == ticket.flight_id,
+                        Flight.seats_sold > 0).update(
+                            {Flight.seats_sold: Flight.seats_sold - 1},
+                            synchronize_session=False)
+    db.session.delete(ticket)
+    db.session.commit()
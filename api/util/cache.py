@@ -1,54 +1,554 @@
 import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+
 import redis
+from flask import has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from api.models.db import Flight, Route, Ticket, User
+from api.util import instrumentation, tracing
+from api.util.lru import LRUCache
+
+# Bounded timeouts: a slow or unreachable Redis must cost a request at most a
+# few hundred milliseconds before the circuit breaker takes it out of the path.
+REDIS_CONN = tracing.TracedRedis(connection_pool=redis.ConnectionPool(
+    host='redis',
+    port=6379,
+    socket_timeout=float(os.getenv('REDIS_SOCKET_TIMEOUT', 0.25)),
+    socket_connect_timeout=float(os.getenv('REDIS_CONNECT_TIMEOUT', 0.25)),
+    connection_class=instrumentation.CountingConnection))
+
+DEFAULT_TTL = 300  # seconds
+
+# Stampede protection: only the holder of a key's rebuild lock recomputes it,
+# everybody else waits up to LOCK_WAIT for the holder's result.
+LOCK_TIMEOUT = 5  # seconds
+LOCK_WAIT = 2  # seconds
+LOCK_POLL_INTERVAL = 0.02  # seconds
+
+# In-process tier in front of Redis, for namespaces with a `local_ttl`. Its size
+# is measured in bytes of cached JSON. Invalidations are broadcast to every
+# worker over INVALIDATION_CHANNEL.
+LOCAL_CACHE = LRUCache(
+    max_entries=int(os.getenv('LOCAL_CACHE_MAX_ENTRIES', 2048)),
+    max_bytes=int(os.getenv('LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024)))
+INVALIDATION_CHANNEL = 'cache_invalidations'
+
+_MISSING = object()
+
+logger = logging.getLogger(__name__)
 
-REDIS_CONN = redis.StrictRedis(host='redis', port=6379)
 
-cache_params = {
-    'use_cache': {
-        'description': 'Bool — whether to use cache',
-        'in': 'header',
-        'type': 'boolean',
-        'default': False,
-        'required': False
+def cache_header(default):
+    """Swagger docs for the `use_cache` header of an endpoint.
+
+    `default` is what the endpoint does without the header: `'true'` for
+    read-through endpoints, `'false'` for those that bypass the cache.
+    """
+    return {
+        'use_cache': {
+            'description': '`true` to read through the cache, `refresh` to rebuild the cached '
+                           f'value, `false` to skip the cache entirely. Defaults to `{default}`',
+            'in': 'header',
+            'type': 'string',
+            'default': default,
+            'required': False
+        }
     }
-}
 
 
-def parse_use_cache(headers):
-    cache_header = headers.get('use_cache', 'false')
-    return json.loads(cache_header.lower())
+cache_params = cache_header('false')
+read_through_cache_params = cache_header('true')
+
+
+class Namespace(object):
+    """A versioned family of cache keys.
+
+    Bump `version` whenever the shape of the cached values changes: keys written
+    by older code are then never read again and simply age out.
+    """
+
+    def __init__(self, name, version=1, ttl=DEFAULT_TTL, local_ttl=None):
+        self.name = name
+        self.version = version
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+
+    def key(self, *parts):
+        return ':'.join([self.name, f'v{self.version}'] + [str(part) for part in parts])
+
+
+USER_TICKETS = Namespace('user_tickets')
+FLIGHT_SEARCH = Namespace('flight_search', version=2, ttl=60, local_ttl=10)
+ROUTES = Namespace('routes', ttl=DEFAULT_TTL, local_ttl=30)
+USER_ROLES = Namespace('user_roles', ttl=DEFAULT_TTL, local_ttl=60)
+
+
+def route_tags(origin_id, destination_id):
+    """Tags of every cached flight search a flight on this route can appear in."""
+    return ['flights_window',
+            f'flights_route_{origin_id}_{destination_id}',
+            f'flights_origin_{origin_id}',
+            f'flights_destination_{destination_id}']
+
+
+def flight_tag(flight_id):
+    """Tag of every cached flight search listing this flight."""
+    return f'flight_{flight_id}'
+
+
+def flight_tags(flights):
+    """Tags of a cached flight search, one per serialized flight it lists."""
+    return [flight_tag(flight['id']) for flight in flights]
+
+
+class CacheStats(object):
+    """Per-process cache hit, miss and invalidation counters."""
+
+    def __init__(self):
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+        instrumentation.CACHE_EVENTS.labels('redis', name).inc(amount)
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        for name in ('hits', 'misses', 'invalidations'):
+            counts.setdefault(name, 0)
+        return counts
+
+
+STATS = CacheStats()
+
+
+class CircuitBreaker(object):
+    """Take Redis out of the request path after repeated failures.
+
+    After `failure_threshold` consecutive errors the breaker opens and calls are
+    skipped for `reset_timeout` seconds. Then a single trial call is let through;
+    its outcome closes the breaker again or keeps it open.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: this caller is the trial, everyone else keeps waiting.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, default=None, **kwargs):
+        """Call `func`, returning `default` if Redis is failing or known to be down."""
+        if not self.allow():
+            STATS.incr('short_circuits')
+            return default
+        try:
+            result = func(*args, **kwargs)
+        except redis.RedisError as exc:
+            self.failed()
+            STATS.incr('errors')
+            logger.warning('Redis call %s failed: %s', getattr(func, '__name__', func), exc)
+            return default
+        self.succeeded()
+        return result
+
+
+BREAKER = CircuitBreaker()
+
+# KEYS: lock; ARGV: token
+_release_lock = REDIS_CONN.register_script("""
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+""")
+
+
+class CachePolicy(object):
+    """How a single request uses the cache.
+
+    bypass        never talk to Redis
+    read-through  serve the cached value, filling the cache on a miss
+    refresh       ignore the cached value but store a freshly loaded one
+
+    Every Redis call goes through the circuit breaker, so when Redis is slow or
+    down requests quietly fall back to the database.
+    """
+
+    BYPASS = 'bypass'
+    READ_THROUGH = 'read-through'
+    REFRESH = 'refresh'
+
+    def __init__(self, mode=BYPASS, breaker=None):
+        self.mode = mode
+        self.breaker = breaker
+
+    @classmethod
+    def from_headers(cls, headers, default=BYPASS):
+        """Pick the policy requested by the `use_cache` header."""
+        value = headers.get('use_cache')
+        if value is None:
+            return cls(default)
+        value = value.strip().lower()
+        if value == 'refresh':
+            return cls(cls.REFRESH)
+        if value in ('true', '1', 'yes'):
+            return cls(cls.READ_THROUGH)
+        return cls(cls.BYPASS)
+
+    def fetch(self, key, loader, ttl=DEFAULT_TTL, tags=(), local_ttl=None):
+        """Return the value for `key`, calling `loader` when it is not usable from cache.
+
+        Parameters
+        ----------
+        key : str
+        loader : callable returning a JSON-serializable value
+        ttl : int
+        tags : iterable of str, or callable
+            Tags to file the key under, see `invalidate_tags`. A callable is
+            given the loaded value and returns them.
+        local_ttl : int, optional
+            Also keep the value in this process' memory for this many seconds.
+        """
+        if self.mode == self.BYPASS:
+            return loader()
+
+        breaker = self.breaker or BREAKER
+        if self.mode == self.READ_THROUGH:
+            if local_ttl:
+                _ensure_invalidation_listener()
+                value = LOCAL_CACHE.get(key, _MISSING)
+                instrumentation.CACHE_EVENTS.labels(
+                    'local', 'misses' if value is _MISSING else 'hits').inc()
+                if value is not _MISSING:
+                    return value
+            payload = breaker.call(_get_payload, key)
+            if payload is not None:
+                return _decode(key, payload, local_ttl)
+            return self._rebuild_once(breaker, key, loader, ttl, tags, local_ttl)
+
+        value = loader()
+        _store(breaker, key, value, ttl, tags, local_ttl)
+        if local_ttl:
+            # Other workers may hold the value we just replaced.
+            breaker.call(REDIS_CONN.publish, INVALIDATION_CHANNEL, json.dumps([key]))
+        return value
+
+    def _rebuild_once(self, breaker, key, loader, ttl, tags, local_ttl):
+        token = uuid.uuid4().hex
+        lock_key = f'{key}:lock'
+        locked = breaker.call(REDIS_CONN.set, lock_key, token, nx=True, ex=LOCK_TIMEOUT,
+                              default=_MISSING)
+        if locked is _MISSING:
+            # Redis is failing; waiting on it would only delay the query.
+            return loader()
+        if locked:
+            try:
+                value = loader()
+                _store(breaker, key, value, ttl, tags, local_ttl)
+                return value
+            finally:
+                breaker.call(_release_lock, keys=[lock_key], args=[token])
+
+        # Somebody else is rebuilding the key; wait for their result rather
+        # than piling onto the database with the same query.
+        deadline = time.monotonic() + LOCK_WAIT
+        while time.monotonic() < deadline and not breaker.is_open:
+            time.sleep(LOCK_POLL_INTERVAL)
+            payload = breaker.call(REDIS_CONN.get, key, default=_MISSING)
+            if payload is _MISSING:
+                break
+            if payload is not None:
+                STATS.incr('lock_waits')
+                return _decode(key, payload, local_ttl)
+        return loader()
+
 
+def _get_payload(key):
+    payload = REDIS_CONN.get(key)
+    STATS.incr('misses' if payload is None else 'hits')
+    return payload
 
-def cache_data_in_redis(data):
-    """Cache data in redis.
+
+def _decode(key, payload, local_ttl):
+    value = json.loads(payload)
+    if local_ttl:
+        LOCAL_CACHE.set(key, value, local_ttl, size=len(payload))
+    return value
+
+
+def _store(breaker, key, value, ttl, tags, local_ttl):
+    if callable(tags):
+        tags = tags(value)
+    payload = json.dumps(value)
+    breaker.call(_write_payloads, {key: payload}, ttl, tags)
+    if local_ttl:
+        LOCAL_CACHE.set(key, value, local_ttl, size=len(payload))
+
+
+def cached(namespace, tags=None, value_tags=None, default=CachePolicy.READ_THROUGH):
+    """Read-through cache for a function of normalized, stringable arguments.
+
+    The result of `func(*args)` is stored under `namespace.key(func.__name__, *args)`
+    and must be JSON-serializable. Inside a request, the `use_cache` header can
+    still pick another policy.
+
+    Parameters
+    ----------
+    namespace : Namespace
+    tags : callable, optional
+        Called with the same arguments, returns the tags to file the key under.
+    value_tags : callable, optional
+        Called with the result, returns more tags to file the key under.
+    default : str
+        Policy mode when the request does not ask for one.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            if has_request_context():
+                policy = CachePolicy.from_headers(request.headers, default=default)
+            else:
+                policy = CachePolicy(default)
+            key_tags = tags(*args) if tags else ()
+
+            def all_tags(value):
+                return [*key_tags, *value_tags(value)]
+
+            return policy.fetch(namespace.key(func.__name__, *args),
+                                lambda: func(*args),
+                                ttl=namespace.ttl,
+                                tags=all_tags if value_tags else key_tags,
+                                local_ttl=namespace.local_ttl)
+
+        return wrapper
+
+    return decorator
+
+
+def tag_key(tag):
+    return f'tag:{tag}'
+
+
+def cache_data_in_redis(data, ttl=DEFAULT_TTL, tags=()):
+    """Cache data in redis, with an expiry, in a single round trip.
 
     Parameters
     ----------
     data : dict of {key : value}
+    ttl : int or dict of {key : int}
+        Seconds until the keys expire, either for every key or per key.
+    tags : iterable of str
+        Tags to file every key under, so they can be dropped together.
+    """
+    return _write_payloads({key: json.dumps(value) for key, value in data.items()}, ttl, tags)
+
+
+def _write_payloads(payloads, ttl, tags):
+    pipe = REDIS_CONN.pipeline(transaction=False)
+    expiries = []
+    for key, payload in payloads.items():
+        expiry = ttl.get(key, DEFAULT_TTL) if isinstance(ttl, dict) else ttl
+        expiries.append(expiry)
+        pipe.set(key, payload, ex=expiry)
+    for tag in tags:
+        pipe.sadd(tag_key(tag), *payloads)
+        pipe.expire(tag_key(tag), max(expiries))
+    return all(pipe.execute())
+
+
+def invalidate(keys):
+    """Drop cached keys.
+
+    Parameters
+    ----------
+    keys : iterable of str
     """
-    # TODO: Refactor using REDIS_CONN.pipeline() to allow setting expire times
-    # https://redis-py.readthedocs.io/en/latest/index.html#redis.Redis.pipeline
-    json_data = {k: json.dumps(v) for k, v in data.items()}
-    return REDIS_CONN.mset(json_data)
+    keys = list(keys)
+    if not keys:
+        return 0
+    LOCAL_CACHE.delete(*keys)
+    STATS.incr('invalidations', len(keys))
+    pipe = REDIS_CONN.pipeline(transaction=False)
+    pipe.delete(*keys)
+    pipe.publish(INVALIDATION_CHANNEL, json.dumps(keys))
+    deleted, _ = pipe.execute()
+    return deleted
 
 
-def get_data_from_redis(keys):
-    """Fetch cached data from redis.
+def invalidate_tags(tags):
+    """Drop every cached key filed under any of `tags`.
 
     Parameters
     ----------
-    keys : list of str
+    tags : iterable of str
+    """
+    tag_keys = [tag_key(tag) for tag in tags]
+    if not tag_keys:
+        return 0
+    keys = [key.decode() for key in REDIS_CONN.sunion(tag_keys)]
+    REDIS_CONN.delete(*tag_keys)
+    return invalidate(keys)
+
+
+def stats():
+    """Return this process' cache counters, per tier.
 
     Returns
     -------
-    data: dict of {key : value}
+    counts : dict of {tier : dict of {name : int}}
     """
-    json_data = REDIS_CONN.mget(keys)
-    results = [None if data is None else json.loads(data) for data in json_data]
+    return {'local': LOCAL_CACHE.stats(), 'redis': STATS.snapshot()}
 
-    data = {
-        key: value
-        for (key, value) in zip(keys, results)
-        if value is not None
-    }
-    return data
+
+class InvalidationListener(threading.Thread):
+    """Evict local entries as soon as any process invalidates them."""
+
+    def __init__(self):
+        super().__init__(name='cache-invalidation-listener', daemon=True)
+
+    def run(self):
+        while True:
+            try:
+                pubsub = REDIS_CONN.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Messages sent while we were not listening are lost.
+                LOCAL_CACHE.clear()
+                while True:
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        LOCAL_CACHE.delete(*json.loads(message['data']))
+            except redis.RedisError as exc:
+                logger.warning('Cache invalidation listener disconnected: %s', exc)
+                time.sleep(1)
+
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_invalidation_listener():
+    # One listener per process, started lazily so forked workers get their own.
+    global _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            InvalidationListener().start()
+            _listener_pid = os.getpid()
+
+
+# Write-triggered invalidation. Keys are collected while the session flushes
+# and only dropped once the transaction commits, so a concurrent reader cannot
+# re-cache rows that are about to change. A rollback forgets them.
+
+def _pending_invalidations(session):
+    return session.info.setdefault('cache_invalidations', set())
+
+
+def _pending_tag_invalidations(session):
+    return session.info.setdefault('cache_tag_invalidations', set())
+
+
+@event.listens_for(Ticket, 'after_insert')
+@event.listens_for(Ticket, 'after_delete')
+def _invalidate_user_tickets(mapper, connection, ticket):
+    session = object_session(ticket)
+    if session is not None and ticket.booked_by_id is not None:
+        _pending_invalidations(session).add(USER_TICKETS.key(ticket.booked_by_id))
+
+
+@event.listens_for(Flight, 'after_insert')
+@event.listens_for(Flight, 'after_delete')
+def _invalidate_flight_searches(mapper, connection, flight):
+    session = object_session(flight)
+    if session is not None:
+        _pending_tag_invalidations(session).update(
+            route_tags(flight.origin_id, flight.destination_id))
+
+
+@event.listens_for(Ticket, 'after_insert')
+@event.listens_for(Ticket, 'after_delete')
+def _invalidate_flight_seats(mapper, connection, ticket):
+    # Searches list seat counts and tickets. Booking and cancelling change
+    # seats_sold with a bulk UPDATE, which fires no ORM events, but always
+    # along with a ticket. Only the searches listing its flight are dropped.
+    session = object_session(ticket)
+    if session is not None:
+        _pending_tag_invalidations(session).add(flight_tag(ticket.flight_id))
+
+
+@event.listens_for(Route, 'after_insert')
+@event.listens_for(Route, 'after_delete')
+def _invalidate_routes(mapper, connection, route):
+    session = object_session(route)
+    if session is not None:
+        _pending_tag_invalidations(session).add('routes')
+
+
+@event.listens_for(User, 'after_update')
+def _invalidate_changed_role(mapper, connection, user):
+    session = object_session(user)
+    if session is not None and inspect(user).attrs.is_admin.history.has_changes():
+        _pending_invalidations(session).add(USER_ROLES.key(user.id))
+
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user_role(mapper, connection, user):
+    session = object_session(user)
+    if session is not None:
+        _pending_invalidations(session).add(USER_ROLES.key(user.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _flush_invalidations(session):
+    keys = session.info.pop('cache_invalidations', None)
+    if keys:
+        BREAKER.call(invalidate, keys)
+    tags = session.info.pop('cache_tag_invalidations', None)
+    if tags:
+        BREAKER.call(invalidate_tags, tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_invalidations(session, previous_transaction):
+    # A savepoint rollback keeps them: the outer transaction may have queued
+    # some too, and dropping a key needlessly is harmless.
+    if previous_transaction.parent is None:
+        session.info.pop('cache_invalidations', None)
+        session.info.pop('cache_tag_invalidations', None)
@@ -0,0 +1,107 @@
+"""
+Swagger docs served from a cache.
+
+Building the spec introspects every view and marshmallow schema, which is
+slow and keeps the whole spec in memory for the life of the worker. So
+`CachedApiSpec`:
+
+* registers the views on the first request for the docs rather than at
+  boot, when `APISPEC_LAZY` is set;
+* serializes `swagger.json` once and serves the stored bytes with an ETag,
+  answering revalidations with a 304;
+* serves the file written by `flask build-docs` instead, when
+  `APISPEC_PREBUILT` names one, so the spec is never built by the API.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+import click
+import flask
+from flask.cli import with_appcontext
+from flask_apispec import FlaskApiSpec
+
+logger = logging.getLogger(__name__)
+
+
+class CachedApiSpec(FlaskApiSpec):
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pending = False
+        self._json = None
+        self._etag = None
+        super().__init__(app)
+
+    def init_app(self, app):
+        self._pending = False
+        self._json = None
+        self._etag = None
+        super().init_app(app)
+        app.extensions['apispec'] = self
+        app.cli.add_command(build_docs)
+
+    def register_existing_resources(self):
+        if self.app.config.get('APISPEC_LAZY'):
+            self._pending = True
+        else:
+            self._register_existing_resources()
+
+    def _register_existing_resources(self):
+        # Like the parent, but without queueing every view to be registered
+        # again on the next `init_app`.
+        for name, view in self.app.view_functions.items():
+            blueprint_name = name.split('.')[0] if '.' in name else None
+            try:
+                self._register(view, blueprint=blueprint_name)
+            except TypeError:
+                pass
+
+    def build(self):
+        """Serialize the spec, registering the views first if that was put off."""
+        if self._pending:
+            self._pending = False
+            self._register_existing_resources()
+        return flask.json.dumps(self.spec.to_dict(), sort_keys=True).encode()
+
+    def spec_json(self):
+        """The serialized spec and its ETag, built or loaded on first use."""
+        if self._json is None:
+            with self._lock:
+                if self._json is None:
+                    body = self._load_prebuilt() or self.build()
+                    self._etag = hashlib.sha1(body).hexdigest()
+                    self._json = body
+        return self._json, self._etag
+
+    def _load_prebuilt(self):
+        path = self.app.config.get('APISPEC_PREBUILT')
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as prebuilt:
+                return prebuilt.read()
+        except FileNotFoundError:
+            logger.warning('Prebuilt Swagger spec %s is missing, building it instead', path)
+            return None
+
+    def swagger_json(self):
+        body, etag = self.spec_json()
+        response = flask.current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(flask.request)
+
+
+@click.command('build-docs')
+@click.argument('path', type=click.Path(dir_okay=False))
+@with_appcontext
+def build_docs(path):
+    """Write the Swagger spec to PATH, to be served through APISPEC_PREBUILT."""
+    body = flask.current_app.extensions['apispec'].build()
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as tmp:
+        tmp.write(body)
+    os.replace(tmp.name, path)
+    click.echo(f'Wrote {len(body)} bytes to {path}')
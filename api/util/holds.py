@@ -0,0 +1,267 @@
+"""
+Time-limited seat holds.
+
+A hold reserves a seat in Redis while the client completes checkout. Holding
+and releasing never touch Postgres; only confirming a hold books the seat
+through `api.util.booking`. Bookings without a hold take their seat from the
+same Redis counter first, so a held seat is never sold to someone else.
+
+Redis keys
+----------
+flight_{flight_id}_available : int
+    Seats on the flight that are neither sold nor held. Seeded from Postgres
+    the first time the flight is held.
+hold_{hold_id} : str
+    The id of the user holding the seat. Expires with the hold.
+holds_by_expiry : sorted set
+    Every live hold id, scored by its expiry timestamp. Whoever removes a hold
+    from this set (confirm, release or the sweeper) owns its seat, so a seat
+    can never be returned twice.
+
+Hold ids are `{flight_id}-{uuid}`, which lets the sweeper find the flight of
+an expired hold without any extra bookkeeping.
+"""
+import re
+import time
+import uuid
+
+from api.models.db import db, Flight
+from api.util import booking
+from api.util.cache import BREAKER, REDIS_CONN
+
+DEFAULT_TTL = 600  # seconds
+
+HOLDS_BY_EXPIRY = 'holds_by_expiry'
+
+HOLD_ID_PATTERN = re.compile(r'^(\d+)-[0-9a-f]{32}$')
+
+# KEYS: availability, hold, holds_by_expiry
+# ARGV: ttl, expires_at, hold_id, user_id
+_hold = REDIS_CONN.register_script("""
+local available = redis.call('GET', KEYS[1])
+if not available then return -1 end
+if tonumber(available) <= 0 then return 0 end
+redis.call('DECR', KEYS[1])
+redis.call('SET', KEYS[2], ARGV[4], 'EX', ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[3])
+return 1
+""")
+
+# KEYS: availability
+_take = REDIS_CONN.register_script("""
+local available = redis.call('GET', KEYS[1])
+if not available then return -1 end
+if tonumber(available) <= 0 then return 0 end
+redis.call('DECR', KEYS[1])
+return 1
+""")
+
+# KEYS: availability, hold, holds_by_expiry
+# ARGV: hold_id, user_id, 'confirm' | 'release'
+_claim = REDIS_CONN.register_script("""
+local owner = redis.call('GET', KEYS[2])
+if owner and owner ~= ARGV[2] then return -1 end
+if redis.call('ZREM', KEYS[3], ARGV[1]) == 0 then return 0 end
+redis.call('DEL', KEYS[2])
+if not owner or ARGV[3] == 'release' then redis.call('INCR', KEYS[1]) end
+if not owner then return 0 end
+return 1
+""")
+
+# KEYS: holds_by_expiry
+# ARGV: now, batch_size
+_sweep = REDIS_CONN.register_script("""
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                           'LIMIT', 0, ARGV[2])
+for _, hold_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], hold_id)
+end
+return expired
+""")
+
+# KEYS: availability, hold
+_expire = REDIS_CONN.register_script("""
+redis.call('DEL', KEYS[2])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCR', KEYS[1])
+end
+""")
+
+# KEYS: availability
+# ARGV: delta
+_adjust = REDIS_CONN.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+""")
+
+
+class HoldNotFound(booking.BookingError):
+    """The hold does not exist or belongs to someone else."""
+
+
+class HoldExpired(booking.BookingError):
+    """The hold lapsed before it was confirmed or released."""
+
+
+def availability_key(flight_id):
+    return f'flight_{flight_id}_available'
+
+
+def hold_key(hold_id):
+    return f'hold_{hold_id}'
+
+
+def hold_seat(flight_id, user_id, ttl=DEFAULT_TTL):
+    """Reserve a seat on a flight for `ttl` seconds.
+
+    Parameters
+    ----------
+    flight_id : int
+    user_id : int
+    ttl : int
+
+    Returns
+    -------
+    hold_id : str
+
+    Raises
+    ------
+    FlightNotFound, SoldOut
+    """
+    hold_id = f'{flight_id}-{uuid.uuid4().hex}'
+    keys = [availability_key(flight_id), hold_key(hold_id), HOLDS_BY_EXPIRY]
+    args = [ttl, time.time() + ttl, hold_id, user_id]
+
+    held = _hold(keys=keys, args=args)
+    if held == -1:
+        _seed_availability(flight_id)
+        held = _hold(keys=keys, args=args)
+    if held != 1:
+        raise booking.SoldOut(f'Flight {flight_id} is sold out.')
+    return hold_id
+
+
+def book_directly(flight_id, user_id):
+    """Book a seat without holding it first.
+
+    The seat is taken from the availability counter before it is booked, as
+    if it were held and confirmed at once, and given back if booking fails.
+    While Redis is down, only Postgres' capacity check applies.
+
+    Returns
+    -------
+    ticket : Ticket
+
+    Raises
+    ------
+    FlightNotFound, SoldOut
+    """
+    taken = BREAKER.call(_take_seat, flight_id)
+    if taken is False:
+        raise booking.SoldOut(f'Flight {flight_id} is sold out.')
+    try:
+        return booking.book_seat(flight_id, user_id)
+    except booking.SoldOut:
+        if taken:
+            BREAKER.call(REDIS_CONN.set, availability_key(flight_id), 0)
+        raise
+    except Exception:
+        if taken:
+            BREAKER.call(seat_returned, flight_id)
+        raise
+
+
+def confirm_hold(hold_id, user_id):
+    """Turn a hold into a paid ticket.
+
+    Returns
+    -------
+    ticket : Ticket
+
+    Raises
+    ------
+    HoldNotFound, HoldExpired, FlightNotFound, SoldOut
+    """
+    flight_id = _claim_hold(hold_id, user_id, 'confirm')
+    try:
+        return booking.book_seat(flight_id, user_id)
+    except booking.SoldOut:
+        # Postgres disagrees with the Redis counter, e.g. after seats were
+        # sold while it was down. Stop handing out holds on this flight.
+        BREAKER.call(REDIS_CONN.set, availability_key(flight_id), 0)
+        raise
+    except Exception:
+        # The hold is already gone, so its seat goes back to the flight.
+        BREAKER.call(seat_returned, flight_id)
+        raise
+
+
+def release_hold(hold_id, user_id):
+    """Give a held seat back to the flight.
+
+    Raises
+    ------
+    HoldNotFound, HoldExpired
+    """
+    _claim_hold(hold_id, user_id, 'release')
+
+
+def release_expired(now=None, batch_size=500):
+    """Return the seats of up to `batch_size` lapsed holds.
+
+    Returns
+    -------
+    released : int
+    """
+    now = time.time() if now is None else now
+    expired = _sweep(keys=[HOLDS_BY_EXPIRY], args=[now, batch_size])
+    if not expired:
+        return 0
+
+    # The sweep took these holds off `holds_by_expiry`, so their seats are
+    # ours to return.
+    pipe = REDIS_CONN.pipeline(transaction=False)
+    for hold_id in expired:
+        hold_id = hold_id.decode()
+        flight_id = HOLD_ID_PATTERN.match(hold_id).group(1)
+        _expire(keys=[availability_key(flight_id), hold_key(hold_id)], client=pipe)
+    pipe.execute()
+    return len(expired)
+
+
+def seat_returned(flight_id):
+    """Account for a cancelled ticket."""
+    _adjust(keys=[availability_key(flight_id)], args=[1])
+
+
+def _take_seat(flight_id):
+    keys = [availability_key(flight_id)]
+    taken = _take(keys=keys)
+    if taken == -1:
+        _seed_availability(flight_id)
+        taken = _take(keys=keys)
+    return taken == 1
+
+
+def _claim_hold(hold_id, user_id, action):
+    match = HOLD_ID_PATTERN.match(hold_id)
+    if not match:
+        raise HoldNotFound(f'Hold {hold_id} does not exist.')
+    flight_id = int(match.group(1))
+
+    claimed = _claim(keys=[availability_key(flight_id), hold_key(hold_id), HOLDS_BY_EXPIRY],
+                     args=[hold_id, user_id, action])
+    if claimed == -1:
+        raise HoldNotFound(f'Hold {hold_id} does not exist.')
+    if claimed == 0:
+        raise HoldExpired(f'Hold {hold_id} has expired.')
+    return flight_id
+
+
+def _seed_availability(flight_id):
+    seats = db.session.query(Flight.capacity, Flight.seats_sold).filter_by(id=flight_id).first()
+    if seats is None:
+        raise booking.FlightNotFound(f'Flight {flight_id} does not exist.')
+    capacity, seats_sold = seats
+    REDIS_CONN.set(availability_key(flight_id), max(0, int(capacity) - seats_sold), nx=True)
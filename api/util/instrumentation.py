@@ -0,0 +1,123 @@
+"""
+Prometheus metrics for requests, SQL, Redis and the cache.
+
+Every request records its latency, how many SQL statements it ran and for
+how long, and how many Redis round trips it made, all by endpoint. Process
+wide counters cover SQL and Redis traffic outside requests too, as well as
+cache hits, misses and invalidations per tier (see `api.util.cache`). The
+cache hit ratio is then, for example::
+
+    sum(rate(flights_cache_events_total{event="hits"}[5m]))
+      / sum(rate(flights_cache_events_total{event=~"hits|misses"}[5m]))
+
+With `PROMETHEUS_MULTIPROC_DIR` set, every process writes its samples there
+and `/api/metrics` reports the sum over all gunicorn workers; the directory
+must be emptied before the workers start.
+"""
+import os
+import time
+
+import redis
+from flask import g, has_app_context, request
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest,
+                               multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, float('inf'))
+
+REQUEST_LATENCY = Histogram(
+    'flights_request_duration_seconds', 'Request latency', ['method', 'endpoint'])
+REQUESTS = Counter(
+    'flights_requests_total', 'Requests by response status', ['method', 'endpoint', 'status'])
+REQUEST_SQL_STATEMENTS = Histogram(
+    'flights_request_sql_statements', 'SQL statements per request', ['endpoint'],
+    buckets=COUNT_BUCKETS)
+REQUEST_SQL_TIME = Histogram(
+    'flights_request_sql_duration_seconds', 'Time spent in SQL per request', ['endpoint'])
+REQUEST_REDIS_ROUND_TRIPS = Histogram(
+    'flights_request_redis_round_trips', 'Redis round trips per request', ['endpoint'],
+    buckets=COUNT_BUCKETS)
+
+SQL_STATEMENTS = Counter('flights_sql_statements_total', 'SQL statements')
+SQL_TIME = Counter('flights_sql_duration_seconds_total', 'Time spent in SQL')
+REDIS_ROUND_TRIPS = Counter('flights_redis_round_trips_total', 'Redis round trips')
+CACHE_EVENTS = Counter('flights_cache_events_total', 'Cache events', ['tier', 'event'])
+TRACE_SPANS_DROPPED = Counter('flights_trace_spans_dropped_total',
+                              'Trace spans dropped by a full queue or a failing exporter')
+
+
+def _in_request():
+    return has_app_context() and 'sql_statements' in g
+
+
+class CountingConnection(redis.Connection):
+    """A Redis connection that counts its round trips.
+
+    A pipeline is sent in one go, so it counts once however many commands it
+    holds.
+    """
+
+    def send_packed_command(self, command):
+        REDIS_ROUND_TRIPS.inc()
+        if _in_request():
+            g.redis_round_trips += 1
+        return super().send_packed_command(command)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+    SQL_STATEMENTS.inc()
+    SQL_TIME.inc(elapsed)
+    if _in_request():
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    starts = context.connection.info.get('statement_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def init_app(app):
+    """Record metrics for every request to `app`."""
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0.0
+    g.redis_round_trips = 0
+
+
+def _end_request(response):
+    if 'request_start' not in g:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_LATENCY.labels(request.method, endpoint).observe(
+        time.perf_counter() - g.request_start)
+    REQUESTS.labels(request.method, endpoint, response.status_code).inc()
+    REQUEST_SQL_STATEMENTS.labels(endpoint).observe(g.sql_statements)
+    REQUEST_SQL_TIME.labels(endpoint).observe(g.sql_seconds)
+    REQUEST_REDIS_ROUND_TRIPS.labels(endpoint).observe(g.redis_round_trips)
+    return response
+
+
+def exposition():
+    """Every metric in Prometheus text format, summed over all workers."""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ or 'prometheus_multiproc_dir' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
@@ -0,0 +1,272 @@
+"""
+Multi-leg itinerary search.
+
+Each process keeps an in-memory, time-expanded view of upcoming flights: for
+every origin, its departing legs sorted by departure time. Searches run a
+bounded best-first (Dijkstra-style) search over it, expanding an airport only
+with legs that leave after the minimum connection time.
+
+The graph is built once and then refreshed incrementally: new flights are
+found by id above a high-water mark, at most every `REFRESH_INTERVAL` seconds
+or right after this process commits one. A full rebuild every
+`REBUILD_INTERVAL` seconds picks up edits, deletions and flights whose ids
+committed out of order, and drops legs that have already departed. It runs in
+a background thread while searches keep using the current graph.
+"""
+import heapq
+import itertools
+import threading
+import time
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import timedelta
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from api.models.db import db, Flight
+
+REFRESH_INTERVAL = 5  # seconds
+REBUILD_INTERVAL = 300  # seconds
+LOAD_BATCH_SIZE = 10000
+
+MAX_LEGS = 4
+MIN_CONNECTION = timedelta(minutes=60)
+MAX_CONNECTION = timedelta(hours=24)
+
+SORT_ORDERS = ('arrival', 'price')
+
+# `departs_at` and `arrives_at` are POSIX timestamps, to keep datetime
+# arithmetic out of the search loop.
+Leg = namedtuple('Leg', 'id origin_id destination_id departure arrival price '
+                        'departs_at arrives_at')
+Itinerary = namedtuple('Itinerary', 'legs departure arrival price')
+
+
+def make_leg(id, origin_id, destination_id, departure, arrival, price):
+    return Leg(id, origin_id, destination_id, departure, arrival, float(price),
+               departure.timestamp(), arrival.timestamp())
+
+
+class FlightGraph(object):
+    """Upcoming flights indexed by origin and departure time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            # origin_id or (origin_id, destination_id)
+            #   -> (sorted departure timestamps, legs in the same order)
+            self._departures = {}
+            self._high_water = 0
+            self._built_at = None
+            self._checked_at = None
+            self._rebuilder = None
+
+    def mark_stale(self):
+        """Look for new flights on the next search."""
+        self._checked_at = None
+
+    @property
+    def size(self):
+        return sum(len(legs) for key, (_, legs) in self._departures.items()
+                   if not isinstance(key, tuple))
+
+    def refresh(self, now=None):
+        """Load flights created since the last refresh, or rebuild if due."""
+        now = time.monotonic() if now is None else now
+        if self._checked_at is not None and now - self._checked_at < REFRESH_INTERVAL:
+            return
+        with self._lock:
+            # Another request may have refreshed while this one waited.
+            if self._checked_at is not None and now - self._checked_at < REFRESH_INTERVAL:
+                return
+            if self._built_at is None:
+                # Nothing to search yet, so the first build cannot wait.
+                self._built_at = now
+            elif now - self._built_at >= REBUILD_INTERVAL:
+                self._built_at = now
+                self._rebuilder = threading.Thread(
+                    target=self._rebuild, args=(current_app._get_current_object(), now),
+                    daemon=True)
+                self._rebuilder.start()
+            legs = _load_legs(after_id=self._high_water)
+            self._departures = _merge(self._departures, legs)
+            self._high_water = max([self._high_water] + [leg.id for leg in legs])
+            self._checked_at = now
+
+    def _rebuild(self, app, started_at):
+        with app.app_context():
+            try:
+                legs = _load_legs()
+            finally:
+                db.session.remove()
+        departures = _merge({}, legs)
+        with self._lock:
+            # Cleared, or rebuilt again, while this one was loading.
+            if self._built_at != started_at:
+                return
+            self._departures = departures
+            self._high_water = max([0] + [leg.id for leg in legs])
+            # Flights loaded in the meantime are above the new high-water mark.
+            self._checked_at = None
+
+    def add(self, legs):
+        """Add legs directly, bypassing the database."""
+        with self._lock:
+            self._departures = _merge(self._departures, list(legs))
+
+    def search(self, origin_id, destination_id, earliest, latest, max_legs=2,
+               min_connection=MIN_CONNECTION, sort='arrival', limit=5):
+        """Find up to `limit` itineraries, best first.
+
+        Parameters
+        ----------
+        origin_id, destination_id : int
+        earliest, latest : datetime
+            Bounds on the departure of the first leg.
+        max_legs : int
+        min_connection : timedelta
+            Time to allow between landing and the next departure.
+        sort : str
+            'arrival' for the earliest arrival, or 'price' for the cheapest.
+        limit : int
+
+        Returns
+        -------
+        itineraries : list of Itinerary
+        """
+        departures = self._departures
+        connection = min_connection.total_seconds()
+        layover = MAX_CONNECTION.total_seconds()
+        counter = itertools.count()
+        queue = []
+
+        def push(path, price):
+            arrival = path[-1].arrives_at
+            priority = (arrival, price) if sort == 'arrival' else (price, arrival)
+            heapq.heappush(queue, (priority, next(counter), price, path))
+
+        key = origin_id if max_legs > 1 else (origin_id, destination_id)
+        for leg in _legs_between(departures, key, earliest.timestamp(), latest.timestamp()):
+            push((leg, ), leg.price)
+
+        # Label-setting bound: a partial itinerary that `limit` others can stand
+        # in for at the same airport cannot contribute to the best `limit`
+        # results, whatever the sort order.
+        settled = {}
+        itineraries = []
+        while queue and len(itineraries) < limit:
+            _, _, price, path = heapq.heappop(queue)
+            last = path[-1]
+            if last.destination_id == destination_id:
+                itineraries.append(Itinerary(legs=list(path),
+                                             departure=path[0].departure,
+                                             arrival=last.arrival,
+                                             price=round(price, 2)))
+                continue
+            if len(path) >= max_legs:
+                continue
+
+            visited = frozenset({origin_id}.union(leg.destination_id for leg in path))
+            # The last leg has to land at the destination, so only look at those.
+            if len(path) + 1 == max_legs:
+                key = (last.destination_id, destination_id)
+            else:
+                key = last.destination_id
+            ready = last.arrives_at + connection
+            times = departures.get(key, ((), ()))[0]
+            if not _any_between(times, ready, ready + layover):
+                continue
+            label = (ready, price, len(path), visited)
+            labels = settled.setdefault(last.destination_id, [])
+            if _dominated(label, labels, limit, times, layover):
+                continue
+            labels.append(label)
+
+            for leg in _legs_between(departures, key, ready, ready + layover):
+                if leg.destination_id not in visited:
+                    push(path + (leg, ), price + leg.price)
+        return itineraries
+
+
+def _dominated(label, labels, limit, times, layover):
+    """Whether `limit` of `labels` can go wherever `label` can, no later or dearer.
+
+    Another label stands in for this one when it is ready to connect no later,
+    has cost no more, used no more legs and visited no airport this one has
+    not, and when none of the departures in `times` this one can make leave
+    after the other's longest layover.
+    """
+    ready, price, legs, visited = label
+    better = 0
+    for other_ready, other_price, other_legs, other_visited in labels:
+        if other_ready > ready or other_price > price or other_legs > legs:
+            continue
+        if other_visited <= visited and not _any_between(times, other_ready + layover,
+                                                         ready + layover):
+            better += 1
+            if better >= limit:
+                return True
+    return False
+
+
+def _any_between(times, start, end):
+    i = bisect_left(times, start)
+    return i < len(times) and times[i] < end
+
+
+def _legs_between(departures, key, start, end):
+    times, legs = departures.get(key, ((), ()))
+    for i in range(bisect_left(times, start), len(times)):
+        if times[i] >= end:
+            break
+        yield legs[i]
+
+
+def _merge(departures, new_legs):
+    """Copy-on-write merge, so that running searches keep a consistent view."""
+    departures = dict(departures)
+    by_key = {}
+    for leg in new_legs:
+        by_key.setdefault(leg.origin_id, []).append(leg)
+        by_key.setdefault((leg.origin_id, leg.destination_id), []).append(leg)
+    for key, legs in by_key.items():
+        _, existing = departures.get(key, ((), ()))
+        merged = sorted(list(existing) + legs, key=lambda leg: (leg.departs_at, leg.id))
+        departures[key] = ([leg.departs_at for leg in merged], merged)
+    return departures
+
+
+def _load_legs(after_id=0):
+    rows = db.session.query(
+        Flight.id, Flight.origin_id, Flight.destination_id, Flight.departure,
+        Flight.arrival, Flight.price,
+    ).filter_by(is_deleted=False).filter(Flight.id > after_id,
+                                         Flight.departure >= db.func.now())
+    return [make_leg(*row) for row in rows.yield_per(LOAD_BATCH_SIZE)]
+
+
+GRAPH = FlightGraph()
+
+
+def search(origin_id, destination_id, earliest, latest, **options):
+    """Search the process-wide graph, refreshing it first if due."""
+    GRAPH.refresh()
+    return GRAPH.search(origin_id, destination_id, earliest, latest, **options)
+
+
+@event.listens_for(Flight, 'after_insert')
+def _flight_created(mapper, connection, flight):
+    session = object_session(flight)
+    if session is not None:
+        session.info['flight_graph_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _refresh_after_commit(session):
+    if session.info.pop('flight_graph_stale', False):
+        GRAPH.mark_stale()
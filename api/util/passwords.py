@@ -0,0 +1,102 @@
+"""
+Password hashing off the request thread.
+
+bcrypt is slow on purpose, so every hash and check runs on a small, bounded
+thread pool. bcrypt releases the GIL while it works, which lets a threaded
+worker keep serving other requests during a login burst. When more hashes are
+queued than `PASSWORD_HASHING_MAX_PENDING`, new ones fail fast with
+`HashingBusy` instead of piling up behind the pool.
+
+The work factor is `BCRYPT_LOG_ROUNDS` from the app config, which defaults to
+the environment variable of the same name. Hashes made with another cost are
+upgraded the next time their owner logs in (see `needs_rehash`).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+
+
+class HashingBusy(Exception):
+    """Too many passwords are already waiting to be hashed."""
+
+
+class HashingPool(object):
+    """A thread pool that refuses work beyond `max_pending` queued jobs."""
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, func, *args):
+        """Run `func(*args)` on the pool and wait for its result.
+
+        Raises
+        ------
+        HashingBusy
+            If `max_pending` jobs are already running or queued.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy('Too many logins in progress. Please try again.')
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+POOL = HashingPool(
+    workers=int(os.getenv('PASSWORD_HASHING_WORKERS', os.cpu_count() or 1)),
+    max_pending=int(os.getenv('PASSWORD_HASHING_MAX_PENDING', 32)))
+
+
+def log_rounds():
+    if has_app_context():
+        return current_app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS)
+    return DEFAULT_LOG_ROUNDS
+
+
+def hash_password(password, rounds=None):
+    """Hash a password with the configured work factor.
+
+    Parameters
+    ----------
+    password : str
+    rounds : int, optional
+        Defaults to `log_rounds()`.
+
+    Returns
+    -------
+    hashed : str
+    """
+    salt = bcrypt.gensalt(rounds or log_rounds())
+    return POOL.run(bcrypt.hashpw, password.encode(), salt).decode()
+
+
+def check_password(hashed, password):
+    """Whether `password` matches `hashed`.
+
+    Returns
+    -------
+    matches : bool
+    """
+    return POOL.run(bcrypt.checkpw, password.encode(), hashed.encode())
+
+
+def needs_rehash(hashed, rounds=None):
+    """Whether `hashed` was made with a different work factor.
+
+    bcrypt hashes look like `$2b$12$...`, where 12 is the cost.
+    """
+    try:
+        cost = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return cost != (rounds or log_rounds())
@@ -0,0 +1,130 @@
+"""
+On-demand request profiling.
+
+A request is profiled when an admin sends the `X-Profile` header
+(`PROFILE_HEADER`), or when it is picked at random at `PROFILE_SAMPLE_RATE`.
+While it runs, a sampler thread records the request thread's stack every
+`PROFILE_INTERVAL_MS`. The stacks are written to `PROFILE_DIR` in collapsed
+format, one `caller;callee count` line per distinct stack, ready for
+`flamegraph.pl` or speedscope::
+
+    > curl -H "Authorization: $TOKEN" -H "X-Profile: 1" -i localhost:8000/api/flights
+    X-Profile-Id: 3f2a...
+    > flamegraph.pl $PROFILE_DIR/3f2a....folded > flights.svg
+
+The sampler only gets the GIL between bytecodes, every `sys.getswitchinterval()`
+at worst, so profile requests that take tens of milliseconds or more. Requests
+that are not profiled only pay for a header lookup.
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import uuid
+from collections import Counter
+
+from flask import current_app, g, request
+
+from api.endpoints.util.auth import is_admin
+from api.models.db import User
+
+DEFAULT_HEADER = 'X-Profile'
+DEFAULT_INTERVAL_MS = 1
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'flights-profiles')
+
+ID_HEADER = 'X-Profile-Id'
+
+
+class Sampler(object):
+    """Count the stacks a thread is seen in, from another thread."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def write(self, path):
+        with open(path, 'w') as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f'{stack} {count}\n')
+
+
+def collapse(frame):
+    """The stack ending in `frame`, outermost call first, joined by `;`."""
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', code.co_filename)
+        calls.append(f'{code.co_name} ({module}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(calls))
+
+
+def init_app(app):
+    """Profile `app`'s requests on demand.
+
+    Call it before any other request hooks are added so profiles cover them.
+    """
+    app.before_request(_start)
+    app.after_request(_finish)
+    app.teardown_request(_stop)
+
+
+def _requested_by_admin():
+    access_token = request.headers.get('Authorization')
+    if not access_token:
+        return False
+    user_id = User.decode_token(access_token)
+    return not isinstance(user_id, str) and bool(is_admin(user_id))
+
+
+def _start():
+    config = current_app.config
+    if config.get('PROFILE_HEADER', DEFAULT_HEADER) in request.headers:
+        if not _requested_by_admin():
+            return
+    else:
+        sample_rate = config.get('PROFILE_SAMPLE_RATE', 0)
+        if not sample_rate or random.random() >= sample_rate:
+            return
+
+    interval = config.get('PROFILE_INTERVAL_MS', DEFAULT_INTERVAL_MS) / 1000
+    g.profile_sampler = Sampler(threading.get_ident(), interval)
+    g.profile_sampler.start()
+
+
+def _finish(response):
+    sampler = g.pop('profile_sampler', None)
+    if sampler is None:
+        return response
+    sampler.stop()
+
+    profile_dir = current_app.config.get('PROFILE_DIR') or DEFAULT_DIR
+    os.makedirs(profile_dir, exist_ok=True)
+    profile_id = uuid.uuid4().hex
+    sampler.write(os.path.join(profile_dir, f'{profile_id}.folded'))
+    response.headers[ID_HEADER] = profile_id
+    return response
+
+
+def _stop(exc):
+    # Requests that never reach `_finish` still have their sampler stopped.
+    sampler = g.pop('profile_sampler', None)
+    if sampler is not None:
+        sampler.stop()
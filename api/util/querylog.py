@@ -0,0 +1,111 @@
+"""
+Slow query log, N+1 detection and per-endpoint query budgets.
+
+* Statements slower than `SLOW_QUERY_MS` are logged with the endpoint that
+  ran them.
+* Within a request, statements are grouped by shape: their SQL with every
+  bound parameter, and the length of every IN list, blanked out. A shape
+  repeated `N_PLUS_ONE_THRESHOLD` times, the signature of loading a
+  relationship per row, is logged once per request.
+* Views declare how many statements they may run with `@query_budget(n)`.
+  Going over budget is logged, or with `QUERY_BUDGET_STRICT` (as in the
+  tests) raises `QueryBudgetExceeded`, so a regression fails the build
+  instead of reaching production.
+"""
+import logging
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SLOW_QUERY_MS = 200
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+logger = logging.getLogger('flights.sql')
+
+_PARAMETER = re.compile(r'%\(\w+\)s|%s|\?')
+_PARAMETER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+
+
+class QueryBudgetExceeded(Exception):
+    """An endpoint ran more SQL statements than its `query_budget`."""
+
+
+def query_budget(statements):
+    """Declare the most SQL statements a view may run per request.
+
+    Place it directly under the route decorator.
+    """
+    def decorator(view):
+        view.query_budget = statements
+        return view
+    return decorator
+
+
+def shape(statement):
+    """The statement with its parameters blanked out."""
+    return _PARAMETER_LIST.sub('?, ...', _PARAMETER.sub('?', statement))
+
+
+def init_app(app):
+    """Check every request to `app` for N+1 queries and its query budget."""
+    app.before_request(_start_request)
+    # Streamed bodies run their statements after `after_request`; the request
+    # is only torn down once they are done.
+    app.teardown_request(_end_request)
+
+
+def _start_request():
+    g.query_shapes = Counter()
+
+
+def _in_request():
+    return has_request_context() and 'query_shapes' in g
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('querylog_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info['querylog_start'].pop()) * 1000
+    in_request = _in_request()
+    endpoint = request.endpoint if in_request else None
+    config = current_app.config if has_app_context() else {}
+
+    if elapsed_ms >= config.get('SLOW_QUERY_MS', DEFAULT_SLOW_QUERY_MS):
+        logger.warning('Slow query in %s (%.1f ms): %s', endpoint, elapsed_ms, statement)
+
+    if in_request:
+        statement_shape = shape(statement)
+        g.query_shapes[statement_shape] += 1
+        threshold = config.get('N_PLUS_ONE_THRESHOLD', DEFAULT_N_PLUS_ONE_THRESHOLD)
+        if g.query_shapes[statement_shape] == threshold:
+            logger.warning('Possible N+1 in %s, %d identical queries: %s',
+                           endpoint, threshold, statement_shape)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    starts = context.connection.info.get('querylog_start') if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def _end_request(exc):
+    if 'query_shapes' not in g or exc is not None:
+        return
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    statements = sum(g.query_shapes.values())
+    if budget is not None and statements > budget:
+        message = (f'{request.endpoint} ran {statements} SQL statements, over its budget of '
+                   f'{budget}: {dict(g.query_shapes.most_common(3))}')
+        if current_app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
@@ -0,0 +1,322 @@
+"""
+Departure reminders.
+
+Every ticket on a flight leaving in the reminder window is read in a single
+joined query, streamed from a server-side cursor, so neither the flights nor
+their tickets, users and destinations are ever loaded one by one. Messages
+go out over a small pool of SMTP connections; each connection stays open for
+`MAIL_MAX_EMAILS` messages before Flask-Mail reconnects it.
+
+A run is split into chunks of consecutive ticket ids (`chunk_bounds`), which
+the notifier sends as independent Celery tasks, so more workers finish a run
+sooner and a failed chunk is retried on its own.
+
+Runs are rolling: every few minutes the notifier claims the departures that
+entered its look-ahead window since the last scan (`claim_departures`), cuts
+them into short slices and enqueues each slice's chunks to run a fixed lead
+time before those flights leave. Reminder traffic is therefore spread over
+the day instead of landing at midnight.
+
+Redis keys
+----------
+reminder_sent_{ticket_id} : str
+    Set once the reminder for a ticket was handed to the SMTP server. Retried
+    and overlapping runs skip these tickets, so nobody is reminded twice.
+reminders_scheduled_until : int
+    Unix time of the latest departure whose reminders have been enqueued.
+"""
+import contextvars
+import datetime
+import queue
+import threading
+import time
+from itertools import islice
+
+from flask import current_app
+from flask_mail import Message
+from sqlalchemy import func
+
+from api.models.db import db, Flight, Route, Ticket, User
+from api.util import tracing
+from api.util.cache import REDIS_CONN
+
+FETCH_SIZE = 1000  # rows per round trip on the server-side cursor
+
+DEFAULT_CONNECTIONS = 4
+
+DEFAULT_CHUNK_SIZE = 5000  # tickets per chunk task
+
+# Sent markers outlive the reminder window, after which the flight has left.
+SENT_TTL = 3 * 24 * 60 * 60  # seconds
+
+# Sent markers are checked this many at a time, in one pipeline.
+MARKER_BATCH = 500
+
+# Delivered messages are marked sent in small batches, at least every
+# interval, so a crashed worker re-sends at most a few per connection.
+SENT_BATCH = 20
+SENT_INTERVAL = 1.0  # seconds
+
+# Messages waiting for a connection; bounds memory when SMTP is the bottleneck.
+QUEUE_SIZE = 1000
+
+SCHEDULED_UNTIL = 'reminders_scheduled_until'
+
+_DONE = object()
+
+# KEYS: scheduled_until
+# ARGV: earliest start, end
+_advance = REDIS_CONN.register_script("""
+local start = math.max(tonumber(redis.call('GET', KEYS[1]) or ARGV[1]), tonumber(ARGV[1]))
+if start >= tonumber(ARGV[2]) then return nil end
+redis.call('SET', KEYS[1], ARGV[2])
+return start
+""")
+
+
+class RateLimiter(object):
+    """Token bucket shared by every sender thread of a worker process.
+
+    Allows `rate` messages per second on average, with bursts of up to one
+    second's worth. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now and wait for it outside the lock, so callers
+            # queue up behind each other instead of all waking at once.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_rate_limiter(app=None):
+    """The per-process limiter for `MAIL_RATE_LIMIT` messages per second."""
+    app = app or current_app
+    limiter = app.extensions.get('mail_rate_limiter')
+    if limiter is None:
+        limiter = app.extensions['mail_rate_limiter'] = RateLimiter(
+            app.config.get('MAIL_RATE_LIMIT', 0))
+    return limiter
+
+
+def sent_key(ticket_id):
+    return f'reminder_sent_{ticket_id}'
+
+
+def _due_tickets(from_date, to_date):
+    return Ticket.query.join(Flight, Ticket.flight_id == Flight.id).filter(
+        ~Flight.is_deleted, ~Ticket.is_deleted,
+        Flight.departure >= from_date, Flight.departure < to_date)
+
+
+def chunk_bounds(from_date, to_date, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split the tickets due for a reminder into runs of consecutive ids.
+
+    Returns
+    -------
+    bounds : list of (int, int)
+        The first and last ticket id of each chunk, inclusive, in id order.
+        Every chunk but the last holds exactly `chunk_size` tickets.
+    """
+    numbered = _due_tickets(from_date, to_date).with_entities(
+        Ticket.id.label('id'),
+        ((func.row_number().over(order_by=Ticket.id) - 1) / chunk_size).label('chunk')
+    ).subquery()
+    return db.session.query(func.min(numbered.c.id), func.max(numbered.c.id)).group_by(
+        numbered.c.chunk).order_by(numbered.c.chunk).all()
+
+
+def due_reminders(from_date, to_date, first_id=None, last_id=None, fetch_size=FETCH_SIZE):
+    """Stream `(ticket_id, email, city, departure)` for every ticket due a reminder.
+
+    `first_id` and `last_id` restrict the tickets to one chunk, inclusive.
+    """
+    query = _due_tickets(from_date, to_date)
+    if first_id is not None:
+        query = query.filter(Ticket.id >= first_id)
+    if last_id is not None:
+        query = query.filter(Ticket.id <= last_id)
+    return query.join(Route, Flight.destination_id == Route.id).join(
+        User, Ticket.booked_by_id == User.id).with_entities(
+        Ticket.id, User.email, Route.city, Flight.departure).order_by(
+        Ticket.id).yield_per(fetch_size)
+
+
+def unsent(rows, batch_size=MARKER_BATCH):
+    """Drop the rows whose ticket already has a sent marker."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        pipe = REDIS_CONN.pipeline(transaction=False)
+        for row in batch:
+            pipe.exists(sent_key(row[0]))
+        for row, sent in zip(batch, pipe.execute()):
+            if not sent:
+                yield row
+
+
+def mark_sent(ticket_ids):
+    pipe = REDIS_CONN.pipeline(transaction=False)
+    for ticket_id in ticket_ids:
+        pipe.set(sent_key(ticket_id), 1, ex=SENT_TTL)
+    pipe.execute()
+
+
+def claim_departures(now, lead, lookahead):
+    """Claim the departures that have not been scheduled yet.
+
+    Moves the high-water mark to `now + lead + lookahead`. Concurrent callers
+    never claim the same departures.
+
+    Parameters
+    ----------
+    now : datetime.datetime
+        Timezone-aware.
+    lead : datetime.timedelta
+        How long before departure reminders are sent. Claims never start
+        before `now + lead`: earlier flights are too close to be reminded,
+        even when scans stopped for a while and the mark fell behind.
+    lookahead : datetime.timedelta
+        How far past `now + lead` to schedule.
+
+    Returns
+    -------
+    window : (datetime.datetime, datetime.datetime) or None
+        The claimed departures, in UTC, or None if they were all scheduled.
+    """
+    first = int((now + lead).timestamp())
+    end = int((now + lead + lookahead).timestamp())
+    start = _advance(keys=[SCHEDULED_UNTIL], args=[first, end])
+    if start is None:
+        return None
+    return (datetime.datetime.fromtimestamp(start, datetime.timezone.utc),
+            datetime.datetime.fromtimestamp(end, datetime.timezone.utc))
+
+
+def slices(start, end, step):
+    """Cut `[start, end)` into consecutive windows of at most `step`."""
+    while start < end:
+        yield start, min(start + step, end)
+        start += step
+
+
+def reminder_message(email, city, departure, sender):
+    date = departure.strftime('%d %b, %Y')
+    time = departure.strftime('%I.%M %p')
+    return Message(subject='Hello',
+                   sender=sender,
+                   recipients=[email],
+                   body=f'Hi! Your flight to {city} on {date} at {time} is almost here!')
+
+
+def send_all(mail, messages, connections=None, on_sent=None):
+    """Send messages over a pool of reused SMTP connections.
+
+    Parameters
+    ----------
+    mail : flask_mail.Mail
+    messages : iterable of (object, flask_mail.Message)
+        Tagged messages. Consumed lazily, so it may be a generator over a
+        database cursor.
+    connections : int, optional
+        Concurrent SMTP connections; defaults to `MAIL_CONNECTIONS`.
+    on_sent : callable, optional
+        Called with lists of the tags of delivered messages, at most
+        `SENT_BATCH` at a time and at least every `SENT_INTERVAL` seconds,
+        even when sending fails part way.
+
+    Returns
+    -------
+    sent : int
+        How many messages were handed to the SMTP server.
+    """
+    app = current_app._get_current_object()
+    if connections is None:
+        connections = app.config.get('MAIL_CONNECTIONS', DEFAULT_CONNECTIONS)
+    limiter = get_rate_limiter(app)
+
+    pending = queue.Queue(maxsize=QUEUE_SIZE)
+    sent = [0] * connections
+    errors = []
+
+    def sender(slot):
+        delivered = []
+        reported_at = time.monotonic()
+        try:
+            with app.app_context(), mail.connect() as connection:
+                while True:
+                    item = pending.get()
+                    if item is _DONE:
+                        return
+                    tag, message = item
+                    limiter.acquire()
+                    with tracing.span('mail.send', tracing.CLIENT,
+                                      **{'mail.recipients': len(message.send_to)}):
+                        connection.send(message)
+                    sent[slot] += 1
+                    delivered.append(tag)
+                    due = time.monotonic() - reported_at >= SENT_INTERVAL
+                    if on_sent and (len(delivered) >= SENT_BATCH or due):
+                        on_sent(delivered)
+                        delivered = []
+                        reported_at = time.monotonic()
+        except Exception as err:
+            errors.append(err)
+            # Keep draining, so the producer is never blocked on a full queue.
+            while pending.get() is not _DONE:
+                pass
+        finally:
+            if on_sent and delivered:
+                try:
+                    on_sent(delivered)
+                except Exception as err:
+                    errors.append(err)
+
+    # Each sender runs in a copy of this context, so its spans join the trace.
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(sender, slot),
+                                daemon=True)
+               for slot in range(connections)]
+    for thread in threads:
+        thread.start()
+    try:
+        for item in messages:
+            if errors:
+                break
+            pending.put(item)
+    finally:
+        for _ in threads:
+            pending.put(_DONE)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return sum(sent)
+
+
+def send_reminders(mail, from_date, to_date, first_id=None, last_id=None):
+    """Mail every passenger on a flight departing between the two dates.
+
+    Tickets with a sent marker are skipped, so this is safe to retry.
+    """
+    sender = current_app.config.get('MAIL_USERNAME')
+    rows = unsent(due_reminders(from_date, to_date, first_id, last_id))
+    return send_all(mail, ((ticket_id, reminder_message(email, city, departure, sender))
+                           for ticket_id, email, city, departure in rows),
+                    on_sent=mark_sent)
@@ -0,0 +1,140 @@
+"""
+Structured request logging, off the request thread.
+
+Requests are sampled as they come in. A sampled request is summarized as a
+dict after the response is built and put on a bounded in-memory queue; a
+`QueueListener` thread turns the summaries into JSON lines and writes them
+out. When the queue is full, summaries are dropped and counted rather than
+waited for, so a slow log sink never slows down requests.
+
+Bodies are only logged for JSON requests no bigger than the body cap, with
+the values of sensitive fields (`REQUEST_LOG_REDACT`) replaced. Errors are
+always logged, whatever the sample rate.
+
+Sample rates and body caps can be set per endpoint, e.g.::
+
+    REQUEST_LOG_ENDPOINTS = {
+        'healthz.get': {'sample_rate': 0},
+        'users.upload': {'max_body': 0},
+    }
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import current_app, g, request
+
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_MAX_BODY = 2048  # bytes
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_REDACT = ('password', 'token', 'access_token', 'authorization')
+
+REDACTED = '[redacted]'
+
+logger = logging.getLogger('flights.requests')
+logger.propagate = False
+
+_handler = None
+
+
+class DroppingQueueHandler(QueueHandler):
+    """A `QueueHandler` that drops records when its queue is full."""
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting happens in the listener thread, not on the request thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Format dict messages as one JSON object per line."""
+
+    def format(self, record):
+        entry = record.msg if isinstance(record.msg, dict) else {'message': record.getMessage()}
+        entry = dict(entry, time=datetime.utcfromtimestamp(record.created).isoformat() + 'Z')
+        return json.dumps(entry, default=str)
+
+
+def init_app(app):
+    """Log a sample of `app`'s requests.
+
+    The queue and its listener thread are shared by every app in the process.
+    """
+    global _handler
+    if _handler is None:
+        path = app.config.get('REQUEST_LOG_FILE')
+        sink = logging.FileHandler(path) if path else logging.StreamHandler()
+        sink.setFormatter(JsonFormatter())
+        _handler = DroppingQueueHandler(
+            queue.Queue(app.config.get('REQUEST_LOG_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)))
+        listener = QueueListener(_handler.queue, sink)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(_handler)
+        logger.setLevel(logging.INFO)
+
+    app.before_request(_start)
+    app.after_request(_log)
+
+
+def dropped():
+    """How many request logs were dropped because the queue was full."""
+    return _handler.dropped if _handler else 0
+
+
+def _endpoint_config(key, default):
+    config = current_app.config
+    overrides = config.get('REQUEST_LOG_ENDPOINTS', {}).get(request.endpoint, {})
+    return overrides.get(key, config.get(f'REQUEST_LOG_{key.upper()}', default))
+
+
+def _start():
+    sample_rate = _endpoint_config('sample_rate', DEFAULT_SAMPLE_RATE)
+    g.request_log_sampled = random.random() < sample_rate
+    g.request_log_start = time.perf_counter()
+
+
+def _log(response):
+    start = g.get('request_log_start')
+    if start is None or not (g.request_log_sampled or response.status_code >= 500):
+        return response
+
+    entry = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+        'user_id': getattr(request, 'user_id', None),
+    }
+    if request.content_length:
+        entry['body_size'] = request.content_length
+        if request.is_json and request.content_length <= _endpoint_config('max_body',
+                                                                          DEFAULT_MAX_BODY):
+            redact = frozenset(current_app.config.get('REQUEST_LOG_REDACT', DEFAULT_REDACT))
+            entry['body'] = _redact(request.get_json(silent=True), redact)
+    logger.info(entry)
+    return response
+
+
+def _redact(value, fields):
+    if isinstance(value, dict):
+        return {key: REDACTED if key.lower() in fields else _redact(item, fields)
+                for key, item in value.items()}
+    if isinstance(value, list):
+        return [_redact(item, fields) for item in value]
+    return value
@@ -0,0 +1,139 @@
+"""
+Content-addressed file storage for user uploads.
+
+Files are stored under the SHA-256 of their content, so identical uploads are
+kept once. The backend is picked with `PHOTO_STORAGE_BACKEND`, a dotted path
+to a `Storage` subclass, and defaults to `LocalStorage`.
+
+Backends that keep files on the local disk expose their `path`, which lets
+downloads go out through `sendfile`. When `PHOTO_ACCEL_REDIRECT_PREFIX` is
+set, downloads are instead handed over to the reverse proxy with an
+`X-Accel-Redirect` header.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from flask import current_app
+from werkzeug.utils import import_string
+
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_BACKEND = 'api.util.storage.LocalStorage'
+DEFAULT_DIR = os.getenv('PHOTO_STORAGE_DIR', 'media')
+
+
+class Storage(object):
+    """Interface for content-addressed storage backends."""
+
+    @classmethod
+    def from_config(cls, config):
+        raise NotImplementedError
+
+    def save(self, fileobj):
+        """Store the content of a readable binary file object.
+
+        Returns
+        -------
+        sha256 : str
+        size : int
+        """
+        raise NotImplementedError
+
+    def open(self, sha256):
+        """Open stored content for binary reading."""
+        raise NotImplementedError
+
+    def path(self, sha256):
+        """Local filesystem path of the content, if the backend has one."""
+        return None
+
+    def accel_redirect(self, sha256):
+        """Internal URI for the reverse proxy to serve, if configured."""
+        return None
+
+    def exists(self, sha256):
+        raise NotImplementedError
+
+    def delete(self, sha256):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """Files on a local directory, fanned out as `ab/cd/abcd...`."""
+
+    def __init__(self, root, accel_prefix=None):
+        self.root = os.path.abspath(root)
+        self.accel_prefix = accel_prefix
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('PHOTO_STORAGE_DIR', DEFAULT_DIR),
+                   accel_prefix=config.get('PHOTO_ACCEL_REDIRECT_PREFIX'))
+
+    def save(self, fileobj):
+        """Hash while copying to a temporary file, then move it into place.
+
+        Renames are atomic, so readers never see a partial file and concurrent
+        uploads of the same content are harmless.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+            try:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            except Exception:
+                os.unlink(tmp.name)
+                raise
+
+        sha256 = digest.hexdigest()
+        path = self.path(sha256)
+        if os.path.exists(path):
+            os.unlink(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+        return sha256, size
+
+    def open(self, sha256):
+        return open(self.path(sha256), 'rb')
+
+    def path(self, sha256):
+        return os.path.join(self.root, self._relative_path(sha256))
+
+    def accel_redirect(self, sha256):
+        if self.accel_prefix:
+            return f'{self.accel_prefix.rstrip("/")}/{self._relative_path(sha256)}'
+        return None
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def delete(self, sha256):
+        try:
+            os.unlink(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    @staticmethod
+    def _relative_path(sha256):
+        return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def get_storage(app=None):
+    """The storage backend configured for `app`, or the current app."""
+    app = app or current_app
+    storage = app.extensions.get('photo_storage')
+    if storage is None:
+        backend = import_string(app.config.get('PHOTO_STORAGE_BACKEND', DEFAULT_BACKEND))
+        storage = app.extensions['photo_storage'] = backend.from_config(app.config)
+    return storage
@@ -0,0 +1,29 @@
+"""
+Enqueue work for the notifier's Celery workers.
+
+Tasks are sent by name, so the API never imports the worker module and its
+app. Names follow the worker's module, `notifier/notify.py`.
+"""
+import logging
+import os
+
+from celery import Celery
+from kombu.exceptions import OperationalError
+
+BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
+
+celery = Celery('flights', broker=BROKER_URL)
+
+logger = logging.getLogger(__name__)
+
+
+def generate_photo_variants(photo_id):
+    """Ask the workers to render the resized variants of a photo.
+
+    A broker outage must not fail the upload; the variants are then simply
+    missing and downloads fall back to the original.
+    """
+    try:
+        celery.send_task('notify.generate_photo_variants', args=[photo_id])
+    except OperationalError:
+        logger.warning('Could not enqueue variants for photo %s', photo_id, exc_info=True)
@@ -0,0 +1,66 @@
+"""
+Resized variants of uploaded photos.
+
+Rendering runs in the notifier's Celery workers (see `api.util.tasks`), never
+on the request thread. Variants keep the format of the original and are
+stored alongside it in `api.util.storage`.
+"""
+from io import BytesIO
+
+from PIL import Image
+
+from api.models.db import db, Photo, PhotoVariant
+from api.util.storage import get_storage
+
+# name -> longest edge in pixels
+VARIANTS = {
+    'small': 128,
+    'medium': 512,
+}
+
+JPEG_QUALITY = 85
+
+
+def generate_variants(photo_id):
+    """Render and store the missing variants of a photo.
+
+    Returns
+    -------
+    names : list of str
+        The variants that were created.
+    """
+    photo = Photo.query.get(photo_id)
+    if photo is None or photo.sha256 is None:
+        return []
+    existing = {name for name, in photo.variants.with_entities(PhotoVariant.name)}
+    missing = [name for name in VARIANTS if name not in existing]
+    if not missing:
+        return []
+
+    storage = get_storage()
+    with storage.open(photo.sha256) as original:
+        image = Image.open(original)
+        image.load()
+
+    for name in missing:
+        resized = _resize(image, VARIANTS[name])
+        sha256, size = storage.save(resized['data'])
+        db.session.add(PhotoVariant(photo_id=photo.id, name=name, sha256=sha256, size=size,
+                                    width=resized['width'], height=resized['height']))
+    db.session.commit()
+    return missing
+
+
+def _resize(image, edge):
+    resized = image.copy()
+    resized.thumbnail((edge, edge))
+    image_format = image.format or 'JPEG'
+    options = {}
+    if image_format == 'JPEG':
+        resized = resized.convert('RGB')
+        options = {'quality': JPEG_QUALITY, 'optimize': True}
+
+    data = BytesIO()
+    resized.save(data, format=image_format, **options)
+    data.seek(0)
+    return {'data': data, 'width': resized.width, 'height': resized.height}
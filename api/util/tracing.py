@@ -0,0 +1,456 @@
+"""
+Lightweight span tracing across requests, SQL, Redis, mail and Celery.
+
+A trace starts with a request, or continues one from the W3C `traceparent`
+header the client sent. Its spans cover the request, every SQL statement,
+every `REDIS_CONN` command or pipeline and every mail sent. Enqueued Celery
+tasks carry the `traceparent` in their message headers, so the task and the
+spans inside it join the trace of whatever enqueued it. The current span is
+kept in a context variable, so it follows the code that runs on its behalf;
+threads started on a request's behalf need a copy of its context
+(`contextvars.copy_context().run`).
+
+Traces are sampled when they start (`TRACING_SAMPLE_RATE`) and the decision
+travels with them. Sampled spans are handed to a background thread, which
+exports them in batches; when it falls behind, spans are dropped and counted
+(`flights_trace_spans_dropped_total` in `/api/metrics`) rather than waited
+for. Forked processes, such as Celery's prefork workers, start their own
+thread. Exporters are pluggable:
+
+* `jsonl`: one JSON object per span, appended to `TRACING_FILE`.
+* `otlp`: OTLP/HTTP JSON, posted to `TRACING_OTLP_ENDPOINT`, for an
+  OpenTelemetry collector, Jaeger or Tempo.
+
+or `set_exporter` installs any object with `export(spans)`. A trace is
+reconstructed offline by grouping spans on `trace_id` and linking each span
+to its `parent_id`.
+"""
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+import redis
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from api.util import instrumentation
+
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_FILE = os.path.join(tempfile.gettempdir(), 'flights-traces.jsonl')
+DEFAULT_OTLP_ENDPOINT = 'http://localhost:4318/v1/traces'
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 512
+
+HEADER = 'traceparent'
+
+# Span kinds, numbered as in OTLP.
+INTERNAL, SERVER, CLIENT, PRODUCER, CONSUMER = range(1, 6)
+
+_current = contextvars.ContextVar('flights_span', default=None)
+
+_exporter = None
+_service = 'flights'
+_sample_rate = DEFAULT_SAMPLE_RATE
+_task_spans = {}
+
+
+class Span(object):
+    """A timed operation within a trace."""
+
+    __slots__ = ('name', 'kind', 'trace_id', 'span_id', 'parent_id', 'sampled',
+                 'attributes', 'error', 'start', 'end')
+
+    def __init__(self, name, kind=INTERNAL, parent=None, trace_id=None, parent_id=None,
+                 sampled=None, attributes=None):
+        self.name = name
+        self.kind = kind
+        if parent is not None:
+            trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.sampled = random.random() < _sample_rate if sampled is None else sampled
+        self.attributes = attributes or {}
+        self.error = None
+        self.start = time.time_ns()
+        self.end = None
+
+    def finish(self, error=None):
+        """End the span and hand it to the exporter if it is sampled.
+
+        `error`, an exception or a message, marks the span as failed.
+        """
+        self.end = time.time_ns()
+        if isinstance(error, BaseException):
+            self.error = f'{type(error).__name__}: {error}'
+        elif error is not None:
+            self.error = error
+        if self.sampled and _exporter is not None:
+            _exporter.submit(self)
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-{"01" if self.sampled else "00"}'
+
+    def as_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'service': _service,
+            'start': self.start,
+            'duration_ms': (self.end - self.start) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def current_span():
+    """The span the calling code runs in, if any."""
+    return _current.get()
+
+
+def _recording():
+    span = _current.get()
+    return span is not None and span.sampled
+
+
+def parse_traceparent(header):
+    """The trace id, parent span id and sampled flag of a `traceparent` header.
+
+    Returns None for a missing or malformed header.
+    """
+    try:
+        version, trace_id, parent_id, flags = header.split('-')
+        int(trace_id, 16), int(parent_id, 16)
+        sampled = bool(int(flags, 16) & 1)
+    except (AttributeError, ValueError):
+        return None
+    if len(trace_id) != 32 or len(parent_id) != 16 or not int(trace_id, 16):
+        return None
+    return trace_id, parent_id, sampled
+
+
+def start_span(name, kind=INTERNAL, traceparent=None, **attributes):
+    """Start a span, as a child of the current one or of `traceparent`."""
+    parent = _current.get()
+    remote = parse_traceparent(traceparent) if traceparent else None
+    if remote:
+        trace_id, parent_id, sampled = remote
+        return Span(name, kind, trace_id=trace_id, parent_id=parent_id, sampled=sampled,
+                    attributes=attributes)
+    return Span(name, kind, parent=parent, attributes=attributes)
+
+
+@contextmanager
+def span(name, kind=INTERNAL, traceparent=None, **attributes):
+    """Run the block in a new span, the current one while it runs."""
+    new_span = start_span(name, kind, traceparent, **attributes)
+    token = _current.set(new_span)
+    try:
+        yield new_span
+    except BaseException as err:
+        new_span.finish(error=err)
+        raise
+    else:
+        new_span.finish()
+    finally:
+        _current.reset(token)
+
+
+def init_app(app):
+    """Trace `app`'s requests.
+
+    Call it before any other request hooks are added so spans cover them.
+    """
+    if not configure(app):
+        return
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    app.teardown_request(_teardown_request)
+
+
+def configure(app):
+    """Set up the sample rate and exporter from `app`'s config.
+
+    The exporter and its thread are shared by every app in the process.
+    Returns whether tracing is enabled.
+    """
+    global _service, _sample_rate
+    name = app.config.get('TRACING_EXPORTER', 'jsonl')
+    if not name:
+        return False
+    if _exporter is None:
+        _service = app.config.get('TRACING_SERVICE', app.name)
+        _sample_rate = app.config.get('TRACING_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+        set_exporter(EXPORTERS[name].from_config(app.config))
+    return True
+
+
+def set_exporter(exporter):
+    """Send spans to `exporter` from now on; returns the previous exporter.
+
+    Anything with an `export(spans)` method, taking a list of `Span`, will do.
+    """
+    global _exporter
+    previous = _exporter
+    _exporter = exporter if isinstance(exporter, BatchExporter) else BatchExporter(exporter)
+    return previous
+
+
+def flush():
+    """Wait until every span finished so far is exported."""
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def _restart_exporter():
+    # A forked child, such as a Celery prefork worker, inherits the queue but
+    # not the thread draining it; the queue's lock may even be held.
+    global _exporter
+    if _exporter is not None:
+        _exporter = _exporter.restarted()
+
+
+atexit.register(flush)
+os.register_at_fork(after_in_child=_restart_exporter)
+
+
+class BatchExporter(object):
+    """Export spans in batches from a background thread."""
+
+    def __init__(self, exporter, queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def restarted(self):
+        """A new exporter like this one, with its own queue and thread."""
+        return BatchExporter(self.exporter, self._queue.maxsize, self.batch_size)
+
+    def submit(self, span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self._drop(1)
+
+    def flush(self):
+        """Wait until every span submitted so far is exported."""
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def _drop(self, count):
+        self.dropped += count
+        instrumentation.TRACE_SPANS_DROPPED.inc(count)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.exporter.export(batch)
+            except Exception:  # a broken exporter must not take the thread down
+                self._drop(len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+class JsonLinesExporter(object):
+    """Append spans to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('TRACING_FILE') or DEFAULT_FILE)
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.as_dict(), default=str) + '\n' for span in spans)
+        with open(self.path, 'a') as out:
+            out.write(lines)
+
+
+class OtlpHttpExporter(object):
+    """Post spans to an OpenTelemetry collector as OTLP/HTTP JSON."""
+
+    def __init__(self, endpoint, timeout=5):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('TRACING_OTLP_ENDPOINT') or DEFAULT_OTLP_ENDPOINT)
+
+    def export(self, spans):
+        body = {'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': _service})},
+            'scopeSpans': [{'scope': {'name': __name__},
+                            'spans': [self._otlp_span(span) for span in spans]}],
+        }]}
+        post = urllib.request.Request(self.endpoint, data=json.dumps(body).encode(),
+                                      headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(post, timeout=self.timeout).close()
+
+    @staticmethod
+    def _otlp_span(span):
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start),
+            'endTimeUnixNano': str(span.end),
+            'attributes': _otlp_attributes(span.attributes),
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+
+def _otlp_attributes(attributes):
+    def value(item):
+        if isinstance(item, bool):
+            return {'boolValue': item}
+        if isinstance(item, int):
+            return {'intValue': str(item)}
+        if isinstance(item, float):
+            return {'doubleValue': item}
+        return {'stringValue': str(item)}
+    return [{'key': key, 'value': value(item)} for key, item in attributes.items()]
+
+
+EXPORTERS = {
+    'jsonl': JsonLinesExporter,
+    'otlp': OtlpHttpExporter,
+}
+
+
+# Requests
+
+def _start_request():
+    trace_span = start_span(request.method, SERVER, request.headers.get(HEADER))
+    if trace_span.sampled:  # only pay for the attributes of spans that are exported
+        rule = request.url_rule.rule if request.url_rule else request.path
+        trace_span.name = f'{request.method} {rule}'
+        trace_span.attributes.update({'http.method': request.method, 'http.route': rule,
+                                      'http.target': request.full_path.rstrip('?')})
+    g.trace = trace_span, _current.set(trace_span)
+
+
+def _end_request(response):
+    trace = g.get('trace')
+    if trace is not None:
+        trace[0].attributes['http.status_code'] = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    trace_span, token = trace
+    status = trace_span.attributes.get('http.status_code', 500)
+    trace_span.finish(error=exc if exc is not None or status < 500 else f'HTTP {status}')
+    _current.reset(token)
+
+
+# SQL
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    if _recording():
+        conn.info.setdefault('trace_spans', []).append(start_span(
+            'sql', CLIENT, **{'db.system': conn.dialect.name, 'db.statement': statement}))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get('trace_spans'):
+        conn.info['trace_spans'].pop().finish()
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    spans = context.connection.info.get('trace_spans') if context.connection else None
+    if spans:
+        spans.pop().finish(error=context.original_exception)
+
+
+# Redis
+
+class TracedRedis(redis.StrictRedis):
+    """A Redis client with a span around every command and pipeline."""
+
+    def execute_command(self, *args, **options):
+        if not _recording():
+            return super().execute_command(*args, **options)
+        with span(f'redis {args[0]}', CLIENT, **{'db.system': 'redis'}):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TracedPipeline(self.connection_pool, self.response_callbacks, transaction,
+                              shard_hint)
+
+
+class TracedPipeline(redis.client.Pipeline):
+    """A Redis pipeline with a span around every execution."""
+
+    def execute(self, raise_on_error=True):
+        if not _recording():
+            return super().execute(raise_on_error)
+        with span('redis pipeline', CLIENT, **{'db.system': 'redis',
+                                               'db.redis.commands': len(self.command_stack)}):
+            return super().execute(raise_on_error)
+
+
+# Celery
+
+@before_task_publish.connect
+def _inject_traceparent(headers=None, **kwargs):
+    current = _current.get()
+    if current is not None and headers is not None:
+        headers[HEADER] = current.traceparent
+
+
+@task_prerun.connect
+def _start_task(task_id=None, task=None, **kwargs):
+    # Message headers become request attributes; eager tasks keep them apart.
+    traceparent = getattr(task.request, HEADER, None)
+    if traceparent is None:
+        traceparent = (task.request.headers or {}).get(HEADER)
+    task_span = start_span(f'celery {task.name}', CONSUMER, traceparent,
+                           **{'celery.task_id': task_id})
+    _task_spans[task_id] = (task_span, _current.set(task_span))
+
+
+@task_postrun.connect
+def _end_task(task_id=None, state=None, retval=None, **kwargs):
+    started = _task_spans.pop(task_id, None)
+    if started is None:
+        return
+    task_span, token = started
+    task_span.attributes['celery.state'] = state
+    task_span.finish(error=retval if state in ('FAILURE', 'RETRY') else None)
+    _current.reset(token)
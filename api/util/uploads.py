@@ -0,0 +1,23 @@
+"""
+Request handling for large uploads.
+
+`SpoolingRequest` parses multipart files into a `SpooledTemporaryFile`: small
+files stay in memory, bigger ones spill to `UPLOAD_SPOOL_DIR` as they are
+read, so an upload never sits in worker RAM as a whole. Request bodies over
+`MAX_CONTENT_LENGTH` are refused with a 413 before they are parsed.
+"""
+import tempfile
+
+from flask import Request, current_app
+
+DEFAULT_SPOOL_MAX_MEMORY = 512 * 1024  # bytes
+
+
+class SpoolingRequest(Request):
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None,
+                         content_length=None):
+        config = current_app.config
+        return tempfile.SpooledTemporaryFile(
+            max_size=config.get('UPLOAD_SPOOL_MAX_MEMORY', DEFAULT_SPOOL_MAX_MEMORY),
+            dir=config.get('UPLOAD_SPOOL_DIR'))
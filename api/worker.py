@@ -0,0 +1,36 @@
+"""
+Flights application for background workers.
+
+Celery workers and beat only need a database session and the mail settings.
+`create_worker_app` skips everything `api.app.create_app` does to serve
+requests: `db.create_all()`, the blueprints (and with them every endpoint
+module), CORS and the Swagger docs. Workers start faster and starting one
+never touches the schema; migrations own it. Tracing is set up, so tasks join
+the traces of whatever enqueued them.
+
+"""
+
+from flask import Flask
+
+import api.settings
+from api.models.db import db
+from api.util import tracing
+from notifier.settings import mail_settings
+
+NAME = 'flights-worker'
+
+
+def create_worker_app(config_obj=api.settings, **config_overrides):
+    """Instantiate and return a flask application for use outside requests.
+
+    Takes the same configuration as `api.app.create_app`.
+    """
+    app = Flask(NAME)
+    app.config.from_object(config_obj)  # defaults
+    app.config.update(config_overrides)
+    app.config.update(mail_settings)
+
+    db.init_app(app)
+    tracing.configure(app)
+
+    return app
@@ -0,0 +1,56 @@
+"""
+A benchmark for the admin check in `admin_required`.
+
+Compares loading the user on every request, as `admin_required` used to, with
+the cached role lookup, and reports latency and SQL statements per check. To
+run:
+```sh
+> docker-compose run flights python benchmarks/auth_paths.py --checks 5000
+```
+"""
+import argparse
+import time
+
+from sqlalchemy import event
+
+from api import app
+from api.endpoints.util import auth
+from api.models.db import db, User
+from tests.util.factories import UserFactory
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--checks', type=int, default=5000,
+                        help='Admin checks per path')
+    args = parser.parse_args()
+
+    flights_app = app.create_app()
+    with flights_app.app_context():
+        user = UserFactory()
+        user.is_admin = True
+        user.save()
+        user_id = user.id
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute',
+                     lambda *_: statements.append(1))
+
+        paths = (
+            ('user lookup', lambda: User.query.get(user_id).is_admin),
+            ('cached role', lambda: auth.is_admin(user_id)),
+        )
+        for name, check in paths:
+            del statements[:]
+            start = time.perf_counter()
+            for _ in range(args.checks):
+                assert check()
+                # Each request starts with an empty session.
+                db.session.remove()
+            elapsed = time.perf_counter() - start
+            print(f'{name:<12} {elapsed / args.checks * 1000:.3f} ms/check, '
+                  f'{len(statements) / args.checks:.3f} statements/check')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+A concurrency benchmark for the seat booking engine.
+
+Fires N parallel bookings at a single flight through `holds.book_directly`,
+the path `POST /api/tickets/book` takes, and reports throughput, latency
+percentiles and the oversell count (which must be zero). To run against the
+docker-compose database:
+```sh
+> docker-compose run flights python benchmarks/booking_concurrency.py -n 1000 -c 300
+```
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api import app
+from api.models.db import db, Flight, Ticket
+from api.util import booking, holds
+from tests.util.factories import FlightFactory, UserFactory
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(flights_app, flight_id, user_id, bookings, workers):
+    # Only as many threads as there are bookings ever start.
+    barrier = threading.Barrier(min(workers, bookings))
+    local = threading.local()
+
+    def book(_):
+        if not hasattr(local, 'ctx'):
+            local.ctx = flights_app.app_context()
+            local.ctx.push()
+            barrier.wait()
+        start = time.perf_counter()
+        try:
+            holds.book_directly(flight_id, user_id)
+            outcome = 'booked'
+        except booking.SoldOut:
+            outcome = 'sold_out'
+        finally:
+            db.session.remove()
+        return outcome, time.perf_counter() - start
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(book, range(bookings)))
+    return results, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--bookings', type=int, default=1000,
+                        help='Number of booking attempts')
+    parser.add_argument('-c', '--capacity', type=int, default=300,
+                        help='Seats on the contested flight (max 999)')
+    parser.add_argument('-w', '--workers', type=int, default=50,
+                        help='Concurrent booking threads')
+    args = parser.parse_args()
+
+    flights_app = app.create_app(SQLALCHEMY_POOL_SIZE=args.workers,
+                                 SQLALCHEMY_MAX_OVERFLOW=0)
+    with flights_app.app_context():
+        user_id = UserFactory().id
+        flight_id = FlightFactory(capacity=args.capacity).id
+
+    results, elapsed = run(flights_app, flight_id, user_id, args.bookings, args.workers)
+
+    with flights_app.app_context():
+        flight = Flight.query.get(flight_id)
+        tickets = Ticket.query.filter_by(flight_id=flight_id).count()
+        capacity = int(flight.capacity)
+        seats_sold = flight.seats_sold
+
+    latencies = [latency for _, latency in results]
+    booked = sum(1 for outcome, _ in results if outcome == 'booked')
+    print(f'attempts:     {len(results)} ({args.workers} concurrent)')
+    print(f'booked:       {booked} of {capacity} seats')
+    print(f'sold out:     {len(results) - booked}')
+    print(f'throughput:   {len(results) / elapsed:.1f} bookings/s')
+    print(f'latency p50:  {percentile(latencies, 50) * 1000:.2f} ms')
+    print(f'latency p99:  {percentile(latencies, 99) * 1000:.2f} ms')
+    print(f'oversold:     {max(0, tickets - capacity)} '
+          f'(tickets={tickets}, seats_sold={seats_sold})')
+
+
+if __name__ == '__main__':
+    main()
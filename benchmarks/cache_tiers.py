@@ -0,0 +1,63 @@
+"""
+A benchmark for the two cache tiers.
+
+Replays hot reads of `GET /api/routes` and a default `GET /api/flights`
+window through the test client, then reports latency, per-tier hit ratios
+and how much memory the in-process tier holds. To run:
+```sh
+> docker-compose run flights python benchmarks/cache_tiers.py --requests 5000
+```
+"""
+import argparse
+import time
+
+from api import app
+from api.models.db import User
+from api.util import cache
+from tests.util.factories import FlightFactory, RouteFactory, UserFactory
+
+
+def ratio(stats):
+    lookups = stats['hits'] + stats['misses']
+    return stats['hits'] / lookups if lookups else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--requests', type=int, default=5000,
+                        help='Requests per endpoint')
+    parser.add_argument('--routes', type=int, default=200,
+                        help='Routes to seed')
+    parser.add_argument('--flights', type=int, default=200,
+                        help='Flights to seed')
+    args = parser.parse_args()
+
+    flights_app = app.create_app()
+    with flights_app.app_context():
+        routes = [RouteFactory() for _ in range(args.routes)]
+        for i in range(args.flights):
+            FlightFactory(origin=routes[i % len(routes)],
+                          destination=routes[(i + 1) % len(routes)])
+        access_token = User.generate_token(UserFactory().id)
+
+    client = flights_app.test_client()
+    headers = {'Authorization': access_token, 'use_cache': 'true'}
+    for url in ('/api/routes', '/api/flights'):
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            client.get(url, headers=headers)
+        elapsed = time.perf_counter() - start
+        print(f'{url:<16} {elapsed / args.requests * 1000:.3f} ms/request')
+
+    stats = cache.stats()
+    local, redis = stats['local'], stats['redis']
+    print(f"local tier:  hit ratio {ratio(local):.1%} ({local['hits']} hits, "
+          f"{local['misses']} misses, {local['evictions']} evictions)")
+    print(f"             {local['entries']}/{local['max_entries']} entries, "
+          f"{local['bytes']}/{local['max_bytes']} bytes of JSON")
+    print(f"redis tier:  hit ratio {ratio(redis):.1%} ({redis['hits']} hits, "
+          f"{redis['misses']} misses)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+An EXPLAIN ANALYZE benchmark for the hot query indexes.
+
+Seeds a few million rows with `generate_series`, then runs EXPLAIN ANALYZE
+on the query behind each endpoint, first with the composite and partial
+indexes dropped and then with them in place. Everything happens in a single
+transaction that is rolled back, so the database is left as it was. To run:
+```sh
+> docker-compose run flights python benchmarks/explain_indexes.py --flights 2000000
+```
+"""
+import argparse
+import re
+from datetime import datetime, timedelta
+
+from api import app
+from api.endpoints.flights import _flights_in_window_query
+from api.models.db import db, Flight, Photo, Ticket
+
+SEED = [
+    ("INSERT INTO routes (city, country, is_deleted) "
+     "SELECT 'City ' || i, 'Benchland', false FROM generate_series(1, %(routes)s) i"),
+    ("INSERT INTO users (email, password, is_admin, is_deleted) "
+     "SELECT 'bench' || i || '@' || md5(random()::text) || '.com', 'x', false, false "
+     "FROM generate_series(1, %(users)s) i"),
+    # Departures are spread over a year; every 50th flight is soft-deleted.
+    ("INSERT INTO flights (capacity, seats_sold, origin_id, destination_id, departure, "
+     "                     arrival, price, is_deleted) "
+     "SELECT 200, 0, "
+     "       %(route_lo)s + i %% %(routes)s, "
+     "       %(route_lo)s + (i %% %(routes)s + 1 + (i / %(routes)s) %% (%(routes)s - 1)) "
+     "                      %% %(routes)s, "
+     "       now() + ((i::bigint * 7919) %% 525600) * interval '1 minute', "
+     "       now() + ((i::bigint * 7919) %% 525600) * interval '1 minute' + interval '2 hours', "
+     "       100, i %% 50 = 0 "
+     "FROM generate_series(1, %(flights)s) i"),
+    ("INSERT INTO tickets (flight_id, paid, booked_by_id, is_deleted) "
+     "SELECT %(flight_lo)s + (i::bigint * 48271) %% %(flights)s, true, "
+     "       %(user_lo)s + i %% %(users)s, i %% 50 = 0 "
+     "FROM generate_series(1, %(tickets)s) i"),
+    ("INSERT INTO photos (name, data, uploaded_by_id, created_at, is_deleted) "
+     "SELECT 'photo.jpg', '\\x00', %(user_lo)s + i %% %(users)s, "
+     "       now() - i * interval '1 second', false "
+     "FROM generate_series(1, %(photos)s) i"),
+]
+
+INDEXED_MODELS = (Flight, Ticket, Photo)
+
+EXECUTION_TIME = re.compile(r'Execution Time: ([\d.]+) ms')
+SCAN = re.compile(r'((?:Bitmap |Parallel )?(?:Index Only Scan|Index Scan|Seq Scan|'
+                  r'Bitmap Index Scan)(?: Backward)?(?: (?:using|on) \w+)?)')
+
+
+def seed(conn, args):
+    counts = vars(args)
+    for sql in SEED:
+        table = sql.split()[2]
+        lo, = conn.execute(f'SELECT coalesce(max(id), 0) FROM {table}').first()
+        conn.execute(sql, counts)
+        # Ids from a single INSERT are contiguous, but may not start at lo + 1.
+        first, = conn.execute(f'SELECT min(id) FROM {table} WHERE id > %(lo)s',
+                              {'lo': lo}).first()
+        counts[f'{table[:-1]}_lo'] = first
+    conn.execute('ANALYZE routes, users, flights, tickets, photos')
+    return counts
+
+
+def endpoint_queries(counts):
+    now = datetime.now()
+    origin = counts['route_lo']
+    destination = origin + 1
+    user = counts['user_lo'] + 7
+    flight_ids = list(range(counts['flight_lo'], counts['flight_lo'] + 50))
+    return [
+        ('GET /api/flights?limit=50',
+         _flights_in_window_query(now, now + timedelta(days=7), limit=50)),
+        ('GET /api/flights/route',
+         Flight.query.filter_by(is_deleted=False, origin_id=origin,
+                                destination_id=destination).filter(
+             Flight.departure >= now,
+             Flight.departure < now + timedelta(days=30)).order_by(Flight.departure,
+                                                                   Flight.id)),
+        ('GET /api/flights/origin',
+         Flight.query.filter_by(is_deleted=False, origin_id=origin)),
+        ('GET /api/flights/destination',
+         Flight.query.filter_by(is_deleted=False, destination_id=destination)),
+        ('include=tickets',
+         Ticket.query.filter(Ticket.flight_id.in_(flight_ids)).order_by(Ticket.id)),
+        ('GET /api/tickets/mine',
+         Ticket.query.filter_by(is_deleted=False, booked_by_id=user).order_by(Ticket.id)),
+        ('GET /api/users/photo/download',
+         Photo.query.filter_by(is_deleted=False, uploaded_by_id=user)
+         .order_by(Photo.created_at.desc()).limit(1)),
+    ]
+
+
+def explain(conn, query):
+    compiled = query.statement.compile(dialect=conn.dialect)
+    plan = '\n'.join(row[0] for row in conn.execute(
+        f'EXPLAIN (ANALYZE, BUFFERS) {compiled}', compiled.params))
+    milliseconds = float(EXECUTION_TIME.search(plan).group(1))
+    return milliseconds, ', '.join(dict.fromkeys(SCAN.findall(plan))), plan
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routes', type=int, default=500)
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--flights', type=int, default=2000000)
+    parser.add_argument('--tickets', type=int, default=2000000)
+    parser.add_argument('--photos', type=int, default=200000)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Print full plans')
+    args = parser.parse_args()
+
+    flights_app = app.create_app()
+    with flights_app.app_context():
+        conn = db.engine.connect()
+        transaction = conn.begin()
+        try:
+            counts = seed(conn, args)
+            queries = endpoint_queries(counts)
+            indexes = [index.name for model in INDEXED_MODELS
+                       for index in model.__table__.indexes
+                       if index.name != f'ix_{model.__tablename__}_id']
+
+            results = {}
+            savepoint = conn.begin_nested()
+            for name in indexes:
+                conn.execute(f'DROP INDEX {name}')
+            for name, query in queries:
+                results[name] = [explain(conn, query)]
+            savepoint.rollback()
+            for name, query in queries:
+                results[name].append(explain(conn, query))
+
+            for name, (before, after) in results.items():
+                print(f'{name}\n'
+                      f'  before: {before[0]:9.2f} ms  {before[1]}\n'
+                      f'  after:  {after[0]:9.2f} ms  {after[1]}')
+                if args.verbose:
+                    print(before[2], after[2], sep='\n\n', end='\n\n')
+        finally:
+            transaction.rollback()
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+An itinerary search benchmark on a synthetic network.
+
+Builds a `FlightGraph` from randomly scheduled flights between thousands of
+routes, each of which is served through one of a few interconnected hubs.
+It then times the build, an incremental refresh and searches between random
+pairs of routes. To run:
+```sh
+> docker-compose run flights python benchmarks/itinerary_search.py --flights 300000
+```
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from api.util.itineraries import FlightGraph, make_leg
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def synthetic_legs(routes, flights, days, hubs, start_id=1):
+    """Hub-and-spoke schedule: every route feeds one hub, and hubs interconnect."""
+    start = datetime.now(timezone.utc)
+    for flight_id in range(start_id, start_id + flights):
+        spoke = random.randint(hubs + 1, routes)
+        hub = spoke % hubs + 1
+        kind = random.random()
+        if kind < 0.4:
+            origin, destination = spoke, hub
+        elif kind < 0.8:
+            origin, destination = hub, spoke
+        else:
+            origin, destination = random.sample(range(1, hubs + 1), 2)
+        departure = start + timedelta(minutes=random.randrange(days * 24 * 60))
+        arrival = departure + timedelta(minutes=random.randint(45, 8 * 60))
+        yield make_leg(flight_id, origin, destination, departure, arrival,
+                       round(random.uniform(40, 900), 2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--routes', type=int, default=2000)
+    parser.add_argument('--flights', type=int, default=300000)
+    parser.add_argument('--days', type=int, default=14,
+                        help='Days over which flights are scheduled')
+    parser.add_argument('--hubs', type=int, default=30)
+    parser.add_argument('-n', '--searches', type=int, default=500)
+    parser.add_argument('--max-legs', type=int, default=3)
+    args = parser.parse_args()
+    random.seed(0)
+
+    graph = FlightGraph()
+    start = time.perf_counter()
+    graph.add(synthetic_legs(args.routes, args.flights, args.days, args.hubs))
+    print(f'build:   {graph.size} legs in {time.perf_counter() - start:.2f} s')
+
+    start = time.perf_counter()
+    graph.add(synthetic_legs(args.routes, 1000, args.days, args.hubs,
+                             start_id=args.flights + 1))
+    print(f'refresh: 1000 new legs in {(time.perf_counter() - start) * 1000:.1f} ms')
+
+    earliest = datetime.now(timezone.utc) + timedelta(days=1)
+    latest = earliest + timedelta(days=1)
+    for sort in ('arrival', 'price'):
+        latencies, found = [], 0
+        for _ in range(args.searches):
+            origin, destination = random.sample(range(args.hubs + 1, args.routes + 1), 2)
+            start = time.perf_counter()
+            itineraries = graph.search(origin, destination, earliest, latest,
+                                       max_legs=args.max_legs, sort=sort)
+            latencies.append(time.perf_counter() - start)
+            found += bool(itineraries)
+        print(f'{sort:<8} p50 {percentile(latencies, 50) * 1000:7.2f} ms, '
+              f'p99 {percentile(latencies, 99) * 1000:7.2f} ms, '
+              f'{found / args.searches:.0%} of pairs connected')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+A login throughput benchmark.
+
+Fires concurrent `POST /api/users/login` requests at each bcrypt work factor
+and reports throughput, latency percentiles and how many logins were shed
+with a 503, to help pick a `BCRYPT_LOG_ROUNDS` that meets the latency SLO.
+Pool sizing follows `PASSWORD_HASHING_WORKERS` and
+`PASSWORD_HASHING_MAX_PENDING`. To run:
+```sh
+> docker-compose run flights python benchmarks/login_throughput.py --rounds 10 11 12
+```
+"""
+import argparse
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from api import app
+
+PASSWORD = 'Benchmark0'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, nargs='+', default=[10, 11, 12],
+                        help='bcrypt work factors to try')
+    parser.add_argument('-n', '--logins', type=int, default=200,
+                        help='Logins per work factor')
+    parser.add_argument('-c', '--concurrency', type=int, default=16,
+                        help='Concurrent clients, like gunicorn threads')
+    args = parser.parse_args()
+
+    flights_app = app.create_app()
+    headers = {'content-type': 'application/json'}
+
+    for rounds in args.rounds:
+        flights_app.config['BCRYPT_LOG_ROUNDS'] = rounds
+        credentials = json.dumps({'email': f'{uuid.uuid4().hex}@bench.com',
+                                  'password': PASSWORD})
+        flights_app.test_client().post('/api/users/register', data=credentials,
+                                       headers=headers)
+
+        def login(_):
+            start = time.perf_counter()
+            response = flights_app.test_client().post('/api/users/login',
+                                                      data=credentials,
+                                                      headers=headers)
+            return response.status_code, time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as clients:
+            results = list(clients.map(login, range(args.logins)))
+        elapsed = time.perf_counter() - start
+
+        latencies = [latency for status, latency in results if status == 200]
+        shed = sum(1 for status, _ in results if status == 503)
+        print(f'cost {rounds:>2}: {len(latencies) / elapsed:7.1f} logins/s, '
+              f'p50 {percentile(latencies, 50) * 1000:6.1f} ms, '
+              f'p99 {percentile(latencies, 99) * 1000:6.1f} ms, '
+              f'{shed} shed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+A departure reminder throughput benchmark.
+
+Seeds tickets on flights leaving tomorrow, then mails them to a stub SMTP
+server (`aiosmtpd`, in its own process so it does not compete for the GIL)
+and reports messages per second, first the old way
+(lazy loads per ticket and a fresh SMTP connection per message, on a sample)
+and then through `api.util.reminders`. Seeding happens in a transaction that
+is rolled back, so the database is left as it was. To run:
+```sh
+> docker-compose run flights pip install aiosmtpd
+> docker-compose run flights python benchmarks/mailer_throughput.py --tickets 100000
+```
+"""
+import argparse
+import datetime
+import socket
+import subprocess
+import sys
+import time
+
+from flask_mail import Mail
+
+from api import app
+from api.models.db import db, Flight
+from api.util import reminders
+from api.util.cache import REDIS_CONN
+
+SEED = [
+    ("INSERT INTO routes (city, country, is_deleted) "
+     "SELECT 'City ' || i, 'Benchland', false FROM generate_series(1, 2) i"),
+    ("INSERT INTO users (email, password, is_admin, is_deleted) "
+     "SELECT 'bench' || i || '@' || md5(random()::text) || '.com', 'x', false, false "
+     "FROM generate_series(1, :users) i"),
+    ("INSERT INTO flights (capacity, seats_sold, origin_id, destination_id, departure, "
+     "                     arrival, price, is_deleted) "
+     "SELECT 999, 0, :route_lo, :route_lo + 1, "
+     "       :tomorrow + (i % 1440) * interval '1 minute', "
+     "       :tomorrow + (i % 1440) * interval '1 minute' + interval '2 hours', 100, false "
+     "FROM generate_series(1, :flights) i"),
+    ("INSERT INTO tickets (flight_id, paid, booked_by_id, is_deleted) "
+     "SELECT :flight_lo + i % :flights, true, :user_lo + i % :users, false "
+     "FROM generate_series(1, :tickets) i"),
+]
+
+
+def start_smtp_stub(port):
+    server = subprocess.Popen([sys.executable, '-m', 'aiosmtpd', '-n', '-c',
+                               'aiosmtpd.handlers.Sink', '-l', f'127.0.0.1:{port}'])
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return server
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                server.kill()
+                raise
+            time.sleep(0.1)
+
+
+def seed(args, tomorrow):
+    counts = dict(vars(args), tomorrow=tomorrow)
+    for sql in SEED:
+        table = sql.split()[2]
+        lo = db.session.execute(f'SELECT coalesce(max(id), 0) FROM {table}').scalar()
+        db.session.execute(sql, counts)
+        counts[f'{table[:-1]}_lo'] = db.session.execute(
+            f'SELECT min(id) FROM {table} WHERE id > :lo', {'lo': lo}).scalar()
+    return counts
+
+
+def clear_sent_markers(first_id, count):
+    """Forget the seeded tickets were reminded, so the next run sends them again."""
+    ticket_ids = range(first_id, first_id + count)
+    for start in range(0, count, reminders.MARKER_BATCH):
+        REDIS_CONN.delete(*(reminders.sent_key(ticket_id)
+                            for ticket_id in ticket_ids[start:start + reminders.MARKER_BATCH]))
+
+
+def legacy(mail, from_date, to_date, limit):
+    """The reminder job before `api.util.reminders`, stopped after `limit` messages."""
+    sent = 0
+    flights = Flight.query.filter_by(is_deleted=False).filter(
+        Flight.departure >= from_date, Flight.departure <= to_date).all()
+    for flight in flights:
+        for ticket in flight.tickets.all():
+            if sent == limit:
+                return sent
+            mail.send(reminders.reminder_message(
+                ticket.booked_by.email, ticket.flight.destination.city,
+                ticket.flight.departure, 'flights@flights.com'))
+            sent += 1
+    return sent
+
+
+def report(name, sent, elapsed):
+    print(f'{name:<12} {sent:>8} messages  {elapsed:8.2f} s  {sent / elapsed:10.0f} msg/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tickets', type=int, default=100000)
+    parser.add_argument('--flights', type=int, default=500)
+    parser.add_argument('--users', type=int, default=50000)
+    parser.add_argument('--legacy-sample', type=int, default=2000,
+                        help='Messages to send the old way; 0 to skip')
+    parser.add_argument('-c', '--connections', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--max-emails', type=int, default=100,
+                        help='Messages per SMTP connection (MAIL_MAX_EMAILS)')
+    parser.add_argument('--smtp-port', type=int, default=8025)
+    args = parser.parse_args()
+
+    smtp = start_smtp_stub(args.smtp_port)
+
+    flights_app = app.create_app()
+    flights_app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=args.smtp_port,
+                              MAIL_USE_SSL=False, MAIL_USE_TLS=False, MAIL_USERNAME=None,
+                              MAIL_SUPPRESS_SEND=False, MAIL_MAX_EMAILS=args.max_emails)
+    mail = Mail(flights_app)
+
+    tomorrow = datetime.datetime.today() + datetime.timedelta(days=1)
+    window = (tomorrow, tomorrow + datetime.timedelta(days=1))
+    try:
+        with flights_app.app_context():
+            counts = seed(args, tomorrow)
+            if args.legacy_sample:
+                start = time.perf_counter()
+                sent = legacy(mail, *window, limit=args.legacy_sample)
+                report('legacy', sent, time.perf_counter() - start)
+
+            for connections in args.connections:
+                flights_app.config['MAIL_CONNECTIONS'] = connections
+                start = time.perf_counter()
+                sent = reminders.send_reminders(mail, *window)
+                report(f'pool x{connections}', sent, time.perf_counter() - start)
+                clear_sent_markers(counts['ticket_lo'], args.tickets)
+            db.session.rollback()
+    finally:
+        smtp.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+A request logging overhead benchmark.
+
+Fires concurrent JSON POSTs at a no-op endpoint and reports the latency each
+logging setup adds per request: none, the old synchronous body dump in
+`before_request`, and `api.util.request_log` at a few sample rates. Logs are
+written to a file; `--sink-delay` makes every write stall, like a congested
+disk or log shipper would. To run:
+```sh
+> docker-compose run flights python benchmarks/request_logging.py -c 1 --sink-delay 0.5
+```
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+
+from api import app
+from api.util import request_log
+
+BODY = json.dumps({'email': 'someone@example.com', 'password': 'Secret0!',
+                   'notes': 'x' * 512})
+
+
+def legacy_logging(flights_app, path):
+    """The `log_request_body` hook `api.util.request_log` replaced."""
+    root_logger = logging.getLogger('benchmark.legacy')
+    root_logger.setLevel(logging.INFO)
+    root_logger.propagate = False
+    root_logger.addHandler(logging.FileHandler(path))
+
+    @flights_app.before_request
+    def log_request_body():
+        if request.get_data():
+            root_logger.info('Request Data: %s', request.json)
+
+
+def run(flights_app, requests, concurrency):
+    headers = {'content-type': 'application/json'}
+
+    def post(_):
+        client = flights_app.test_client()
+        start = time.perf_counter()
+        client.post('/bench/echo', data=BODY, headers=headers)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        latencies = sorted(clients.map(post, range(requests)))
+    return sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--requests', type=int, default=20000)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--sample-rates', type=float, nargs='+', default=[1.0, 0.1])
+    parser.add_argument('--sink-delay', type=float, default=0,
+                        help='Milliseconds each log write stalls for')
+    args = parser.parse_args()
+
+    if args.sink_delay:
+        emit = logging.FileHandler.emit
+
+        def slow_emit(self, record):
+            time.sleep(args.sink_delay / 1000)
+            emit(self, record)
+
+        logging.FileHandler.emit = slow_emit
+
+    log_dir = tempfile.mkdtemp()
+    setups = [('none', None), ('legacy', None)] + [
+        (f'async @ {rate:g}', rate) for rate in args.sample_rates]
+
+    baseline = None
+    for name, rate in setups:
+        flights_app = app.create_app(
+            REQUEST_LOG_FILE=os.path.join(log_dir, 'requests.log'),
+            REQUEST_LOG_SAMPLE_RATE=0 if rate is None else rate)
+        flights_app.add_url_rule('/bench/echo', 'echo', lambda: ('', 204), methods=['POST'])
+        if name == 'legacy':
+            legacy_logging(flights_app, os.path.join(log_dir, 'legacy.log'))
+
+        run(flights_app, min(args.requests, 500), args.concurrency)  # warm up
+        mean, p99 = run(flights_app, args.requests, args.concurrency)
+        baseline = mean if baseline is None else baseline
+        print(f'{name:<14} mean {mean * 1e6:8.1f} us  p99 {p99 * 1e6:8.1f} us  '
+              f'overhead {(mean - baseline) * 1e6:+8.1f} us')
+    print(f'dropped: {request_log.dropped()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+A process startup benchmark for the API and the notifier workers.
+
+Starts fresh interpreters and reports, for each target, how long importing
+its modules takes, how long building its Flask app takes once imported, and
+the wall time from spawning the process until it is ready. `api` is what
+gunicorn (and, before `api.worker` existed, every Celery process) pays;
+`worker` and `notifier` are what Celery workers and beat pay now. To run:
+```sh
+> docker-compose run flights python benchmarks/startup_time.py --runs 10
+```
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+PROBE = """
+import json, time
+start = time.perf_counter()
+{imports}
+imported = time.perf_counter()
+{ready}
+ready = time.perf_counter()
+print(json.dumps([imported - start, ready - imported]))
+"""
+
+TARGETS = {
+    'api': ('from api.app import create_app', 'create_app()'),
+    'worker': ('from api.worker import create_worker_app', 'create_worker_app()'),
+    # Builds its worker app at import time, along with the Celery app.
+    'notifier': ('import notifier.notify', 'pass'),
+}
+
+
+def probe(imports, ready):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c',
+                             PROBE.format(imports=imports, ready=ready)],
+                            check=True, stdout=subprocess.PIPE).stdout
+    wall = time.perf_counter() - start
+    return json.loads(output.decode().splitlines()[-1]) + [wall]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('targets', nargs='*', metavar='target',
+                        help=f'Any of {", ".join(TARGETS)}; all by default')
+    args = parser.parse_args()
+
+    print(f'{"":<10} {"import":>10} {"create app":>12} {"spawn to ready":>16}  (median)')
+    for name in args.targets or TARGETS:
+        samples = [probe(*TARGETS[name]) for _ in range(args.runs)]
+        imported, created, wall = (statistics.median(column) for column in zip(*samples))
+        print(f'{name:<10} {imported * 1000:8.0f} ms {created * 1000:10.0f} ms '
+              f'{wall * 1000:14.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,19 @@ bash bin/wait_for_it.sh ;
 
 cd api
 
-if [ ! -d migrations ] ; then
-  flask db init
-  flask db migrate
-  flask db upgrade
+# Schema changes ship as revisions in api/migrations.
+flask db upgrade
+python models/seed.py --if-empty
 
-  python models/seed.py
-else
-  flask db migrate
-  flask db upgrade
+# Serialize the Swagger spec once, so gunicorn workers never build it.
+if [ -n "$APISPEC_PREBUILT" ]; then
+    flask build-docs "$APISPEC_PREBUILT"
 fi
 
-gunicorn -w 1 -b 0.0.0.0:8000 --timeout 350 unicorn:app
+# Workers share their metrics through this directory; start from scratch.
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/flights-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# Threads keep serving while logins wait on the bcrypt pool.
+gunicorn -w 1 --threads ${GUNICORN_THREADS:-8} -b 0.0.0.0:8000 --timeout 350 unicorn:app
 exec $@
@@ -1,14 +1,13 @@
 import datetime
 
-from celery import Celery
-from celery.schedules import crontab
-from flask_mail import Mail, Message
-from sqlalchemy import and_
+from celery import Celery, group
+from flask_mail import Mail
+from redis import RedisError
 
-from api import app
-from api.models.db import Flight
+from api.util import holds, reminders, thumbnails
+from api.worker import create_worker_app
 
-mail_app = app.create_app()
+mail_app = create_worker_app()
 mail = Mail(mail_app)
 
 celery_settings = {
@@ -18,36 +17,97 @@ celery_settings = {
 celery = Celery('notifier', broker=celery_settings['broker_url'])
 celery.conf.update(celery_settings)
 celery.conf.beat_schedule = {
-    'notify_users': {
-        'task': 'notify.notify_users',
-        'schedule': crontab(hour=0, minute=0)
+    'schedule_reminders': {
+        'task': 'notify.schedule_reminders',
+        'schedule': mail_app.config['REMINDER_SCAN_MINUTES'] * 60.0
+    },
+    'release_expired_holds': {
+        'task': 'notify.release_expired_holds',
+        'schedule': 30.0
     }
 }
 
+HOLD_SWEEP_BATCH = 500
+
+REMINDER_RETRY_DELAY = 60  # seconds
+
+
+def enqueue_reminders(from_date, to_date, eta=None):
+    """Send one chunk task per id range of the tickets departing in the window.
+
+    The last chunk is left open-ended, so tickets booked between now and
+    `eta` are reminded too.
+    """
+    with mail_app.app_context():
+        bounds = reminders.chunk_bounds(from_date, to_date, mail_app.config.get(
+            'REMINDER_CHUNK_SIZE', reminders.DEFAULT_CHUNK_SIZE))
+    if bounds:
+        bounds[-1] = (bounds[-1][0], None)
+    else:
+        bounds = [(None, None)]
+    group(send_reminder_chunk.s(from_date.isoformat(), to_date.isoformat(), first_id, last_id)
+          for first_id, last_id in bounds).apply_async(eta=eta)
+    return len(bounds)
+
 
 @celery.task
 def notify_users():
+    """Remind everyone flying tomorrow of their flight, right away.
+
+    Reminders are normally sent by `schedule_reminders`; this is for catching
+    up by hand.
+    """
+    from_date = datetime.datetime.today() + datetime.timedelta(days=1)
+    return enqueue_reminders(from_date, from_date + datetime.timedelta(days=1))
+
+
+@celery.task
+def schedule_reminders():
+    """Enqueue the reminders for departures that entered the look-ahead window.
+
+    Runs every `REMINDER_SCAN_MINUTES`. Each slice of departures is sent
+    `REMINDER_LEAD_HOURS` before it leaves, using a Celery ETA.
+    """
+    config = mail_app.config
+    lead = datetime.timedelta(hours=config['REMINDER_LEAD_HOURS'])
+    step = datetime.timedelta(minutes=config['REMINDER_SCAN_MINUTES'])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    window = reminders.claim_departures(
+        now, lead, datetime.timedelta(minutes=config['REMINDER_LOOKAHEAD_MINUTES']))
+    if window is None:
+        return 0
+    return sum(enqueue_reminders(from_date, to_date, eta=max(now, from_date - lead))
+               for from_date, to_date in reminders.slices(*window, step))
+
+
+@celery.task(bind=True, max_retries=5, default_retry_delay=REMINDER_RETRY_DELAY)
+def send_reminder_chunk(self, from_date, to_date, first_id, last_id):
+    """Send the reminders for tickets `first_id` to `last_id`.
+
+    Delivered tickets are marked in Redis, so a retry only sends the rest.
+    """
+    with mail_app.app_context():
+        try:
+            return reminders.send_reminders(
+                mail, datetime.datetime.fromisoformat(from_date),
+                datetime.datetime.fromisoformat(to_date), first_id, last_id)
+        except (OSError, RedisError) as err:  # SMTP errors are OSErrors too
+            raise self.retry(exc=err)
+
+
+@celery.task
+def generate_photo_variants(photo_id):
+    """Render the resized variants of an uploaded photo."""
     with mail_app.app_context():
-        from_date = datetime.datetime.today() + datetime.timedelta(days=1)
-        to_date = from_date + datetime.timedelta(days=1)
-        flights = Flight.query.filter(
-            and_(Flight.departure >= from_date,
-                 Flight.departure <= to_date)).all()
-
-        tickets = [flight.tickets.all() for flight in flights]
-
-        users = []
-        for flight in tickets:
-            for ticket in flight:
-                users.append((ticket.flight, ticket.booked_by))
-
-        for flight, user in users:
-            date = flight.departure.strftime('%d %b, %Y')
-            time = flight.departure.strftime('%I.%M %p')
-            msg = Message(subject='Hello',
-                          sender=mail_app.config.get('MAIL_USERNAME'),
-                          recipients=[user.email],
-                          body=f'Hi! Your flight to {flight.destination.city} on '
-                               f'{date} at '
-                               f'{time} is almost here!')
-            mail.send(msg)
+        return thumbnails.generate_variants(photo_id)
+
+
+@celery.task
+def release_expired_holds():
+    """Hand the seats of lapsed holds back to their flights, in batches."""
+    released = 0
+    while True:
+        swept = holds.release_expired(batch_size=HOLD_SWEEP_BATCH)
+        released += swept
+        if swept < HOLD_SWEEP_BATCH:
+            return released
@@ -7,5 +7,21 @@ mail_settings = {
     "MAIL_USE_SSL": True,
     "MAIL_USERNAME": os.environ.get('EMAIL_USER'),
     "MAIL_PASSWORD": os.environ.get('EMAIL_PASSWORD'),
-    "MAIL_DEFAULT_SENDER": 'flights@flights.com'
+    "MAIL_DEFAULT_SENDER": 'flights@flights.com',
+    # Reminders go out over this many SMTP connections, each reconnected
+    # after MAIL_MAX_EMAILS messages.
+    "MAIL_CONNECTIONS": int(os.environ.get('MAIL_CONNECTIONS', 4)),
+    "MAIL_MAX_EMAILS": int(os.environ.get('MAIL_MAX_EMAILS', 100)),
+    # Messages per second for each worker process; 0 for no limit.
+    "MAIL_RATE_LIMIT": float(os.environ.get('MAIL_RATE_LIMIT', 0)),
+    # Tickets per reminder chunk task.
+    "REMINDER_CHUNK_SIZE": int(os.environ.get('REMINDER_CHUNK_SIZE', 5000)),
+    # Reminders arrive this long before departure.
+    "REMINDER_LEAD_HOURS": float(os.environ.get('REMINDER_LEAD_HOURS', 24)),
+    # How often departures are scanned, and the width of each scheduled slice.
+    "REMINDER_SCAN_MINUTES": float(os.environ.get('REMINDER_SCAN_MINUTES', 5)),
+    # How far ahead of their send time reminders are enqueued. Keep this under
+    # the Redis broker's visibility timeout (an hour), or ETA tasks are
+    # delivered twice.
+    "REMINDER_LOOKAHEAD_MINUTES": float(os.environ.get('REMINDER_LOOKAHEAD_MINUTES', 30)),
 }
@@ -3,7 +3,9 @@ import unittest
 
 from api import app
 from api.models.db import db
+from api.util import itineraries
 from tests import settings
+from tests.util.helpers import reset_redis_database_cache
 
 
 class BaseTestCase(unittest.TestCase):
@@ -15,6 +17,8 @@ class BaseTestCase(unittest.TestCase):
         """Define test variables and initialize app."""
         self.app = app.create_app(config_obj=settings, TESTING=True)
         self.client = self.app.test_client()
+        reset_redis_database_cache()
+        itineraries.GRAPH.clear()
 
         with self.app.app_context():
             db.session.close()
@@ -1,7 +1,12 @@
 import os
+import tempfile
 
 user = os.getenv('DB_USER', 'postgres')
 password = os.getenv('DB_PASSWORD', 'password')
 host = os.getenv('DB_HOST', 'postgres')
 SQLALCHEMY_DATABASE_URI = f'postgresql+psycopg2://{user}:{password}@{host}:5432/test'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+PHOTO_STORAGE_DIR = os.path.join(tempfile.gettempdir(), 'flights-test-media')
+BCRYPT_LOG_ROUNDS = 4  # keep hashing cheap in tests
+QUERY_BUDGET_STRICT = True  # fail tests that go over an endpoint's query budget
+TRACING_SAMPLE_RATE = 0  # only trace what a test sends a sampled traceparent for
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from api import app
+from api.util.docs import CachedApiSpec
+from tests import settings
+from tests.base import BaseTestCase
+
+
+class DocsTestCase(BaseTestCase):
+    """Test case for the Swagger docs."""
+
+    def create_docs_app(self, **config_overrides):
+        # Docs are only set up outside of testing.
+        return app.create_app(config_obj=settings, APISPEC_SWAGGER_URL='/api/swagger.json',
+                              **config_overrides)
+
+    def test_swagger_json_is_cached(self):
+        """Test the spec is built lazily, once, and revalidated with its ETag."""
+        docs_app = self.create_docs_app(APISPEC_LAZY=True)
+        client = docs_app.test_client()
+
+        docs = docs_app.extensions['apispec']
+        with mock.patch.object(CachedApiSpec, 'build', wraps=docs.build) as build:
+            response = client.get('/api/swagger.json')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('/api/flights/itineraries', json.loads(response.data)['paths'])
+            etag = response.headers['ETag']
+
+            self.assertEqual(client.get('/api/swagger.json').data, response.data)
+            response = client.get('/api/swagger.json', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+        self.assertEqual(build.call_count, 1)
+
+        with self.subTest('Cache headers document their default'):
+            paths = json.loads(client.get('/api/swagger.json').data)['paths']
+
+            def use_cache_default(path):
+                [param] = [param for param in paths[path]['get']['parameters']
+                           if param['name'] == 'use_cache']
+                return param['default']
+
+            self.assertEqual(use_cache_default('/api/routes'), 'true')
+            self.assertEqual(use_cache_default('/api/flights'), 'true')
+            self.assertEqual(use_cache_default('/api/tickets/mine'), 'false')
+
+    def test_prebuilt_swagger_json(self):
+        """Test a spec written by `flask build-docs` is served without building one."""
+        path = os.path.join(tempfile.mkdtemp(), 'swagger.json')
+        docs_app = self.create_docs_app(APISPEC_PREBUILT=path)
+        result = docs_app.test_cli_runner().invoke(args=['build-docs', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+
+        docs_app = self.create_docs_app(APISPEC_PREBUILT=path)
+        with mock.patch.object(CachedApiSpec, 'build', side_effect=AssertionError):
+            response = docs_app.test_client().get('/api/swagger.json')
+
+        self.assertEqual(response.status_code, 200)
+        with open(path, 'rb') as prebuilt:
+            self.assertEqual(response.data, prebuilt.read())
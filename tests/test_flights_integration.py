@@ -1,10 +1,17 @@
 import json
-from datetime import timedelta
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-from api.models.db import User
+from flask import Response, stream_with_context
+from sqlalchemy.exc import ProgrammingError
+
+from api.models.db import db, Flight, Ticket, User
+from api.util import cache, itineraries, querylog
 from tests.base import BaseTestCase
-from tests.util.factories import FlightFactory, RouteFactory, UserFactory
-from tests.util.helpers import JsonEncoderWithDatetime
+from tests.util.factories import FlightFactory, RouteFactory, TicketFactory, UserFactory
+from tests.util.helpers import JsonEncoderWithDatetime, count_queries
 
 
 class FlightTestCase(BaseTestCase):
@@ -41,6 +48,50 @@ class FlightTestCase(BaseTestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(result['message'], 'Flight created.')
 
+    def test_admin_roles_are_cached(self):
+        """Test admin checks are cached until the role changes."""
+        with self.app.app_context():
+            user = UserFactory()
+            user.is_admin = True
+            user.save()
+            access_token = User.generate_token(user.id)
+            route_1 = RouteFactory()
+            route_2 = RouteFactory()
+
+            def create_flight():
+                flight = FlightFactory.build()
+                return self.client.post('/api/flights',
+                                        data=json.dumps(
+                                            {
+                                                'origin_id': route_1.id,
+                                                'destination_id': route_2.id,
+                                                'departure': flight.departure,
+                                                'arrival': flight.arrival,
+                                                'price': flight.price,
+                                                'capacity': flight.capacity
+                                            },
+                                            cls=JsonEncoderWithDatetime),
+                                        headers={
+                                            'Authorization': access_token,
+                                            'content-type': 'application/json'
+                                        })
+
+            self.assertEqual(create_flight().status_code, 201)
+            key = cache.USER_ROLES.key(user.id)
+            self.assertIs(cache.LOCAL_CACHE.get(key), True)
+
+            with self.subTest('Revoking admin drops the cached role'):
+                user.is_admin = False
+                user.save()
+                self.assertIsNone(cache.REDIS_CONN.get(key))
+
+                response = create_flight()
+                self.assertEqual(response.status_code, 401)
+
+            with self.subTest('Invalid tokens are rejected'):
+                access_token = 'Bearer invalid'
+                self.assertEqual(create_flight().status_code, 404)
+
     def test_get_all_flights(self):
         """Test can get all flights."""
         with self.app.app_context():
@@ -63,6 +114,53 @@ class FlightTestCase(BaseTestCase):
             self.assertEqual(result['flights'][1]['origin_id'], flight_2.origin_id)
             self.assertEqual(result['flights'][1]['destination_id'], flight_2.destination_id)
 
+    def test_get_all_flights_in_pages(self):
+        """Test flights can be paged through and streamed in departure order."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            flights = sorted((FlightFactory() for _ in range(5)),
+                             key=lambda flight: (flight.departure, flight.id))
+            expected = [flight.origin_id for flight in flights]
+
+            def get_all(**query_string):
+                response = self.client.get('/api/flights',
+                                           query_string=query_string,
+                                           headers={'Authorization': access_token})
+                return response.status_code, json.loads(response.data.decode())
+
+            origins, cursor, pages = [], None, 0
+            while True:
+                query_string = {'limit': 2}
+                if cursor:
+                    query_string['cursor'] = cursor
+                status, result = get_all(**query_string)
+                self.assertEqual(status, 200)
+                origins += [flight['origin_id'] for flight in result['flights']]
+                pages += 1
+                cursor = result['next_cursor']
+                if not cursor:
+                    break
+            self.assertEqual(pages, 3)
+            self.assertEqual(origins, expected)
+
+            with self.subTest('Streamed responses match'):
+                status, result = get_all(stream='true')
+                self.assertEqual(status, 200)
+                self.assertEqual([flight['origin_id'] for flight in result['flights']],
+                                 expected)
+                self.assertIsNone(result['next_cursor'])
+
+                status, result = get_all(stream='true', limit=3)
+                self.assertEqual(len(result['flights']), 3)
+                status, result = get_all(stream='true', cursor=result['next_cursor'])
+                self.assertEqual([flight['origin_id'] for flight in result['flights']],
+                                 expected[3:])
+
+            with self.subTest('Bad pages are rejected'):
+                self.assertEqual(get_all(cursor='not-a-cursor')[0], 422)
+                self.assertEqual(get_all(limit=0)[0], 422)
+
     def test_get_all_flights_with_date_range(self):
         """Test can get all flights filtered by date range."""
         with self.app.app_context():
@@ -141,6 +239,45 @@ class FlightTestCase(BaseTestCase):
             self.assertEqual(result['flights'][0]['origin_id'], flight.origin_id)
             self.assertEqual(result['flights'][0]['destination_id'], flight.destination_id)
 
+    def test_get_by_route_and_day(self):
+        """Test route searches are bounded to departure days."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            origin, destination = RouteFactory(), RouteFactory()
+            day = datetime.now(timezone.utc).replace(hour=12, minute=0, second=0,
+                                                     microsecond=0) + timedelta(days=5)
+            flights = {}
+            for offset in (0, 1, 3, 60):
+                departure = day + timedelta(days=offset)
+                flights[offset] = FlightFactory(origin=origin, destination=destination,
+                                                departure=departure,
+                                                arrival=departure + timedelta(hours=3)).id
+
+            def search(**query_string):
+                response = self.client.get('/api/flights/route',
+                                           query_string={'origin': origin.id,
+                                                         'destination': destination.id,
+                                                         **query_string},
+                                           headers={'Authorization': access_token})
+                if response.status_code != 200:
+                    return response.status_code
+                result = json.loads(response.data.decode())
+                return [flight['id'] for flight in result['flights']]
+
+            self.assertEqual(search(), [flights[0], flights[1], flights[3]])
+            self.assertEqual(search(departure=day.strftime('%Y-%m-%d')), [flights[0]])
+
+            with self.subTest('Flexible days'):
+                self.assertEqual(search(departure=day.strftime('%Y-%m-%d'), flex=1),
+                                 [flights[0], flights[1]])
+                next_day = (day + timedelta(days=2)).strftime('%Y-%m-%d')
+                self.assertEqual(search(departure=next_day, flex=1), [flights[1], flights[3]])
+
+            with self.subTest('Bad searches are rejected'):
+                self.assertEqual(search(departure='tomorrow'), 422)
+                self.assertEqual(search(flex=99), 422)
+
     def test_get_by_origin(self):
         """Test can get flight by origin."""
         with self.app.app_context():
@@ -178,3 +315,341 @@ class FlightTestCase(BaseTestCase):
             self.assertEqual(len(result['flights']), 1)
             self.assertEqual(result['flights'][0]['origin_id'], flight.origin_id)
             self.assertEqual(result['flights'][0]['destination_id'], flight.destination_id)
+
+    def test_flight_searches_are_cached(self):
+        """Test flight searches are cached until a flight is added on the route."""
+        with self.app.app_context():
+            user = UserFactory()
+            user.is_admin = True
+            access_token = User.generate_token(user.id)
+            flight = FlightFactory()
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json'
+            }
+            query = {'origin': flight.origin_id, 'destination': flight.destination_id}
+
+            def get_by_route(**extra_headers):
+                response = self.client.get('/api/flights/route',
+                                           query_string=query,
+                                           headers={**headers, **extra_headers})
+                self.assertEqual(response.status_code, 200)
+                return json.loads(response.data.decode())['flights']
+
+            self.assertEqual(len(get_by_route()), 1)
+            hits = cache.stats()['local']['hits']
+            self.assertEqual(len(get_by_route()), 1)
+            self.assertEqual(cache.stats()['local']['hits'], hits + 1)
+
+            with self.subTest('Creating a flight on the route drops the cached search'):
+                response = self.client.post('/api/flights',
+                                            data=json.dumps(
+                                                {
+                                                    'origin_id': flight.origin_id,
+                                                    'destination_id': flight.destination_id,
+                                                    'departure': flight.departure,
+                                                    'arrival': flight.arrival,
+                                                    'price': float(flight.price),
+                                                    'capacity': flight.capacity
+                                                },
+                                                cls=JsonEncoderWithDatetime),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(len(get_by_route()), 2)
+
+            with self.subTest('Searches can skip the cache'):
+                FlightFactory(origin=flight.origin, destination=flight.destination)
+                self.assertEqual(len(get_by_route(use_cache='false')), 3)
+
+    def test_cached_searches_see_bookings(self):
+        """Test booking and cancelling drop the cached searches listing the flight."""
+        with self.app.app_context():
+            access_token = User.generate_token(UserFactory().id)
+            flight = FlightFactory(capacity=5)
+            headers = {'Authorization': access_token, 'content-type': 'application/json'}
+
+            def search():
+                response = self.client.get(f'/api/flights/origin/{flight.origin_id}',
+                                           query_string={'include': 'tickets'},
+                                           headers=headers)
+                [result] = json.loads(response.data.decode())['flights']
+                return result['seats_available'], len(result['tickets'])
+
+            self.assertEqual(search(), (5, 0))
+            for _ in range(2):
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 201)
+            self.assertEqual(search(), (3, 2))
+
+            ticket = Ticket.query.filter_by(flight_id=flight.id).first()
+            response = self.client.delete(f'/api/tickets/cancel/{ticket.id}', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(search(), (4, 1))
+
+            with self.subTest('Searches listing other flights are kept'):
+                later = datetime.utcnow().replace(microsecond=0) + timedelta(days=10)
+                other = FlightFactory(departure=later, arrival=later + timedelta(hours=2))
+                window = {'from': (later - timedelta(days=1)).isoformat(),
+                          'to': (later + timedelta(days=1)).isoformat()}
+                response = self.client.get('/api/flights', query_string=window,
+                                           headers=headers)
+                self.assertEqual(len(json.loads(response.data.decode())['flights']), 1)
+                [key] = cache.REDIS_CONN.smembers(cache.tag_key(cache.flight_tag(other.id)))
+
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 201)
+                self.assertTrue(cache.REDIS_CONN.exists(key))
+
+    def test_flight_lists_run_constant_queries(self):
+        """Test listing flights costs the same number of queries at any size."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            origin = RouteFactory()
+            destination = RouteFactory()
+            headers = {'Authorization': access_token, 'use_cache': 'false'}
+            urls = ['/api/flights',
+                    '/api/flights?limit=50',
+                    '/api/flights?stream=true',
+                    f'/api/flights/route?origin={origin.id}&destination={destination.id}',
+                    f'/api/flights/origin/{origin.id}',
+                    f'/api/flights/destination/{destination.id}']
+
+            def queries_per_url():
+                counts = {}
+                for url in urls:
+                    for include in ('', 'tickets'):
+                        separator = '&' if '?' in url else '?'
+                        with count_queries() as statements:
+                            response = self.client.get(f'{url}{separator}include={include}',
+                                                       headers=headers)
+                            response.get_data()  # streamed bodies are only read here
+                        self.assertEqual(response.status_code, 200)
+                        counts[url, include] = len(statements)
+                return counts
+
+            flight = FlightFactory(origin=origin, destination=destination)
+            TicketFactory(flight=flight)
+            one_flight = queries_per_url()
+            for _ in range(4):
+                flight = FlightFactory(origin=origin, destination=destination)
+                TicketFactory(flight=flight)
+                TicketFactory(flight=flight)
+            self.assertEqual(queries_per_url(), one_flight)
+
+            with self.subTest('Tickets are only listed on request'):
+                response = self.client.get(f'/api/flights/origin/{origin.id}',
+                                           headers=headers)
+                result = json.loads(response.data.decode())
+                self.assertNotIn('tickets', result['flights'][0])
+                self.assertEqual(result['flights'][0]['seats_sold'], 0)
+                self.assertEqual(result['flights'][0]['seats_available'],
+                                 result['flights'][0]['capacity'])
+
+                response = self.client.get(f'/api/flights/origin/{origin.id}?include=tickets',
+                                           headers=headers)
+                result = json.loads(response.data.decode())
+                self.assertEqual([len(flight['tickets']) for flight in result['flights']],
+                                 [1, 2, 2, 2, 2])
+
+    def test_query_log(self):
+        """Test N+1 queries, slow queries and views over budget are reported."""
+        @self.app.route('/test/seats')
+        @querylog.query_budget(3)
+        def seats():
+            return json.dumps([flight.tickets.count() for flight in Flight.query])
+
+        with self.app.app_context():
+            access_token = User.generate_token(UserFactory().id)
+            for _ in range(5):
+                FlightFactory()
+
+            with self.assertLogs('flights.sql', 'WARNING') as logs:
+                with self.assertRaises(querylog.QueryBudgetExceeded):
+                    self.client.get('/test/seats')
+            self.assertEqual(len(logs.output), 1)
+            self.assertIn('Possible N+1 in seats, 5 identical queries', logs.output[0])
+
+            with self.subTest('Slow queries are logged'):
+                self.app.config['SLOW_QUERY_MS'] = 0
+                with self.assertLogs('flights.sql', 'WARNING') as logs:
+                    self.client.get('/api/routes', headers={'Authorization': access_token,
+                                                            'use_cache': 'false'})
+                self.assertIn('Slow query in routes.get_all', logs.output[0])
+
+            with self.subTest('Streamed bodies count towards the budget'):
+                @self.app.route('/test/seats/stream')
+                @querylog.query_budget(3)
+                def streamed_seats():
+                    def generate():
+                        for flight in Flight.query:
+                            yield str(flight.tickets.count())
+                    return Response(stream_with_context(generate()))
+
+                with self.assertRaises(querylog.QueryBudgetExceeded):
+                    self.client.get('/test/seats/stream').get_data()
+
+            with self.subTest('Failed statements are not left timing'):
+                with db.engine.connect() as connection:
+                    with self.assertRaises(ProgrammingError):
+                        connection.execute('SELECT * FROM no_such_table')
+                    self.assertEqual(connection.info['querylog_start'], [])
+                    self.assertEqual(connection.info['statement_start'], [])
+
+            with self.subTest('Parameters and IN lists are blanked out'):
+                self.assertEqual(
+                    querylog.shape('SELECT * FROM tickets WHERE flight_id IN '
+                                   '(%(flight_id_1)s, %(flight_id_2)s) AND id = %(id_1)s'),
+                    'SELECT * FROM tickets WHERE flight_id IN (?, ...) AND id = ?')
+
+    def test_itinerary_search(self):
+        """Test connecting itineraries are found and ranked."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            a, b, c = RouteFactory(), RouteFactory(), RouteFactory()
+            start = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=2)
+
+            def fly(origin, destination, departs, hours, price):
+                departure = start + timedelta(hours=departs)
+                return FlightFactory(origin=origin, destination=destination,
+                                     departure=departure,
+                                     arrival=departure + timedelta(hours=hours),
+                                     price=price)
+
+            direct = fly(a, c, 0, 10, 500)
+            first = fly(a, b, 0, 2, 100)
+            connection = fly(b, c, 3.5, 1.5, 100)
+            tight_connection = fly(b, c, 2.5, 1.5, 50)
+
+            def search(**query_string):
+                response = self.client.get('/api/flights/itineraries',
+                                           query_string={'origin': a.id,
+                                                         'destination': c.id,
+                                                         **query_string},
+                                           headers={'Authorization': access_token})
+                self.assertEqual(response.status_code, 200)
+                result = json.loads(response.data.decode())
+                return [[leg['id'] for leg in itinerary['legs']]
+                        for itinerary in result['itineraries']]
+
+            self.assertEqual(search(), [[first.id, connection.id], [direct.id]])
+
+            with self.subTest('Connections honour the minimum connection time'):
+                self.assertEqual(search(min_connection=20)[0],
+                                 [first.id, tight_connection.id])
+
+            with self.subTest('Itineraries can be sorted by price'):
+                self.assertEqual(search(sort='price', min_connection=20),
+                                 [[first.id, tight_connection.id],
+                                  [first.id, connection.id],
+                                  [direct.id]])
+
+            with self.subTest('Legs are bounded'):
+                self.assertEqual(search(max_legs=1), [[direct.id]])
+
+            with self.subTest('New flights are picked up without a rebuild'):
+                faster = fly(a, c, 0, 1, 900)
+                self.assertEqual(search()[0], [faster.id])
+
+            with self.subTest('Bad searches are rejected'):
+                response = self.client.get('/api/flights/itineraries',
+                                           query_string={'origin': a.id, 'sort': 'fun'},
+                                           headers={'Authorization': access_token})
+                self.assertEqual(response.status_code, 422)
+
+    def test_itinerary_search_by_price(self):
+        """Test a cheap leg that misses the connection does not hide a dearer one that makes it."""
+        start = datetime.now(timezone.utc) + timedelta(hours=2)
+
+        def leg(flight_id, origin, destination, departs, hours, price):
+            departure = start + timedelta(hours=departs)
+            return itineraries.make_leg(flight_id, origin, destination, departure,
+                                        departure + timedelta(hours=hours), price)
+
+        graph = itineraries.FlightGraph()
+        graph.add([leg(1, 1, 2, 0, 4.5, 50), leg(2, 1, 2, 0, 2, 150), leg(3, 2, 3, 5, 1, 100)])
+        for sort in itineraries.SORT_ORDERS:
+            with self.subTest(sort=sort):
+                [itinerary] = graph.search(1, 3, start, start + timedelta(hours=1),
+                                           sort=sort, limit=1)
+                self.assertEqual([leg.id for leg in itinerary.legs], [2, 3])
+
+    def test_itinerary_search_within_the_longest_layover(self):
+        """Test an early, cheap leg does not hide a later one that still connects."""
+        start = datetime.now(timezone.utc) + timedelta(hours=2)
+
+        def leg(flight_id, origin, destination, departs, hours, price):
+            departure = start + timedelta(hours=departs)
+            return itineraries.make_leg(flight_id, origin, destination, departure,
+                                        departure + timedelta(hours=hours), price)
+
+        graph = itineraries.FlightGraph()
+        # Leg 3 leaves 28 hours after leg 1 lands, but only 18 after leg 2.
+        graph.add([leg(1, 1, 2, 0, 2, 50), leg(2, 1, 2, 0.5, 11.5, 150),
+                   leg(3, 2, 3, 30, 1, 100)])
+        for sort in itineraries.SORT_ORDERS:
+            with self.subTest(sort=sort):
+                [itinerary] = graph.search(1, 3, start, start + timedelta(hours=1),
+                                           sort=sort, limit=1)
+                self.assertEqual([leg.id for leg in itinerary.legs], [2, 3])
+
+        with self.subTest('Airports visited on the way'):
+            # 1 -> 4 -> 2 beats 1 -> 5 -> 2, but cannot go on via 4.
+            graph = itineraries.FlightGraph()
+            graph.add([leg(1, 1, 4, 0, 1, 10), leg(2, 4, 2, 2, 1, 10),
+                       leg(3, 1, 5, 0, 1, 30), leg(4, 5, 2, 2, 1, 30),
+                       leg(5, 2, 4, 5, 1, 10), leg(6, 4, 3, 28, 1, 10)])
+            [itinerary] = graph.search(1, 3, start, start + timedelta(hours=1),
+                                       max_legs=4, limit=1)
+            self.assertEqual([leg.id for leg in itinerary.legs], [3, 4, 5, 6])
+
+    def test_flight_graph_refreshes_once(self):
+        """Test requests that waited for a refresh do not repeat it."""
+        graph = itineraries.FlightGraph()
+        with mock.patch.object(itineraries, '_load_legs', return_value=[]) as load_legs:
+            graph.refresh(now=0)
+            graph.mark_stale()
+            with graph._lock:
+                waiting = threading.Thread(target=graph.refresh, kwargs={'now': 1})
+                waiting.start()
+                time.sleep(0.05)
+                graph._checked_at = 1  # refreshed meanwhile
+            waiting.join()
+        self.assertEqual(load_legs.call_count, 1)
+
+    def test_flight_graph_rebuilds_in_the_background(self):
+        """Test searches keep using the current graph while it is rebuilt."""
+        start = datetime.now(timezone.utc) + timedelta(hours=2)
+        old = itineraries.make_leg(1, 1, 2, start, start + timedelta(hours=1), 10)
+        new = itineraries.make_leg(2, 1, 2, start, start + timedelta(hours=2), 20)
+        loading = threading.Event()
+        loaded = threading.Event()
+
+        def load_legs(after_id=0):
+            if after_id:
+                return []
+            loading.set()
+            loaded.wait(5)
+            return [new]
+
+        graph = itineraries.FlightGraph()
+        graph.add([old])
+        graph._built_at, graph._checked_at, graph._high_water = 0, 0, old.id
+        with self.app.app_context(), \
+                mock.patch.object(itineraries, '_load_legs', side_effect=load_legs):
+            graph.refresh(now=itineraries.REBUILD_INTERVAL)
+            self.assertTrue(loading.wait(5))
+
+            def search():
+                return [[leg.id for leg in itinerary.legs]
+                        for itinerary in graph.search(1, 2, start, start + timedelta(hours=1))]
+
+            self.assertEqual(search(), [[1]])
+            loaded.set()
+            graph._rebuilder.join()
+            self.assertEqual(search(), [[2]])
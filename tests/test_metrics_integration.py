@@ -0,0 +1,61 @@
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+from api.models.db import User
+from tests.base import BaseTestCase
+from tests.util.factories import TicketFactory, UserFactory
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class MetricsTestCase(BaseTestCase):
+    """Test case for the metrics blueprint."""
+
+    def test_metrics(self):
+        """Test requests report their latency, SQL, Redis and cache usage."""
+        with self.app.app_context():
+            user = UserFactory()
+            TicketFactory(booked_by=user)
+            access_token = User.generate_token(user.id)
+
+        endpoint = {'endpoint': 'tickets.get_mine'}
+        before = {
+            'requests': sample('flights_request_duration_seconds_count', method='GET', **endpoint),
+            'statements': sample('flights_request_sql_statements_sum', **endpoint),
+            'round_trips': sample('flights_request_redis_round_trips_sum', **endpoint),
+            'misses': sample('flights_cache_events_total', tier='redis', event='misses'),
+            'hits': sample('flights_cache_events_total', tier='redis', event='hits'),
+        }
+        for _ in range(2):
+            response = self.client.get('/api/tickets/mine',
+                                       headers={'Authorization': access_token,
+                                                'use_cache': 'true'})
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(
+            sample('flights_request_duration_seconds_count', method='GET', **endpoint),
+            before['requests'] + 2)
+        self.assertEqual(sample('flights_requests_total', method='GET', status='200', **endpoint),
+                         sample('flights_request_duration_seconds_count', method='GET',
+                                **endpoint))
+        self.assertGreater(sample('flights_request_sql_statements_sum', **endpoint),
+                           before['statements'])
+        self.assertGreater(sample('flights_request_redis_round_trips_sum', **endpoint),
+                           before['round_trips'])
+        self.assertEqual(sample('flights_cache_events_total', tier='redis', event='misses'),
+                         before['misses'] + 1)
+        self.assertEqual(sample('flights_cache_events_total', tier='redis', event='hits'),
+                         before['hits'] + 1)
+
+        with self.subTest('Metrics are exposed in Prometheus text format'):
+            response = self.client.get('/api/metrics')
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content_type.startswith('text/plain'))
+            families = {family.name for family in
+                        text_string_to_metric_families(response.data.decode())}
+            self.assertLessEqual({'flights_request_duration_seconds', 'flights_requests',
+                                  'flights_request_sql_statements',
+                                  'flights_request_redis_round_trips',
+                                  'flights_cache_events'}, families)
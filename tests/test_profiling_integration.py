@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+
+from api.models.db import User
+from api.util import profiling
+from tests.base import BaseTestCase
+from tests.util.factories import UserFactory
+
+
+class ProfilingTestCase(BaseTestCase):
+    """Test case for on-demand request profiling."""
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['PROFILE_DIR'] = tempfile.mkdtemp()
+
+        @self.app.route('/test/slow')
+        def slow():
+            time.sleep(0.05)
+            return ''
+
+    def read_profile(self, response):
+        path = os.path.join(self.app.config['PROFILE_DIR'],
+                            response.headers[profiling.ID_HEADER] + '.folded')
+        with open(path) as profile:
+            return [line.rsplit(' ', 1) for line in profile.read().splitlines()]
+
+    def test_admins_can_profile_requests(self):
+        """Test an admin's request is profiled when they ask for it, and no one else's."""
+        with self.app.app_context():
+            admin = UserFactory()
+            admin.is_admin = True
+            admin.save()
+            admin_token = User.generate_token(admin.id)
+            user_token = User.generate_token(UserFactory().id)
+
+        response = self.client.get('/test/slow', headers={'Authorization': admin_token,
+                                                          'X-Profile': '1'})
+        stacks = self.read_profile(response)
+        self.assertTrue(stacks)
+        self.assertTrue(all(count.isdigit() for _, count in stacks))
+        self.assertTrue(any(stack.split(';')[-1].startswith(f'slow ({__name__}:')
+                            for stack, _ in stacks))
+
+        for headers in ({'Authorization': admin_token},
+                        {'Authorization': user_token, 'X-Profile': '1'},
+                        {'X-Profile': '1'}):
+            response = self.client.get('/test/slow', headers=headers)
+            self.assertNotIn(profiling.ID_HEADER, response.headers)
+        self.assertEqual(len(os.listdir(self.app.config['PROFILE_DIR'])), 1)
+
+    def test_sampled_profiles(self):
+        """Test a sample of all requests is profiled."""
+        self.app.config['PROFILE_SAMPLE_RATE'] = 1
+        response = self.client.get('/test/slow')
+        self.assertTrue(self.read_profile(response))
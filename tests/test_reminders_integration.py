@@ -0,0 +1,126 @@
+import datetime
+import time
+
+from flask_mail import Mail
+
+from api.util import reminders
+from api.worker import create_worker_app
+from tests import settings
+from tests.base import BaseTestCase
+from tests.util.factories import FlightFactory, TicketFactory
+from tests.util.helpers import count_queries, reset_redis_database_cache
+
+
+class ReminderTestCase(BaseTestCase):
+    """Test case for departure reminders."""
+
+    def test_departure_reminders(self):
+        """Test tomorrow's passengers are reminded with a single query."""
+        with self.app.app_context():
+            def departing(days):
+                departure = datetime.datetime.today() + datetime.timedelta(days=days)
+                return {'departure': departure,
+                        'arrival': departure + datetime.timedelta(hours=2)}
+
+            flight = FlightFactory(**departing(1.25))
+            passengers = {TicketFactory(flight=flight).booked_by.email for _ in range(3)}
+            TicketFactory(flight=flight, is_deleted=True)
+            TicketFactory(flight=FlightFactory(is_deleted=True, **departing(1.25)))
+            TicketFactory(flight=FlightFactory(**departing(5)))
+            city = flight.destination.city
+
+            from_date = datetime.datetime.today() + datetime.timedelta(days=1)
+            to_date = from_date + datetime.timedelta(days=1)
+            mail = Mail(self.app)
+            with count_queries() as statements, mail.record_messages() as outbox:
+                sent = reminders.send_reminders(mail, from_date, to_date)
+
+            self.assertEqual(sent, 3)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual({msg.recipients[0] for msg in outbox}, passengers)
+            self.assertTrue(all(city in msg.body for msg in outbox))
+
+            with self.subTest('Delivered tickets are not reminded again'):
+                self.assertEqual(reminders.send_reminders(mail, from_date, to_date), 0)
+
+            with self.subTest('Chunks cover every ticket once'):
+                reset_redis_database_cache()
+                ticket_ids = sorted(ticket.id for ticket in flight.tickets
+                                    if not ticket.is_deleted)
+                bounds = reminders.chunk_bounds(from_date, to_date, chunk_size=2)
+                self.assertEqual(bounds, [(ticket_ids[0], ticket_ids[1]),
+                                          (ticket_ids[2], ticket_ids[2])])
+                with mail.record_messages() as outbox:
+                    sent = [reminders.send_reminders(mail, from_date, to_date, *chunk)
+                            for chunk in bounds]
+                self.assertEqual(sent, [2, 1])
+                self.assertEqual({msg.recipients[0] for msg in outbox}, passengers)
+
+    def test_reminders_from_worker_app(self):
+        """Test the worker app sends reminders without any of the API's endpoints."""
+        worker_app = create_worker_app(config_obj=settings, TESTING=True)
+        self.assertEqual([rule.endpoint for rule in worker_app.url_map.iter_rules()],
+                         ['static'])
+
+        with worker_app.app_context():
+            departure = datetime.datetime.today() + datetime.timedelta(days=1, hours=6)
+            ticket = TicketFactory(flight=FlightFactory(
+                departure=departure, arrival=departure + datetime.timedelta(hours=2)))
+            from_date = datetime.datetime.today() + datetime.timedelta(days=1)
+            mail = Mail(worker_app)
+            with mail.record_messages() as outbox:
+                sent = reminders.send_reminders(
+                    mail, from_date, from_date + datetime.timedelta(days=1))
+
+            self.assertEqual(sent, 1)
+            self.assertEqual(outbox[0].recipients, [ticket.booked_by.email])
+
+    def test_reminder_scheduling(self):
+        """Test each departure is claimed for reminders by exactly one scan."""
+        now = datetime.datetime(2026, 5, 1, 12, tzinfo=datetime.timezone.utc)
+        lead = datetime.timedelta(hours=24)
+        lookahead = datetime.timedelta(minutes=30)
+
+        start, end = reminders.claim_departures(now, lead, lookahead)
+        self.assertEqual(start, now + lead)
+        self.assertEqual(end, now + lead + lookahead)
+
+        with self.subTest('Claimed departures are not claimed again'):
+            self.assertIsNone(reminders.claim_departures(now, lead, lookahead))
+
+        with self.subTest('Later scans pick up where the last one stopped'):
+            later = now + datetime.timedelta(minutes=5)
+            self.assertEqual(reminders.claim_departures(later, lead, lookahead),
+                             (end, later + lead + lookahead))
+
+        with self.subTest('Scans after downtime skip departures too close to remind'):
+            much_later = now + datetime.timedelta(days=2)
+            self.assertEqual(reminders.claim_departures(much_later, lead, lookahead),
+                             (much_later + lead, much_later + lead + lookahead))
+
+        step = datetime.timedelta(minutes=10)
+        self.assertEqual([window[0] - start for window in reminders.slices(start, end, step)],
+                         [datetime.timedelta(0), step, 2 * step])
+
+    def test_reminder_rate_limit(self):
+        """Test the reminder rate limiter spaces out sends beyond a burst."""
+        limiter = reminders.RateLimiter(rate=100)
+        start = time.monotonic()
+        for _ in range(120):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+    def test_reminders_are_marked_sent_in_small_batches(self):
+        """Test delivered reminders are reported a few at a time, so a crash re-sends few."""
+        departure = datetime.datetime.today()
+        messages = [(ticket_id, reminders.reminder_message('someone@example.com', 'Nairobi',
+                                                           departure, 'noreply@example.com'))
+                    for ticket_id in range(reminders.SENT_BATCH * 2 + 5)]
+        batches = []
+        with self.app.app_context():
+            sent = reminders.send_all(Mail(self.app), messages, connections=1,
+                                      on_sent=batches.append)
+        self.assertEqual(sent, len(messages))
+        self.assertEqual(sorted(tag for batch in batches for tag in batch),
+                         [tag for tag, _ in messages])
+        self.assertLessEqual(max(len(batch) for batch in batches), reminders.SENT_BATCH)
@@ -1,6 +1,8 @@
 import json
+import time
 
 from api.models.db import User
+from api.util import cache
 from tests.base import BaseTestCase
 from tests.util.factories import RouteFactory, UserFactory
 
@@ -54,3 +56,41 @@ class RouteTestCase(BaseTestCase):
             self.assertEqual(result['routes'][0]['country'], route_1.country)
             self.assertEqual(result['routes'][1]['city'], route_2.city)
             self.assertEqual(result['routes'][1]['country'], route_2.country)
+
+    def test_routes_are_cached_in_process(self):
+        """Test routes are served from memory until any worker invalidates them."""
+        with self.app.app_context():
+            user = UserFactory()
+            user.is_admin = True
+            access_token = User.generate_token(user.id)
+            RouteFactory()
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json'
+            }
+
+            def get_routes():
+                response = self.client.get('/api/routes', headers=headers)
+                self.assertEqual(response.status_code, 200)
+                return json.loads(response.data.decode())['routes']
+
+            self.assertEqual(len(get_routes()), 1)
+            hits = cache.stats()['local']['hits']
+            self.assertEqual(len(get_routes()), 1)
+            self.assertEqual(cache.stats()['local']['hits'], hits + 1)
+
+            with self.subTest('Adding a route drops the cached list'):
+                route = RouteFactory.build()
+                self.client.post('/api/routes',
+                                 data=json.dumps({'city': route.city, 'country': route.country}),
+                                 headers=headers)
+                self.assertEqual(len(get_routes()), 2)
+
+            with self.subTest('Invalidations from other workers evict local entries'):
+                key = cache.ROUTES.key('_all_routes')
+                self.assertIsNotNone(cache.LOCAL_CACHE.get(key))
+                cache.REDIS_CONN.publish(cache.INVALIDATION_CHANNEL, json.dumps([key]))
+                deadline = time.monotonic() + 5
+                while cache.LOCAL_CACHE.get(key) is not None and time.monotonic() < deadline:
+                    time.sleep(0.05)
+                self.assertIsNone(cache.LOCAL_CACHE.get(key))
@@ -1,6 +1,11 @@
 import json
+import time
+from unittest import mock
 
-from api.models.db import User
+from redis import ConnectionError, StrictRedis
+
+from api.models.db import db, Ticket, User
+from api.util import cache, holds
 from tests.base import BaseTestCase
 from tests.util.factories import FlightFactory, TicketFactory, UserFactory
 
@@ -29,6 +34,192 @@ class TicketTestCase(BaseTestCase):
         self.assertEqual(response.status_code, 201)
         self.assertEqual(result['message'], 'Ticket successfully booked.')
 
+    def test_create_ticket_enforces_capacity(self):
+        """Test a flight cannot be booked beyond its capacity."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            flight = FlightFactory(capacity=1)
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json'
+            }
+
+            response = self.client.post('/api/tickets/book',
+                                        data=json.dumps({'flight_id': flight.id}),
+                                        headers=headers)
+            self.assertEqual(response.status_code, 201)
+
+            with self.subTest('Last seat is gone'):
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+
+                result = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 409)
+                self.assertEqual(result['message'], 'Flight is sold out.')
+                self.assertEqual(Ticket.query.filter_by(flight_id=flight.id).count(), 1)
+
+            with self.subTest('Cancelling frees the seat'):
+                ticket = Ticket.query.filter_by(flight_id=flight.id).first()
+                response = self.client.delete(f'/api/tickets/cancel/{ticket.id}',
+                                              headers=headers)
+                self.assertEqual(response.status_code, 200)
+
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 201)
+
+            with self.subTest('Unknown flights are not found'):
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id + 1}),
+                                            headers=headers)
+
+                result = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 404)
+                self.assertEqual(result['message'], 'Flight not found.')
+
+    def test_hold_and_confirm(self):
+        """Test a held seat can be confirmed into a ticket."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            flight = FlightFactory(capacity=1)
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json'
+            }
+
+            response = self.client.post('/api/tickets/hold',
+                                        data=json.dumps({'flight_id': flight.id}),
+                                        headers=headers)
+
+            result = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 201)
+            hold_id = result['hold_id']
+            self.assertEqual(Ticket.query.count(), 0)
+
+            with self.subTest('Held seats cannot be held again'):
+                response = self.client.post('/api/tickets/hold',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 409)
+
+            with self.subTest('Confirming books the seat'):
+                response = self.client.post(f'/api/tickets/hold/{hold_id}/confirm',
+                                            headers=headers)
+
+                result = json.loads(response.data.decode())
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(result['message'], 'Ticket successfully booked.')
+                ticket = Ticket.query.filter_by(flight_id=flight.id).one()
+                self.assertTrue(ticket.paid)
+
+            with self.subTest('Holds can only be confirmed once'):
+                response = self.client.post(f'/api/tickets/hold/{hold_id}/confirm',
+                                            headers=headers)
+                self.assertEqual(response.status_code, 410)
+
+    def test_hold_release_and_expiry(self):
+        """Test released and expired holds give their seat back."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            flight = FlightFactory(capacity=1)
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json'
+            }
+
+            def hold_seat():
+                return self.client.post('/api/tickets/hold',
+                                        data=json.dumps({'flight_id': flight.id}),
+                                        headers=headers)
+
+            hold_id = json.loads(hold_seat().data.decode())['hold_id']
+
+            with self.subTest('Other users cannot release the hold'):
+                other = User.generate_token(UserFactory().id)
+                response = self.client.delete(f'/api/tickets/hold/{hold_id}',
+                                              headers={'Authorization': other})
+                self.assertEqual(response.status_code, 404)
+
+            response = self.client.delete(f'/api/tickets/hold/{hold_id}', headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+            response = hold_seat()
+            self.assertEqual(response.status_code, 201)
+            hold_id = json.loads(response.data.decode())['hold_id']
+            self.assertEqual(holds.release_expired(now=time.time() + holds.DEFAULT_TTL + 1), 1)
+            self.assertFalse(holds.REDIS_CONN.exists(holds.hold_key(hold_id)))
+            self.assertEqual(hold_seat().status_code, 201)
+
+    def test_failed_confirmations_return_the_seat(self):
+        """Test a hold that cannot be booked gives its seat back."""
+        self.addCleanup(cache.BREAKER.succeeded)
+        with self.app.app_context():
+            user = UserFactory()
+            flight = FlightFactory(capacity=1)
+
+            hold_id = holds.hold_seat(flight.id, user.id)
+            with mock.patch.object(holds.booking, 'book_seat', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    holds.confirm_hold(hold_id, user.id)
+
+            hold_id = holds.hold_seat(flight.id, user.id)
+            with mock.patch.object(holds.booking, 'book_seat',
+                                   side_effect=holds.booking.SoldOut), \
+                    mock.patch.object(holds.REDIS_CONN, 'set', side_effect=ConnectionError):
+                with self.assertRaises(holds.booking.SoldOut):
+                    holds.confirm_hold(hold_id, user.id)
+
+    def test_bookings_respect_holds(self):
+        """Test a held seat cannot be booked by anyone else."""
+        with self.app.app_context():
+            flight = FlightFactory(capacity=1)
+            holder = {'Authorization': User.generate_token(UserFactory().id),
+                      'content-type': 'application/json'}
+            booker = {'Authorization': User.generate_token(UserFactory().id),
+                      'content-type': 'application/json'}
+            data = json.dumps({'flight_id': flight.id})
+
+            response = self.client.post('/api/tickets/hold', data=data, headers=holder)
+            hold_id = json.loads(response.data.decode())['hold_id']
+
+            response = self.client.post('/api/tickets/book', data=data, headers=booker)
+            self.assertEqual(response.status_code, 409)
+
+            response = self.client.post(f'/api/tickets/hold/{hold_id}/confirm', headers=holder)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(Ticket.query.filter_by(flight_id=flight.id).count(), 1)
+
+    def test_bookings_survive_redis_failures(self):
+        """Test booking and cancelling still work while Redis is down."""
+        self.addCleanup(cache.BREAKER.succeeded)
+        with self.app.app_context():
+            flight = FlightFactory(capacity=1)
+            headers = {'Authorization': User.generate_token(UserFactory().id),
+                       'content-type': 'application/json'}
+
+            with mock.patch.object(holds, '_take', side_effect=ConnectionError), \
+                    mock.patch.object(holds, '_adjust', side_effect=ConnectionError):
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 201)
+
+                response = self.client.post('/api/tickets/book',
+                                            data=json.dumps({'flight_id': flight.id}),
+                                            headers=headers)
+                self.assertEqual(response.status_code, 409)
+
+                ticket = Ticket.query.filter_by(flight_id=flight.id).one()
+                response = self.client.delete(f'/api/tickets/cancel/{ticket.id}',
+                                              headers=headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(Ticket.query.filter_by(flight_id=flight.id).count(), 0)
+
     def test_get_by_user_id(self):
         """Test can get ticket by user id."""
         with self.app.app_context():
@@ -98,3 +289,104 @@ class TicketTestCase(BaseTestCase):
                 result = json.loads(response.data.decode())
                 self.assertEqual(response.status_code, 200)
                 self.assertEqual(len(result['tickets']), 0)
+
+    def test_cached_tickets_are_invalidated(self):
+        """Test booking and cancelling drop the user's cached tickets."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            flight = FlightFactory()
+            headers = {
+                'Authorization': access_token,
+                'content-type': 'application/json',
+                'use_cache': 'true'
+            }
+
+            def get_mine():
+                response = self.client.get('/api/tickets/mine', headers=headers)
+                return json.loads(response.data.decode())['tickets']
+
+            self.client.post('/api/tickets/book',
+                             data=json.dumps({'flight_id': flight.id}),
+                             headers=headers)
+            self.assertEqual(len(get_mine()), 1)
+
+            key = cache.USER_TICKETS.key(user.id)
+            ttl = cache.REDIS_CONN.ttl(key)
+            self.assertGreater(ttl, 0)
+            self.assertLessEqual(ttl, cache.USER_TICKETS.ttl)
+
+            with self.subTest('Booking drops the cached list'):
+                invalidations = cache.stats()['redis']['invalidations']
+                self.client.post('/api/tickets/book',
+                                 data=json.dumps({'flight_id': flight.id}),
+                                 headers=headers)
+                self.assertEqual(len(get_mine()), 2)
+                self.assertGreater(cache.stats()['redis']['invalidations'], invalidations)
+
+            with self.subTest('Cancelling drops the cached list'):
+                ticket = Ticket.query.filter_by(booked_by_id=user.id).first()
+                self.client.delete(f'/api/tickets/cancel/{ticket.id}', headers=headers)
+                self.assertEqual(len(get_mine()), 1)
+
+    def test_rolled_back_writes_are_not_invalidated(self):
+        """Test a rolled back transaction's invalidations are not sent on the next commit."""
+        with self.app.app_context():
+            user = UserFactory()
+            flight = FlightFactory()
+            db.session.add(Ticket(flight_id=flight.id, booked_by_id=user.id))
+            db.session.flush()
+            db.session.rollback()
+
+            with mock.patch.object(cache, 'invalidate') as invalidate:
+                UserFactory()
+            invalidate.assert_not_called()
+
+    def test_cache_policies(self):
+        """Test the use_cache header picks how the cache is used."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+            ticket = TicketFactory.build()
+            ticket.booked_by = user
+            ticket.save()
+
+            key = cache.USER_TICKETS.key(user.id)
+            cache.cache_data_in_redis({key: []})
+
+            def get_mine(use_cache=None):
+                headers = {'Authorization': access_token}
+                if use_cache is not None:
+                    headers['use_cache'] = use_cache
+                response = self.client.get('/api/tickets/mine', headers=headers)
+                self.assertEqual(response.status_code, 200)
+                return json.loads(response.data.decode())['tickets']
+
+            with self.subTest('Bypass never reads the cache'):
+                self.assertEqual(len(get_mine()), 1)
+                self.assertEqual(len(get_mine('false')), 1)
+
+            with self.subTest('Read-through serves the cached value'):
+                self.assertEqual(len(get_mine('true')), 0)
+
+            with self.subTest('Refresh rebuilds the cached value'):
+                self.assertEqual(len(get_mine('refresh')), 1)
+                self.assertEqual(len(get_mine('true')), 1)
+
+            with self.subTest('Redis outages fall back to the database'):
+                unreachable = StrictRedis(host='redis', port=1, socket_connect_timeout=0.1)
+                breaker = cache.CircuitBreaker(failure_threshold=1, reset_timeout=60)
+                with mock.patch.object(cache, 'REDIS_CONN', unreachable), \
+                        mock.patch.object(cache, 'BREAKER', breaker):
+                    self.assertEqual(len(get_mine('true')), 1)
+                    self.assertTrue(breaker.is_open)
+                    self.assertEqual(len(get_mine('true')), 1)
+
+            with self.subTest('Redis errors do not wait on the rebuild lock'):
+                breaker = cache.CircuitBreaker(failure_threshold=100)
+                with mock.patch.object(cache, 'REDIS_CONN', unreachable), \
+                        mock.patch.object(cache, 'BREAKER', breaker), \
+                        mock.patch.object(cache.time, 'sleep') as sleep:
+                    self.assertEqual(len(get_mine('true')), 1)
+                    self.assertFalse(breaker.is_open)
+                    sleep.assert_not_called()
@@ -0,0 +1,150 @@
+import datetime
+import os
+import tempfile
+import time
+from unittest import mock
+
+from celery import Celery
+from celery.signals import before_task_publish
+from flask_mail import Mail
+from prometheus_client import REGISTRY
+
+from api.models.db import User
+from api.util import reminders, tracing
+from tests.base import BaseTestCase
+from tests.util.factories import FlightFactory, TicketFactory, UserFactory
+
+TRACE_ID = os.urandom(16).hex()
+PARENT_ID = os.urandom(8).hex()
+TRACEPARENT = f'00-{TRACE_ID}-{PARENT_ID}-01'
+
+
+class MemoryExporter(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+
+class TracingTestCase(BaseTestCase):
+    """Test case for span tracing."""
+
+    def setUp(self):
+        super().setUp()
+        self.exporter = MemoryExporter()
+        self.batch_exporter = tracing.BatchExporter(self.exporter)
+        previous = tracing.set_exporter(self.batch_exporter)
+        self.addCleanup(tracing.set_exporter, previous)
+
+    def exported(self):
+        self.batch_exporter.flush()
+        return {span.span_id: span for span in self.exporter.spans}
+
+    def test_request_spans(self):
+        """Test a request continues the caller's trace, with SQL and Redis spans inside."""
+        with self.app.app_context():
+            access_token = User.generate_token(UserFactory().id)
+
+        response = self.client.get('/api/routes', headers={'Authorization': access_token,
+                                                           'traceparent': TRACEPARENT})
+        self.assertEqual(response.status_code, 200)
+
+        spans = self.exported()
+        [root] = [span for span in spans.values() if span.parent_id == PARENT_ID]
+        self.assertEqual(root.name, 'GET /api/routes')
+        self.assertEqual(root.attributes['http.status_code'], 200)
+        self.assertIsNone(root.error)
+        self.assertTrue(all(span.trace_id == TRACE_ID for span in spans.values()))
+        children = {span.name for span in spans.values() if span.parent_id == root.span_id}
+        self.assertIn('sql', children)
+        self.assertTrue(any(name.startswith('redis ') for name in children))
+
+        with self.subTest('Unsampled requests are not exported'):
+            self.exporter.spans.clear()
+            self.client.get('/api/routes', headers={'Authorization': access_token})
+            self.assertEqual(self.exported(), {})
+
+    def test_task_spans(self):
+        """Test enqueued tasks carry the trace and join it when they run."""
+        celery = Celery('tracing-test')
+
+        @celery.task
+        def work():
+            with tracing.span('work'):
+                pass
+
+        with tracing.span('enqueue', traceparent=TRACEPARENT) as enqueue:
+            headers = {}
+            before_task_publish.send(sender='work', headers=headers)
+        self.assertEqual(headers['traceparent'], enqueue.traceparent)
+
+        work.apply(headers=headers)
+        spans = self.exported()
+        [task] = [span for span in spans.values() if span.parent_id == enqueue.span_id]
+        self.assertEqual(task.name, f'celery {work.name}')
+        self.assertEqual(task.attributes['celery.state'], 'SUCCESS')
+        [inner] = [span for span in spans.values() if span.parent_id == task.span_id]
+        self.assertEqual(inner.name, 'work')
+        self.assertEqual(inner.trace_id, TRACE_ID)
+
+    def test_mail_spans(self):
+        """Test every reminder sent gets a span, from whichever sender thread sent it."""
+        with self.app.app_context():
+            departure = datetime.datetime.today() + datetime.timedelta(days=1.25)
+            flight = FlightFactory(departure=departure,
+                                   arrival=departure + datetime.timedelta(hours=2))
+            for _ in range(3):
+                TicketFactory(flight=flight)
+
+            from_date = datetime.datetime.today() + datetime.timedelta(days=1)
+            with tracing.span('remind', traceparent=TRACEPARENT) as remind:
+                reminders.send_reminders(Mail(self.app), from_date,
+                                         from_date + datetime.timedelta(days=1))
+
+        mail_spans = [span for span in self.exported().values() if span.name == 'mail.send']
+        self.assertEqual(len(mail_spans), 3)
+        self.assertTrue(all(span.parent_id == remind.span_id for span in mail_spans))
+
+    def test_forked_processes_export_spans(self):
+        """Test a forked worker process exports its spans through a thread of its own."""
+        path = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+        tracing.set_exporter(tracing.JsonLinesExporter(path))
+
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            with tracing.span('in child', traceparent=TRACEPARENT):
+                pass
+            tracing.flush()
+            os._exit(0)
+
+        deadline = time.monotonic() + 10
+        while not os.waitpid(pid, os.WNOHANG)[0]:
+            if time.monotonic() > deadline:
+                os.kill(pid, 9)
+                self.fail('The child never exported its span')
+            time.sleep(0.01)
+        with open(path) as traces:
+            self.assertIn('"in child"', traces.read())
+
+    def test_failed_exports_are_counted(self):
+        """Test spans a failing exporter could not export show up in the metrics."""
+        def dropped():
+            return REGISTRY.get_sample_value('flights_trace_spans_dropped_total') or 0
+
+        failing = mock.Mock(**{'export.side_effect': OSError})
+        batch_exporter = tracing.BatchExporter(failing)
+        tracing.set_exporter(batch_exporter)
+        before = dropped()
+        with tracing.span('lost', traceparent=TRACEPARENT):
+            pass
+        batch_exporter.flush()
+        self.assertEqual(dropped(), before + 1)
+
+    def test_traceparent(self):
+        """Test malformed traceparent headers start a new trace."""
+        self.assertEqual(tracing.parse_traceparent(TRACEPARENT), (TRACE_ID, PARENT_ID, True))
+        for header in ('', 'nonsense', f'00-{TRACE_ID}-{PARENT_ID}',
+                       f'00-{"0" * 32}-{PARENT_ID}-01', f'00-{TRACE_ID[:-1]}-{PARENT_ID}-01',
+                       f'00-{TRACE_ID}-{PARENT_ID}-zz'):
+            self.assertIsNone(tracing.parse_traceparent(header), header)
@@ -1,7 +1,14 @@
 import json
 import io
+import logging
+import queue
+from unittest import mock
+
+from PIL import Image
 
 from api.models.db import Photo, User
+from api.util import passwords, request_log, tasks, thumbnails
+from api.util.storage import get_storage
 from tests.base import BaseTestCase
 from tests.util.factories import PhotoFactory, UserFactory
 
@@ -70,6 +77,31 @@ class UserTestCase(BaseTestCase):
         self.assertEqual(login_response.status_code, 200)
         self.assertTrue(result['access_token'])
 
+    def test_login_rehashes_password(self):
+        """Test logging in upgrades hashes made with an old work factor."""
+        self.register_user()
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+
+        login_response = self.login_user()
+
+        self.assertEqual(login_response.status_code, 200)
+        with self.app.app_context():
+            user = User.query.filter_by(email=self.user_data['email']).one()
+            self.assertTrue(user.password.startswith('$2b$05$'))
+            self.assertTrue(user.is_registered_password(self.user_data['password']))
+
+    def test_login_when_hashing_is_saturated(self):
+        """Test logins are shed while the hashing pool is full."""
+        self.register_user()
+
+        with mock.patch.object(passwords, 'POOL', passwords.HashingPool(1, 0)):
+            login_response = self.login_user()
+
+        result = json.loads(login_response.data.decode())
+        self.assertEqual(login_response.status_code, 503)
+        self.assertEqual(login_response.headers['Retry-After'], '1')
+        self.assertIn('Please try again', result['message'])
+
     def test_non_registered_user_login(self):
         """Test non registered users cannot login."""
         not_a_user = {
@@ -87,6 +119,32 @@ class UserTestCase(BaseTestCase):
         self.assertEqual(result['message'],
                          "Invalid email or password. Please try again")
 
+    def test_login_request_logs(self):
+        """Test request logs are sampled and never contain passwords."""
+        self.register_user()
+
+        with mock.patch.object(request_log.logger, 'info') as log:
+            self.app.config['REQUEST_LOG_SAMPLE_RATE'] = 1
+            response = self.login_user()
+            self.assertEqual(response.status_code, 200)
+
+            self.app.config['REQUEST_LOG_SAMPLE_RATE'] = 0
+            self.login_user()
+
+        log.assert_called_once()
+        entry = log.call_args[0][0]
+        self.assertEqual(entry['endpoint'], 'users.login')
+        self.assertEqual(entry['status'], 200)
+        self.assertEqual(entry['body'], {'email': self.user_data['email'],
+                                         'password': request_log.REDACTED})
+        self.assertNotIn(self.user_data['password'], json.dumps(entry))
+
+        with self.subTest('A full queue drops logs instead of blocking'):
+            handler = request_log.DroppingQueueHandler(queue.Queue(1))
+            for _ in range(3):
+                handler.handle(logging.makeLogRecord({'msg': entry}))
+            self.assertEqual(handler.dropped, 2)
+
     def test_photo_upload(self):
         """Test user can upload photo."""
         with self.app.app_context():
@@ -109,7 +167,10 @@ class UserTestCase(BaseTestCase):
 
             with self.app.app_context():
                 photo = Photo.query.get(1)
-            self.assertEqual(photo.data, b'yaddayadda')
+                with get_storage().open(photo.sha256) as stored:
+                    self.assertEqual(stored.read(), b'yaddayadda')
+            self.assertIsNone(photo.data)
+            self.assertEqual(photo.size, len(b'yaddayadda'))
 
         with self.subTest('None Jpgs are NOT uploaded'):
             response = self.client.post(
@@ -137,3 +198,106 @@ class UserTestCase(BaseTestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data, photo.data)
+
+    def test_photo_variants(self):
+        """Test resized variants are rendered in the background and served."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+
+        original = io.BytesIO()
+        Image.new('RGB', (600, 400), color='teal').save(original, format='JPEG')
+        original = original.getvalue()
+
+        with mock.patch.object(tasks.celery, 'send_task') as send_task:
+            response = self.client.post(
+                '/api/users/photo/upload',
+                data={'data': (io.BytesIO(original), 'photo.jpg')},
+                headers={'Authorization': access_token})
+        self.assertEqual(response.status_code, 201)
+        with self.app.app_context():
+            photo_id = Photo.query.one().id
+        send_task.assert_called_once_with('notify.generate_photo_variants', args=[photo_id])
+
+        def download(size):
+            return self.client.get('/api/users/photo/download',
+                                   query_string={'size': size},
+                                   headers={'Authorization': access_token})
+
+        with self.subTest('The original is sent until variants are ready'):
+            self.assertEqual(download('small').data, original)
+
+        with self.app.app_context():
+            self.assertEqual(thumbnails.generate_variants(photo_id), ['small', 'medium'])
+            self.assertEqual(thumbnails.generate_variants(photo_id), [])
+
+        for size, edge in thumbnails.VARIANTS.items():
+            with self.subTest(size=size):
+                response = download(size)
+                self.assertEqual(response.status_code, 200)
+                image = Image.open(io.BytesIO(response.data))
+                self.assertEqual(image.format, 'JPEG')
+                self.assertEqual(max(image.size), edge)
+
+        with self.subTest('Unknown sizes are rejected'):
+            self.assertEqual(download('huge').status_code, 422)
+
+    def test_photo_upload_size_limit(self):
+        """Test uploads over MAX_CONTENT_LENGTH are refused."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+        self.app.config['MAX_CONTENT_LENGTH'] = 1024
+
+        response = self.client.post(
+            '/api/users/photo/upload',
+            data={'data': (io.BytesIO(b'x' * 4096), 'big.jpg')},
+            headers={'Authorization': access_token})
+
+        result = json.loads(response.data.decode())
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('1024 byte limit', result['message'])
+        with self.app.app_context():
+            self.assertEqual(Photo.query.count(), 0)
+
+    def test_stored_photo_download(self):
+        """Test uploaded photos are deduplicated and downloadable in ranges."""
+        with self.app.app_context():
+            user = UserFactory()
+            access_token = User.generate_token(user.id)
+
+        content = b'\xff\xd8' + bytes(range(256)) * 64
+        for name in ('first.jpg', 'second.jpg'):
+            response = self.client.post(
+                '/api/users/photo/upload',
+                data={'data': (io.BytesIO(content), name)},
+                headers={'Authorization': access_token})
+            self.assertEqual(response.status_code, 201)
+
+        with self.app.app_context():
+            photos = Photo.query.order_by(Photo.id).all()
+            self.assertEqual(len({photo.sha256 for photo in photos}), 1)
+
+        response = self.client.get('/api/users/photo/download',
+                                   headers={'Authorization': access_token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, content)
+        self.assertIn('second.jpg', response.headers['Content-Disposition'])
+
+        with self.subTest('Range requests'):
+            response = self.client.get('/api/users/photo/download',
+                                       headers={'Authorization': access_token,
+                                                'Range': 'bytes=2-9'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, content[2:10])
+
+        with self.subTest('Reverse proxy downloads'):
+            self.app.config['PHOTO_ACCEL_REDIRECT_PREFIX'] = '/protected-media'
+            self.app.extensions.pop('photo_storage')
+            response = self.client.get('/api/users/photo/download',
+                                       headers={'Authorization': access_token})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'')
+            self.assertTrue(response.headers['X-Accel-Redirect'].startswith(
+                '/protected-media/'))
+            self.assertTrue(response.headers['X-Accel-Redirect'].endswith(photos[0].sha256))
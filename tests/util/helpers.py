@@ -1,6 +1,12 @@
 import datetime
 import json
+from contextlib import contextmanager
+
 from redis import StrictRedis
+from sqlalchemy import event
+
+from api.models.db import db
+from api.util import cache
 
 
 class JsonEncoderWithDatetime(json.JSONEncoder):
@@ -13,6 +19,22 @@ class JsonEncoderWithDatetime(json.JSONEncoder):
 
 
 def reset_redis_database_cache():
-    """deletes cached results in redis"""
+    """deletes cached results in redis and in process memory"""
     redis = StrictRedis(host='redis', port=6379)
     redis.flushdb()
+    cache.LOCAL_CACHE.clear()
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the block."""
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)